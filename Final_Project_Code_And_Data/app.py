@@ -21,91 +21,419 @@ Names: Amelia Whitworth, Jennie Chung
 Emails: awhirwor@caltech.edu, jjchung@caltech.edu 
 """
 
-from re import S
+import functools
+import json
+import re
 import sys  # to print error messages to sys.stderr
+import time
 import mysql.connector
 # To get error codes from the connector, useful for user-friendly
 # error-handling
 import mysql.connector.errorcode as errorcode
 
+from autocomplete import AutocompleteIndex, AUTHOR, TITLE
+from db_pool import ConnectionPool, DB_CONFIG, is_connection_lost
+from metrics import Metrics, estimate_bytes
+from pagination import decode_cursor, split_page
+from result_cache import ResultCache
+
+# The description similarity index is optional: it needs NumPy and SciPy, and
+# an index built with `python3 description_index.py build`.
+try:
+    from description_index import DescriptionIndex, DEFAULT_INDEX_DIR
+except ImportError:
+    DescriptionIndex = None
+
 # Debugging flag to print errors when debugging that shouldn't be visible
 # to an actual client. Set to False when done testing.
 DEBUG = True
+# Programs which call the functions below directly rather than through the
+# menus (e.g. benchmark.py) set this to True, so that database errors are 
+# raised to them instead of printed.
+RAISE_ERRORS = False
+
+# Instrumentation (see metrics.py). Statements taking at least 
+# SLOW_QUERY_SECONDS are logged, with their parameters, to the file 
+# SLOW_QUERY_LOG (None for no log). If PROFILE_OPERATION is the name of an
+# operation (e.g. 'search'), it runs under cProfile and tracemalloc. If
+# METRICS_FILE is set, the metrics are saved there as JSON on quitting.
+SLOW_QUERY_SECONDS = 0.5
+SLOW_QUERY_LOG = None
+PROFILE_OPERATION = None
+METRICS_FILE = None
+
+# Connection pool settings. POOL_SIZE is the maximum number of connections
+# this process opens to booksdb; POOL_TIMEOUT is how long (in seconds) an
+# operation waits for a free connection before giving up.
+POOL_SIZE = 5
+POOL_TIMEOUT = 10.0
+# Connections idle for longer than this many seconds are pinged before use
+POOL_HEALTH_CHECK_INTERVAL = 30.0
+# Maximum number of prepared statements kept open on each connection
+STATEMENT_CACHE_SIZE = 64
+# Number of rows fetched from the server at a time by stream_sql_query
+STREAM_BATCH_SIZE = 500
+
+# Query result cache settings: the maximum number of cached results, how long
+# (in seconds) a result stays cached, and the largest result (in rows) which
+# is cached. Only queries run with cache=True are cached.
+RESULT_CACHE_SIZE = 256
+RESULT_CACHE_TTL = 300.0
+RESULT_CACHE_MAX_ROWS = 10000
+
+# Book recommendation settings. Candidate books score GENRE_WEIGHT points for
+# every genre they share with the book the user enjoyed, AUTHOR_WEIGHT points
+# for every shared author, and up to YEAR_WEIGHT * (YEAR_WINDOW + 1) points 
+# for being published within YEAR_WINDOW years of it (more for closer years).
+RECOMMENDATION_LIMIT = 10
+GENRE_WEIGHT = 1
+AUTHOR_WEIGHT = 3
+YEAR_WEIGHT = 1
+YEAR_WINDOW = 2
+
+# Top rated books in a timeframe settings: how many books are shown per 
+# page, and how many ratings a book needs to be included (so that a book with
+# one 5-star rating doesn't top the list)
+TOP_RATED_LIMIT = 20
+TOP_RATED_MIN_RATINGS = 10
+# Number of books shown per page of a user's top rated books
+USER_TOP_RATED_LIMIT = 10
+# Number of books shown per page of search results
+SEARCH_PAGE_SIZE = 20
+
+# Maximum number of results shown by full-text search
+SEARCH_LIMIT = 20
+# Maximum number of candidate books shown when resolving a partial title or
+# author to an isbn_10
+AUTOCOMPLETE_LIMIT = 8
+
+# Input which looks like an isbn_10 rather than a title or author. Our 
+# isbn_10s may have lost their leading zeros, so they can be shorter than 10.
+ISBN_10_RE = re.compile(r'^[0-9]{5,9}[0-9Xx]$')
 
 # ----------------------------------------------------------------------
 # SQL Utility Functions
 # ----------------------------------------------------------------------
-def get_conn():
+def get_pool():
     """"
-    Returns a connected MySQL connector instance, if connection is successful.
-    If unsuccessful, exits.
+    Returns a ConnectionPool connected to the books database, if connection 
+    is successful. If unsuccessful, exits (or raises the error, if 
+    RAISE_ERRORS is set).
     """
     try:
-        conn = mysql.connector.connect(
-          host='localhost',
-          user='bookretailer',
-          # Find port in MAMP or MySQL Workbench GUI or with
-          # SHOW VARIABLES WHERE variable_name LIKE 'port';
-          port='3306',
-          password='8sXjJK',
-          database='booksdb'
+        pool = ConnectionPool(
+            size=POOL_SIZE,
+            timeout=POOL_TIMEOUT,
+            health_check_interval=POOL_HEALTH_CHECK_INTERVAL,
+            statement_cache_size=STATEMENT_CACHE_SIZE,
+            **DB_CONFIG
         )
         print('Successfully connected.')
-        return conn
+        return pool
     except mysql.connector.Error as err:
+        if RAISE_ERRORS:
+            raise
         # Remember that this is specific to _database_ users, not
         # application users. So is probably irrelevant to a client in your
         # simulated program. Their user information would be in a users table
         # specific to your database.
         if err.errno == errorcode.ER_ACCESS_DENIED_ERROR and DEBUG:
-            sys.stderr('Incorrect username or password when connecting to DB.')
+            sys.stderr.write('Incorrect username or password when connecting '
+                'to DB.\n')
         elif err.errno == errorcode.ER_BAD_DB_ERROR and DEBUG:
-            sys.stderr('Database does not exist.')
+            sys.stderr.write('Database does not exist.\n')
         elif DEBUG:
-            sys.stderr(err)
+            sys.stderr.write('%s\n' % err)
         else:
-            sys.stderr('An error occurred, please contact the administrator.')
+            sys.stderr.write('An error occurred, please contact the '
+                'administrator.\n')
         sys.exit(1)
 
 # ----------------------------------------------------------------------
 # Functions for Command-Line Options/Query Execution
 # ----------------------------------------------------------------------
-def execute_sql_query(sql, error_message):
+def execute_sql_query(sql, error_message, params=(), cache=False):
+    """
+    Try-except for executing sql queries. The query is a prepared statement
+    with %s placeholders for each value in params, which are sent to the
+    server separately (so user input is never spliced into the SQL text).
+
+    Queries are read-only, so they run on a read-only checkout from the 
+    connection pool (no transaction and no commit). If the connection turns 
+    out to have been lost, the query is retried once on a fresh connection.
+
+    With cache=True, the result is served from (and stored in) the query 
+    result cache. Use this for catalog lookups which are repeated often; 
+    results are dropped from the cache whenever this process writes to a 
+    table they read.
+    """
+    if cache:
+        rows = result_cache.get(sql, params)
+        if rows is not None:
+            return rows
+
+    rows = []
+    for attempt in range(2):
+        try:
+            with pool.checkout(read_only=True) as pooled:
+                cursor = pooled.statements.cursor(sql)
+                start = time.perf_counter()
+                try:
+                    cursor.execute(sql, params)
+                    rows = cursor.fetchall()
+                except mysql.connector.Error:
+                    instruments.record_statement(sql, params, 
+                        time.perf_counter() - start, 0, 0, error=True)
+                    # Don't reuse a prepared statement left in a failed state
+                    pooled.statements.discard(sql)
+                    raise
+                instruments.record_statement(sql, params, 
+                    time.perf_counter() - start, len(rows), 
+                    estimate_bytes(rows))
+            if cache:
+                result_cache.put(sql, params, rows)
+            break
+        except mysql.connector.Error as err:
+            if attempt == 0 and is_connection_lost(err):
+                continue
+            if RAISE_ERRORS:
+                raise
+            if DEBUG:
+                sys.stderr.write('%s\n' % err)
+                sys.exit(1)
+            else:
+                sys.stderr.write(error_message + '\n')
+
+    return rows
+
+def stream_sql_query(sql, error_message, params=(), 
+                     batch_size=STREAM_BATCH_SIZE, cache=False):
+    """
+    Like execute_sql_query, but a generator which yields rows as they arrive
+    from the server instead of returning them all in a list. Rows are read
+    from the unbuffered result in batches of batch_size with fetchmany, so 
+    memory use stays flat and the first row can be displayed as soon as the
+    server sends it, no matter how large the result is.
+
+    The connection stays checked out until the generator is exhausted or
+    closed, so don't run other queries in between consuming its rows.
+
+    With cache=True, cached results are replayed without a round trip, and
+    results of up to RESULT_CACHE_MAX_ROWS rows are cached once they have 
+    been read in full (see execute_sql_query).
+    """
+    if cache:
+        rows = result_cache.get(sql, params)
+        if rows is not None:
+            yield from rows
+            return
+
+    for attempt in range(2):
+        yielded = False
+        # Rows kept for the result cache, until there are too many to cache
+        collected = [] if cache else None
+        try:
+            with pool.checkout(read_only=True) as pooled:
+                cursor = pooled.statements.cursor(sql)
+                exhausted = False
+                # Time spent executing and fetching (not in the caller while
+                # it handles the rows), and what was fetched
+                seconds = 0.0
+                num_rows = 0
+                num_bytes = 0
+                error = False
+                start = time.perf_counter()
+                try:
+                    cursor.execute(sql, params)
+                except mysql.connector.Error:
+                    instruments.record_statement(sql, params, 
+                        time.perf_counter() - start, 0, 0, error=True)
+                    pooled.statements.discard(sql)
+                    raise
+                try:
+                    while True:
+                        batch = cursor.fetchmany(batch_size)
+                        seconds += time.perf_counter() - start
+                        if not batch:
+                            exhausted = True
+                            break
+                        num_rows += len(batch)
+                        num_bytes += estimate_bytes(batch)
+                        if collected is not None:
+                            collected.extend(batch)
+                            if len(collected) > result_cache.max_rows:
+                                collected = None
+                        for row in batch:
+                            yielded = True
+                            yield row
+                        start = time.perf_counter()
+                except mysql.connector.Error:
+                    error = True
+                    pooled.statements.discard(sql)
+                    raise
+                finally:
+                    # If the caller stopped early, read (and throw away) the
+                    # rest of the result so the connection can be re-used.
+                    # After a fetch error there's nothing left to read, and
+                    # the cursor may be dead.
+                    try:
+                        if not exhausted and not error:
+                            start = time.perf_counter()
+                            try:
+                                while cursor.fetchmany(batch_size):
+                                    pass
+                            except mysql.connector.Error:
+                                error = True
+                                raise
+                            finally:
+                                seconds += time.perf_counter() - start
+                    finally:
+                        instruments.record_statement(sql, params, seconds,
+                            num_rows, num_bytes, error=error)
+            if exhausted and collected is not None:
+                result_cache.put(sql, params, collected)
+            return
+        except mysql.connector.Error as err:
+            # Only retry if the caller hasn't already seen some of the rows
+            if attempt == 0 and not yielded and is_connection_lost(err):
+                continue
+            if RAISE_ERRORS:
+                raise
+            if DEBUG:
+                sys.stderr.write('%s\n' % err)
+                sys.exit(1)
+            else:
+                sys.stderr.write(error_message + '\n')
+                return
+
+def execute_instrumented(pooled, sql, params):
     """
-    Try-except for executing sql queries.
+    Executes a command on a checked-out connection, recording it (with the
+    rows it affected) in the metrics.
     """
+    cursor = pooled.statements.cursor(sql)
+    start = time.perf_counter()
     try:
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        rows = cursor.fetchall()
-        conn.commit()
-        cursor.close()
+        cursor.execute(sql, params)
+    except mysql.connector.Error:
+        instruments.record_statement(sql, params, 
+            time.perf_counter() - start, 0, 0, error=True)
+        pooled.statements.discard(sql)
+        raise
+    instruments.record_statement(sql, params, time.perf_counter() - start,
+        max(cursor.rowcount, 0), 0)
+
+
+def instrumented(name):
+    """
+    Decorator recording a menu option's statements under the operation 
+    called name (see metrics.py).
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with instruments.operation(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def execute_sql_command(sql, error_message, params=()):
+    """
+    Try-except for executing sql commands where query result is not needed.
+    As in execute_sql_query, the command is a prepared statement with %s 
+    placeholders for the values in params.
+
+    Commands run inside a transaction on a pooled connection, which is 
+    committed when the command succeeds and rolled back otherwise.
+    """
+    try:
+        with pool.checkout() as pooled:
+            execute_instrumented(pooled, sql, params)
+        # Cached results which read the tables we wrote are now stale
+        result_cache.invalidate_for(sql)
     except mysql.connector.Error as err:
+        if RAISE_ERRORS:
+            raise
         if DEBUG:
-            sys.stderr(err)
+            sys.stderr.write('%s\n' % err)
             sys.exit(1)
         else:
             sys.stderr.write(error_message + '\n')
 
-    return rows
-
-def execute_sql_command(sql, error_message):
+def execute_sql_commands(commands, error_message):
     """
-    Try-except for executing sql commands where query result is not needed.
+    Like execute_sql_command, but executes a list of (sql, params) commands
+    in a single transaction, so either all of them take effect or none do.
+    Returns True if the transaction was committed.
     """
     try:
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        conn.commit()
-        cursor.close()
+        with pool.checkout() as pooled:
+            for (sql, params) in commands:
+                execute_instrumented(pooled, sql, params)
+        for (sql, _) in commands:
+            result_cache.invalidate_for(sql)
+        return True
     except mysql.connector.Error as err:
+        if RAISE_ERRORS:
+            raise
         if DEBUG:
-            sys.stderr(err)
+            sys.stderr.write('%s\n' % err)
             sys.exit(1)
         else:
             sys.stderr.write(error_message + '\n')
+    return False
+
+
+# Books in a genre and language published after a year, newest first, a
+# page at a time: the next page seeks past the (orig_publication_yr, isbn_10)
+# of the last book shown (see pagination.py)
+SEARCH_BOOKS_PAGE_SQL = """
+    SELECT isbn_10, orig_title, orig_publication_yr
+    FROM books NATURAL JOIN genres
+    WHERE genre = %s AND language_code = %s
+    AND orig_publication_yr > %s{seek}
+    ORDER BY orig_publication_yr DESC, isbn_10
+    LIMIT %s"""
+SEARCH_BOOKS_FIRST_PAGE_SQL = SEARCH_BOOKS_PAGE_SQL.format(seek='')
+SEARCH_BOOKS_NEXT_PAGE_SQL = SEARCH_BOOKS_PAGE_SQL.format(seek="""
+    AND (orig_publication_yr < %s
+        OR (orig_publication_yr = %s AND isbn_10 > %s))""")
+
+
+def fetch_search_page(genre, language_code, after_year, cursor=None,
+        limit=SEARCH_PAGE_SIZE):
+    """
+    Returns (rows, next_cursor) for a page of up to limit (isbn_10, 
+    orig_title, orig_publication_yr) rows of the books in a genre and 
+    language published after after_year, newest first. cursor is the 
+    next_cursor of the previous page (None for the first page); next_cursor 
+    is None on the last page. Raises CursorError for an invalid cursor.
+    """
+    filters = (genre, language_code, int(after_year))
+    if cursor is None:
+        (sql, params) = (SEARCH_BOOKS_FIRST_PAGE_SQL, filters + (limit + 1,))
+    else:
+        (year, isbn_10) = decode_cursor(cursor, 'search', filters, (int, str))
+        (sql, params) = (SEARCH_BOOKS_NEXT_PAGE_SQL, 
+            filters + (year, year, isbn_10, limit + 1))
+    rows = execute_sql_query(sql, ("An error occurred, could not retrieve "
+        "specified books."), params, cache=True)
+    return split_page(rows, limit, 'search', filters, 
+        lambda row: (row[2], row[0]))
+
+
+def ask_next_page(next_cursor):
+    """
+    Returns True if there is another page and the user wants to see it.
+    """
+    if next_cursor is None:
+        return False
+    ans = input('Show the next page? (y/n): ')
+    return bool(ans) and ans.lower()[0] == 'y'
 
 
+@instrumented('search')
 def search_for_books():
     '''
     A function to prompt users for genre, language, and year specifications in 
@@ -129,8 +457,8 @@ def search_for_books():
         if chosen_genre == 'l':
             sql = "SELECT DISTINCT genre FROM genres"
             # Attempt to retrieve the genres
-            rows = execute_sql_query(sql, ("An error occurred, could not get " 
-            "list of genres."))
+            rows = stream_sql_query(sql, ("An error occurred, could not get " 
+            "list of genres."), cache=True)
             for row in rows:
                 print('    ', row[0])
 
@@ -142,8 +470,8 @@ def search_for_books():
         if chosen_lang == 'l':
             sql = "SELECT DISTINCT language_code FROM books"
             # Attempt to retrieve the language codes
-            rows = execute_sql_query(sql, ("An error occurred, could not get " 
-            "list of language_codes. "))
+            rows = stream_sql_query(sql, ("An error occurred, could not get " 
+            "list of language_codes. "), cache=True)
             for row in rows:
                 print('    ', row[0])
 
@@ -160,31 +488,120 @@ def search_for_books():
 
     # If the user has entered search criteria, create the SQL query
     if chosen_genre and chosen_lang and chosen_yr:
-        sql = """
-            SELECT orig_title, orig_publication_yr
-            FROM books NATURAL JOIN genres
-            WHERE genre = '%s' AND language_code = '%s'
-            AND orig_publication_yr > %s
-            ORDER BY orig_publication_yr DESC;""" % (chosen_genre, chosen_lang, 
-                chosen_yr)
-    
-        # Attempt to retrieve the books
-        rows = execute_sql_query(sql, ("An error occurred, could not retrieve " 
-            "specified books."))
-    
-        # If there are no books, let the user know. Otherwise, display
-        # the results.
-        if not rows:
-            print(("Could not find any books under genre {}, in {}, published "
-                "post-{}").format(chosen_genre, chosen_lang, chosen_yr))
-        else:
-            print(("The following are books under genre {}, in {}, published "
-                "post-{}").format(chosen_genre, chosen_lang, chosen_yr))
+        # Attempt to retrieve the books, a page at a time
+        cursor = None
+        page = 0
+        while True:
+            (rows, cursor) = fetch_search_page(chosen_genre, chosen_lang, 
+                chosen_yr, cursor)
+            page += 1
+            # If there are no books, let the user know.
+            if not rows:
+                if page == 1:
+                    print(("Could not find any books under genre {}, in {}, "
+                        "published post-{}").format(chosen_genre, chosen_lang,
+                        chosen_yr))
+                break
+            print(("The following are books under genre {}, in {}, "
+                "published post-{} (page {}):").format(chosen_genre, 
+                chosen_lang, chosen_yr, page))
             for row in rows:
-                (orig_title, orig_publication_yr) = (row) 
+                (isbn_10, orig_title, orig_publication_yr) = (row) 
                 print('    ', orig_title, orig_publication_yr)
+            if not ask_next_page(cursor):
+                break
 
 
+def load_autocomplete_index():
+    """
+    Builds the in-memory autocomplete index over every book title and author
+    in the database.
+    """
+    index = AutocompleteIndex()
+    index.add_many(stream_sql_query("SELECT isbn_10, orig_title FROM books",
+        "An error occurred, could not load book titles."), TITLE)
+    index.add_many(stream_sql_query("SELECT isbn_10, author FROM authors",
+        "An error occurred, could not load authors."), AUTHOR)
+    return index
+
+
+# Books whose title contains some text, for resolving titles when the
+# autocomplete index isn't loaded
+TITLE_LIKE_SQL = """
+    SELECT isbn_10, orig_title
+    FROM books
+    WHERE orig_title LIKE %s
+    ORDER BY orig_title
+    LIMIT %s"""
+
+
+def find_books_by_title(text, limit=AUTOCOMPLETE_LIMIT):
+    """
+    Returns up to limit (isbn_10, title, matched, score) candidates, as from
+    AutocompleteIndex.lookup, for the books whose title contains text (with 
+    no typo tolerance, and no score).
+    """
+    pattern = '%{}%'.format(text.replace('\\', '\\\\').replace('%', '\\%')
+        .replace('_', '\\_'))
+    rows = execute_sql_query(TITLE_LIKE_SQL, ("An error occurred, could not "
+        "search book titles."), (pattern, limit))
+    return [(isbn_10, title, title, None) for (isbn_10, title) in rows]
+
+
+def resolve_isbn_10(text):
+    """
+    Returns the isbn_10 for user input which is either an isbn_10 or a 
+    (possibly partial or misspelled) title or author. For titles and authors,
+    the user picks from the matching books. Returns None if nothing matches
+    or nothing is picked. Without the autocomplete index (see init_app), 
+    only exact parts of titles are matched.
+    """
+    text = text.strip()
+    if ISBN_10_RE.match(text):
+        return text.upper()
+
+    if autocomplete_index is None:
+        candidates = find_books_by_title(text)
+    else:
+        candidates = autocomplete_index.lookup(text, AUTOCOMPLETE_LIMIT)
+    if not candidates:
+        print('Could not find any books matching "{}".'.format(text))
+        return None
+
+    print('Which of these books did you mean?')
+    for (i, (isbn_10, title, matched, score)) in enumerate(candidates, 1):
+        if matched == title:
+            print('  ({}) - {} [{}]'.format(i, title, isbn_10))
+        else:
+            print('  ({}) - {} by {} [{}]'.format(i, title, matched, isbn_10))
+    print()
+
+    choice = input('Enter an option (or press enter for none of these): ')
+    if choice.strip().isdigit() and 1 <= int(choice) <= len(candidates):
+        return candidates[int(choice) - 1][0]
+    return None
+
+
+def input_isbn_10(prompt):
+    """
+    Prompts for a book by isbn_10, title or author, and returns its isbn_10
+    (or None). See resolve_isbn_10.
+    """
+    return resolve_isbn_10(input(prompt))
+
+
+def insert_rating(user_id, isbn_10, rating):
+    """
+    Adds a user's rating (1 to 5 stars) of a book.
+    """
+    sql = """
+        INSERT INTO ratings(user_id, isbn_10, rating) 
+        VALUES (%s, %s, %s)"""
+    execute_sql_command(sql, 'An error occurred, could not add rating.',
+        (user_id, isbn_10, rating))
+
+
+@instrumented('rate')
 def add_rating():
     """
     Users are also able to perform other actions, such as add a rating of a 
@@ -199,19 +616,28 @@ def add_rating():
     # If yes, prompt the user for rating info
     if ans and ans.lower()[0] == 'y':
         user_id = input('What is your user_id? ')
-        isbn_10 = input(('What is the isbn_10 identifier of the book? '
-            '(must be 10 characters): '))
+        isbn_10 = input_isbn_10(('What is the isbn_10 identifier, title or '
+            'author of the book? '))
         rating = input('What do you rate this book (1 to 5 stars)? ')
 
     # If the user has entered valid rating info, create the SQL command
     if user_id and isbn_10 and rating:
-        sql = """
-            INSERT INTO ratings(user_id, isbn_10, rating) 
-            VALUES (%s, '%s', %s);""" % (user_id, isbn_10, rating)
         # Attempt to add this book to the ratings table
-        execute_sql_command(sql, 'An error occurred, could not add rating.')
+        insert_rating(user_id, isbn_10, rating)
 
 
+def insert_to_read(user_id, isbn_10):
+    """
+    Adds a book to a user's to-read shelf.
+    """
+    sql = """
+        INSERT INTO to_read(user_id, isbn_10) 
+        VALUES (%s, %s)"""
+    execute_sql_command(sql, 'An error occurred, could not add book to to_read.',
+        (user_id, isbn_10))
+
+
+@instrumented('to_read')
 def add_to_read_item():
     """
     User can also add a book to their "to-read" shelf by adding an 
@@ -225,18 +651,36 @@ def add_to_read_item():
     # If yes, prompt the user for rating info
     if ans and ans.lower()[0] == 'y':
         user_id = input('What is your user_id?')
-        isbn_10 = input('What is the isbn_10 identifier of the book?')
+        isbn_10 = input_isbn_10(('What is the isbn_10 identifier, title or '
+            'author of the book? '))
 
     # If the user has entered valid to-read book info, create the SQL command
     if user_id and isbn_10:
-        sql = """
-            INSERT INTO to_read(user_id, isbn_10) 
-            VALUES (%s, %s);""" % (user_id, isbn_10)
-    
         # Attempt to add this book to the to_read table
-        execute_sql_command(sql, 'An error occurred, could not add book to to_read.')
+        insert_to_read(user_id, isbn_10)
+
 
+# Books (with their details) by an author
+BOOKS_BY_AUTHOR_SQL = """
+    SELECT isbn_10, orig_title, orig_publication_yr, author, 
+        num_pages, num_comments, num_editions  
+    FROM books NATURAL JOIN book_details NATURAL JOIN authors 
+    WHERE author = %s"""
 
+
+def fetch_books_by_author(author):
+    """
+    Returns a list of (isbn_10, orig_title, orig_publication_yr, author, 
+    num_pages, num_comments, num_editions) rows for the books by an author
+    (the exact author name).
+    """
+    # The author names are exact, so this is an idx_authors_author lookup
+    # rather than a LIKE '%...%' scan of every author.
+    return execute_sql_query(BOOKS_BY_AUTHOR_SQL, ("An error occurred, could "
+        "not retrieve popular series."), (author,), cache=True)
+
+
+@instrumented('popular_series')
 def view_popular_series_info():
     """
     Users can also view information pertaining to popular authors in the 
@@ -265,7 +709,7 @@ def view_popular_series_info():
         if option == 'h':
             chosen_author = 'J.K. Rowling'
         elif option == 't':
-            chosen_author = 'Stephanie Meyer'
+            chosen_author = 'Stephenie Meyer'
         elif option == 'g':
             chosen_author = 'Suzanne Collins'
         elif option == 'n':
@@ -275,36 +719,90 @@ def view_popular_series_info():
         
     # If the user has entered search criteria, create the SQL query
     if chosen_author:
-        sql = """
-            SELECT orig_title, orig_publication_yr, author, num_pages, 
-                num_comments, num_editions  
-            FROM books NATURAL JOIN book_details NATURAL JOIN authors 
-            WHERE author LIKE '%%%s%%';""" % (chosen_author)
-    
         # Attempt to retrieve the books by this popular series author
-        rows = execute_sql_query(sql, ("An error occurred, could not retrieve "
-            "popular series."))
+        rows = fetch_books_by_author(chosen_author)
     
         # If there are no books, let the user know. Otherwise, display
         # the results.
         if not rows:
-            print("Could not find any books by %s".format(chosen_author))
+            print("Could not find any books by {}".format(chosen_author))
         else:
-            print("The following are books are by %s:".format(chosen_author))
+            averages = fetch_average_ratings([row[0] for row in rows])
+            print("The following are books are by {}:".format(chosen_author))
             for row in rows:
-                (orig_title, orig_publication_yr, author, num_pages, num_comments,
-                    num_editions) = (row) 
+                (isbn_10, orig_title, orig_publication_yr, author, num_pages, 
+                    num_comments, num_editions) = (row) 
                 print('    ', orig_title, orig_publication_yr, 
-                    author, num_pages, num_comments, num_editions)
+                    author, num_pages, num_comments, num_editions,
+                    format_average_rating(averages.get(isbn_10, (0, None))))
     
 
+# Finds books whose title, author or description match the search terms, using
+# the full-text indexes from setup.sql. Title and author matches count double,
+# since they are much more specific than a word in a long description.
+FULL_TEXT_SEARCH_SQL = """
+    SELECT b.isbn_10, b.orig_title, b.orig_publication_yr, 
+        SUM(m.relevance) AS relevance
+    FROM (
+        SELECT isbn_10, 2 * MATCH(orig_title) AGAINST (%s) AS relevance
+        FROM books
+        WHERE MATCH(orig_title) AGAINST (%s)
+        UNION ALL
+        SELECT isbn_10, 2 * MATCH(author) AGAINST (%s) AS relevance
+        FROM authors
+        WHERE MATCH(author) AGAINST (%s)
+        UNION ALL
+        SELECT isbn_10, MATCH(book_description) AGAINST (%s) AS relevance
+        FROM book_details
+        WHERE MATCH(book_description) AGAINST (%s)
+    ) AS m JOIN books AS b ON b.isbn_10 = m.isbn_10
+    GROUP BY b.isbn_10, b.orig_title, b.orig_publication_yr
+    ORDER BY relevance DESC, b.isbn_10
+    LIMIT %s"""
+
+
+def fetch_full_text_matches(search_terms, limit=SEARCH_LIMIT):
+    """
+    Returns a list of up to limit (isbn_10, orig_title, orig_publication_yr,
+    relevance) rows for the books best matching the search terms, most 
+    relevant first.
+    """
+    return execute_sql_query(FULL_TEXT_SEARCH_SQL, ("An error occurred, could "
+        "not search for books."), (search_terms,) * 6 + (limit,), cache=True)
+
+
+@instrumented('full_text_search')
+def full_text_search():
+    """
+    Users can search for books by keywords, which are matched against book
+    titles, authors and descriptions.
+    """
+    search_terms = input(('What would you like to search for? (e.g. a title, '
+        'an author or a topic): ')).strip()
+
+    if search_terms:
+        rows = fetch_full_text_matches(search_terms)
+
+        # If there are no books, let the user know. Otherwise, display
+        # the results.
+        if not rows:
+            print('Could not find any books matching "{}"'.format(search_terms))
+        else:
+            print('The following books best match "{}":'.format(search_terms))
+            for row in rows:
+                (isbn_10, orig_title, orig_publication_yr, relevance) = (row)
+                print('    ', isbn_10, orig_title, orig_publication_yr)
+
+
 def get_isbn_10(select_option):
     """
     Helper function for get_book_recommendation for users to either select a 
     book from a list of books or directly input an isbn. 
     """
+    isbn_10 = None
+
     # If the user wants to select from a list of options, let them select one,
-    # otherwise they can input the isbn_10 directly.
+    # otherwise they can input the isbn_10 (or title or author) directly.
     if select_option == 'options':
         print('Which of these books appeals to you most?')
         print('  (h) - The Hobbit and The Lord of the Rings')
@@ -319,36 +817,191 @@ def get_isbn_10(select_option):
         # We hardcode these isbn_10 identifiers in case there are duplicate
         # titles or duplicate titles are added to the db later on
         if option == 'h':
-            isbn_10 = ' 345538374'
+            isbn_10 = '345538374'
         elif option == 'hp':
-            isbn_10 = ' 439554934'
+            isbn_10 = '439554934'
         elif option == 'm':
-            isbn_10 = ' 743477545'
+            isbn_10 = '743477545'
         elif option == 'g':
-            isbn_10 = ' 385732554'
+            isbn_10 = '385732554'
         elif option == 't':
-            isbn_10 = ' 141439602'
+            isbn_10 = '141439602'
     elif select_option == 'direct_selection':
-        isbn_10 = input('What is the isbn_10 of a book you\'ve enjoyed?')
+        isbn_10 = input_isbn_10(('What is the isbn_10, title or author of a '
+            'book you\'ve enjoyed? '))
 
     return isbn_10
 
 
+# Scores every book sharing a genre or an author with the seed book, or 
+# published within YEAR_WINDOW years of it, and returns the best ones. All of
+# the scoring happens in one statement, so a recommendation is one round trip
+# and at most RECOMMENDATION_LIMIT rows however many genres the seed book has.
+RECOMMENDATION_SQL = """
+    WITH seed AS (
+        SELECT isbn_10, orig_publication_yr
+        FROM books
+        WHERE isbn_10 = %%s
+    ),
+    candidates AS (
+        SELECT g.isbn_10, %(genre_weight)d AS score
+        FROM genres AS g JOIN genres AS seed_genres ON g.genre = seed_genres.genre
+        WHERE seed_genres.isbn_10 = %%s
+        UNION ALL
+        SELECT a.isbn_10, %(author_weight)d AS score
+        FROM authors AS a 
+            JOIN authors AS seed_authors ON a.author = seed_authors.author
+        WHERE seed_authors.isbn_10 = %%s
+        UNION ALL
+        SELECT b.isbn_10, 0 AS score
+        FROM books AS b JOIN seed
+        WHERE b.orig_publication_yr 
+            BETWEEN seed.orig_publication_yr - %(year_window)d 
+            AND seed.orig_publication_yr + %(year_window)d
+    )
+    SELECT b.isbn_10, b.orig_title, b.orig_publication_yr,
+        SUM(c.score) + %(year_weight)d * GREATEST(0, %(year_window)d + 1 
+            - COALESCE(ABS(b.orig_publication_yr - seed.orig_publication_yr), 
+                %(year_window)d + 1)) AS score
+    FROM candidates AS c JOIN books AS b ON b.isbn_10 = c.isbn_10 JOIN seed
+    WHERE b.isbn_10 <> seed.isbn_10
+    GROUP BY b.isbn_10, b.orig_title, b.orig_publication_yr, 
+        seed.orig_publication_yr
+    ORDER BY score DESC, b.isbn_10
+    LIMIT %%s""" % {
+        'genre_weight': GENRE_WEIGHT,
+        'author_weight': AUTHOR_WEIGHT,
+        'year_weight': YEAR_WEIGHT,
+        'year_window': YEAR_WINDOW,
+    }
+
+
+def fetch_recommendations(isbn_10, limit=RECOMMENDATION_LIMIT):
+    """
+    Returns a list of up to limit (isbn_10, orig_title, orig_publication_yr,
+    score) rows for books similar to the book with the given isbn_10, best 
+    first. Books are scored on shared genres, shared authors and how close 
+    their publication years are; the book itself is never recommended.
+    """
+    return execute_sql_query(RECOMMENDATION_SQL, ("An error occurred, could "
+        "not retrieve book recommendations."), 
+        (isbn_10, isbn_10, isbn_10, limit), cache=True)
+
+
+# The nearest neighbors of a book, from build_book_neighbors.py
+ALSO_LIKED_SQL = """
+    SELECT n.neighbor_isbn_10, b.orig_title, n.similarity
+    FROM book_neighbors AS n 
+        JOIN books AS b ON b.isbn_10 = n.neighbor_isbn_10
+    WHERE n.isbn_10 = %s
+    ORDER BY n.neighbor_rank
+    LIMIT %s"""
+
+
+def fetch_also_liked(isbn_10, limit=RECOMMENDATION_LIMIT):
+    """
+    Returns a list of up to limit (isbn_10, orig_title, similarity) rows for
+    the books readers rated most like the book with the given isbn_10, from
+    the book_neighbors table built by build_book_neighbors.py.
+    """
+    return execute_sql_query(ALSO_LIKED_SQL, ("An error occurred, could not "
+        "retrieve books liked by similar readers."), (isbn_10, limit))
+
+
+def load_description_index():
+    """
+    Memory-maps the book description similarity index, if it has been built
+    and NumPy and SciPy are installed. Returns None otherwise.
+    """
+    if DescriptionIndex is None:
+        return None
+    try:
+        return DescriptionIndex.load(DEFAULT_INDEX_DIR)
+    except OSError:
+        return None
+
+
+def fetch_similar_descriptions(isbn_10, limit=RECOMMENDATION_LIMIT):
+    """
+    Returns a list of up to limit (isbn_10, orig_title, similarity) tuples
+    for the books whose descriptions are most like the given book's, or an
+    empty list if the description index isn't loaded. The similarity search
+    itself runs in memory, not in MySQL.
+    """
+    if description_index is None:
+        return []
+    similar = description_index.similar(isbn_10, limit)
+    titles = fetch_titles([isbn for (isbn, _) in similar])
+    return [(isbn, titles.get(isbn, ''), similarity) 
+            for (isbn, similarity) in similar]
+
+
+# Titles of a list of books. As in AVERAGE_RATINGS_SQL below, the isbn_10s 
+# are passed as one JSON array, so lists of any length share a single 
+# prepared statement.
+TITLES_SQL = """
+    SELECT books.isbn_10, orig_title
+    FROM JSON_TABLE(%s, '$[*]' COLUMNS (isbn_10 CHAR(10) PATH '$')) AS isbns
+        JOIN books ON books.isbn_10 = isbns.isbn_10"""
+
+
+def fetch_titles(isbns):
+    """
+    Returns a dictionary from isbn_10 to orig_title for the given isbn_10s.
+    """
+    if not isbns:
+        return {}
+    rows = execute_sql_query(TITLES_SQL, "An error occurred, could not get "
+        "titles.", (json.dumps(list(isbns)),), cache=True)
+    return dict(rows)
+
+
+# Set-based version of the get_average_rating UDF (see sp_get_average_ratings
+# in setup-routines.sql). The isbn_10s are passed as one JSON array, so lists
+# of any length share a single prepared statement.
+AVERAGE_RATINGS_SQL = """
+    SELECT isbns.isbn_10, IFNULL(num_ratings, 0), avg_rating
+    FROM JSON_TABLE(%s, '$[*]' COLUMNS (isbn_10 CHAR(10) PATH '$')) AS isbns
+        LEFT JOIN book_stats ON book_stats.isbn_10 = isbns.isbn_10"""
+
+
+def fetch_average_ratings(isbns):
+    """
+    Returns a dictionary from isbn_10 to (num_ratings, avg_rating) for the 
+    given isbn_10s, looked up in one statement. avg_rating is None for books 
+    without ratings.
+    """
+    if not isbns:
+        return {}
+    rows = execute_sql_query(AVERAGE_RATINGS_SQL, "An error occurred, could "
+        "not get average ratings.", (json.dumps(list(isbns)),), cache=True)
+    return {isbn_10: (num_ratings, avg_rating) 
+            for (isbn_10, num_ratings, avg_rating) in rows}
+
+
+def format_average_rating(average):
+    """
+    Formats a (num_ratings, avg_rating) pair from fetch_average_ratings for
+    display.
+    """
+    (num_ratings, avg_rating) = average
+    if avg_rating is None:
+        return 'no ratings'
+    return 'avg {:.2f} ({} ratings)'.format(float(avg_rating), num_ratings)
+
+
+@instrumented('recommend')
 def get_book_recommendation():
     """
     Users can also be recommended a book by entering a book they liked. Then,
-    a similar book will be recommended by extracting information about the book 
-    they liked, given that it is in the database.
+    similar books will be recommended based on the genres, author and 
+    publication year of the book they liked, given that it is in the database.
     """
     # Ask the user whether they'd like to search the database using these
     # criteria 
     ans = input('Would you like to get a book recommendation? (y/n): ')
     isbn_10 = None
 
-    by_genre = None
-    by_year = None
-    by_author = None
-
     # If yes, prompt the user for a book they like in the database?
     if ans and ans.lower()[0] == 'y':
         print('To recommend a book, you can either:')
@@ -363,71 +1016,75 @@ def get_book_recommendation():
         elif select_option == 'b':
             isbn_10 = get_isbn_10('direct_selection')
 
-        # If the user has entered search criteria, create the SQL query
+        # If the user has selected a book, recommend the most similar books
         if isbn_10:
-            sql = """
-                SELECT isbn_10, orig_title, genre, publication_year, author
-                FROM books NATURAL JOIN genres NATURAL JOIN authors
-                WHERE isbn_10 = %s""" % (isbn_10)
-        
-            # Attempt to retrieve the books
-            rows = execute_sql_query(sql, ("An error occurred, could not retrieve"
-                "book to base recommendation on."))
-        
-            # If there are no books, let the user know. Otherwise, make some
-            # recommendations with the same genre, publication year, and/or 
-            # author
+            rows = fetch_recommendations(isbn_10)
+
+            # If there are no recommendations (or the book is not in the 
+            # database), let the user know. Otherwise, display them.
             if not rows:
-                print(("A book with isbn_10 %s does not exist in the "
-                    "database").format(isbn_10))
+                print(("There are no books with the same genre, publication "
+                    "year, or author as the book with isbn_10 {}, or it does "
+                    "not exist in the database.").format(isbn_10))
             else:
+                print('Here are some recommendations: ')
                 for row in rows:
-                    (isbn_10, orig_title, genre, year, author) = (row) 
-                    recommendations = []
-                    
-                    # Find a book in the same genre
-                    sql = """
-                    SELECT isbn_10, orig_title
-                    FROM books NATURAL JOIN genres
-                    WHERE genre = '%s'
-                    """% (genre)
-                    same_genre_row = execute_sql_query(sql, ("An error occured,"
-                        " could not retrieve same genre book"))
-                    if same_genre_row:
-                        recommendations.append(same_genre_row)
-
-                    sql = """
-                    SELECT isbn_10, orig_title
-                    FROM books
-                    WHERE orig_publication_yr = '%s'
-                    """% (year)
-                    # Find a book in the same publication year
-                    same_year_row = execute_sql_query(sql, ("An error occured, "
-                        "could not retrieve same publication year book"))
-                    if same_year_row:
-                        recommendations.append(same_year_row)
-
-                    sql = """
-                    SELECT isbn_10, orig_title
-                    FROM books NATURAL JOIN authors
-                    WHERE author = '%s'
-                    """% (author)
-                    # Find a book with the same author
-                    same_year_row = execute_sql_query(sql, ("An error occured, "
-                        "could not retrieve same author book"))
-                    if same_year_row:
-                        recommendations.append(same_year_row)
-
-                    if recommendations:
-                        print('Here are some recommendations: ')
-                        for row in recommendations:
-                            (orig_title, orig_publication_yr) = (row) 
-                            print('    ', isbn_10, orig_title)
-                    else:
-                        print(("There are no books with the same genre, "
-                            "publication year, or author as the selection."))
-
-
+                    (rec_isbn_10, orig_title, orig_publication_yr, score) = (row)
+                    print('    ', rec_isbn_10, orig_title, orig_publication_yr)
+
+            # Show the books whose descriptions are most like this book's
+            similar = fetch_similar_descriptions(isbn_10)
+            if similar:
+                print('Books with similar descriptions: ')
+                for (rec_isbn_10, orig_title, similarity) in similar:
+                    print('    ', rec_isbn_10, orig_title)
+
+            # Also show what readers who rated this book similarly liked
+            rows = fetch_also_liked(isbn_10)
+            if rows:
+                print('Readers who liked this book also liked: ')
+                for row in rows:
+                    (rec_isbn_10, orig_title, similarity) = (row)
+                    print('    ', rec_isbn_10, orig_title)
+
+
+# A user's highest rated books, a page at a time: the next page seeks past 
+# the (rating, isbn_10) of the last book shown, reading idx_ratings_user_rating
+# from there (see pagination.py)
+USERS_TOP_RATED_PAGE_SQL = """
+    SELECT isbn_10, rating
+    FROM ratings
+    WHERE user_id = %s{seek}
+    ORDER BY rating DESC, isbn_10
+    LIMIT %s"""
+USERS_TOP_RATED_FIRST_PAGE_SQL = USERS_TOP_RATED_PAGE_SQL.format(seek='')
+USERS_TOP_RATED_NEXT_PAGE_SQL = USERS_TOP_RATED_PAGE_SQL.format(seek="""
+    AND (rating < %s OR (rating = %s AND isbn_10 > %s))""")
+
+
+def fetch_users_top_rated_page(user_id, cursor=None, 
+        limit=USER_TOP_RATED_LIMIT):
+    """
+    Returns (rows, next_cursor) for a page of up to limit (isbn_10, rating)
+    rows of a user's highest rated books. cursor is the next_cursor of the 
+    previous page (None for the first page); next_cursor is None on the last
+    page. Raises CursorError for an invalid cursor.
+    """
+    filters = (int(user_id),)
+    if cursor is None:
+        (sql, params) = (USERS_TOP_RATED_FIRST_PAGE_SQL, filters + (limit + 1,))
+    else:
+        (rating, isbn_10) = decode_cursor(cursor, 'users_top_rated', filters, 
+            (int, str))
+        (sql, params) = (USERS_TOP_RATED_NEXT_PAGE_SQL, 
+            filters + (rating, rating, isbn_10, limit + 1))
+    rows = execute_sql_query(sql, ("An error occurred, could not retrieve "
+        "user\'s top rated books."), params)
+    return split_page(rows, limit, 'users_top_rated', filters, 
+        lambda row: (row[1], row[0]))
+
+
+@instrumented('users_top_rated')
 def get_users_top_rated():
     """
     Admin users can target specific readers and recommend them books
@@ -443,28 +1100,92 @@ def get_users_top_rated():
 
     # If the user has entered a user_id create the SQL query
     if chosen_user_id:
-        sql = """
-            SELECT isbn_10, rating
-            FROM ratings
-            WHERE user_id = %s
-            ORDER BY rating DESC
-            LIMIT 10;""" % (chosen_user_id)
-    
-        # Attempt to retrieve the user's top rated books
-        rows = execute_sql_query(sql, ("An error occurred, could not retrieve "
-            "user\'s top rated books."))
-    
-        # If there are no books, let the user know. Otherwise, display
-        # the results.
-        if not rows:
-            print("Could not find user %s's top rated books".format(chosen_user_id))
-        else:
-            print("User %s's top rated books:".format(chosen_user_id))
+        try:
+            chosen_user_id = int(chosen_user_id)
+        except ValueError:
+            print('Not a valid user_id. Returning to the menu.')
+            return
+
+        # Attempt to retrieve the user's top rated books, a page at a time
+        cursor = None
+        page = 0
+        while True:
+            (rows, cursor) = fetch_users_top_rated_page(chosen_user_id, cursor)
+            page += 1
+            # If there are no books, let the user know. Otherwise, display
+            # the results.
+            if not rows:
+                if page == 1:
+                    print("Could not find user {}'s top rated books".format(
+                        chosen_user_id))
+                break
+            # Show how each book is rated overall, next to the user's rating
+            averages = fetch_average_ratings([row[0] for row in rows])
+            print("User {}'s top rated books (page {}):".format(
+                chosen_user_id, page))
             for row in rows:
                 (isbn_10, rating) = (row) 
-                print('    ', isbn_10, rating)
-
-
+                print('    ', isbn_10, rating, format_average_rating(
+                    averages.get(isbn_10, (0, None))))
+            if not ask_next_page(cursor):
+                break
+
+
+# The highest rated books published in a range of years, a page at a time: 
+# the next page seeks past the (avg_rating, isbn_10) of the last book shown 
+# (see pagination.py). The average is computed from the rollup, so the books
+# published in the range are still read and sorted for every page, but only 
+# one page of them is returned. The average is rounded to 4 places, both as 
+# shown and as sorted and sought on, so the cursor holds exactly the value 
+# the seek compares (books with the same rounded average tie, and are 
+# ordered by isbn_10).
+TOP_RATED_IN_TIMEFRAME_PAGE_SQL = """
+    SELECT y.isbn_10, b.orig_title, 
+        ROUND(y.total_stars / y.num_ratings, 4) AS avg_rating, y.num_ratings
+    FROM mv_year_book_stats AS y JOIN books AS b ON b.isbn_10 = y.isbn_10
+    WHERE y.orig_publication_yr BETWEEN %s AND %s
+        AND y.num_ratings >= %s{seek}
+    ORDER BY avg_rating DESC, y.isbn_10
+    LIMIT %s"""
+TOP_RATED_IN_TIMEFRAME_FIRST_PAGE_SQL = TOP_RATED_IN_TIMEFRAME_PAGE_SQL.format(
+    seek='')
+TOP_RATED_IN_TIMEFRAME_NEXT_PAGE_SQL = TOP_RATED_IN_TIMEFRAME_PAGE_SQL.format(
+    seek="""
+        AND (ROUND(y.total_stars / y.num_ratings, 4) 
+                < CAST(%s AS DECIMAL(14, 4))
+            OR (ROUND(y.total_stars / y.num_ratings, 4) 
+                = CAST(%s AS DECIMAL(14, 4))
+                AND y.isbn_10 > %s))""")
+
+
+def fetch_top_rated_in_timeframe_page(start_year, end_year, cursor=None,
+        min_ratings=TOP_RATED_MIN_RATINGS, limit=TOP_RATED_LIMIT):
+    """
+    Returns (rows, next_cursor) for a page of up to limit (isbn_10, 
+    orig_title, avg_rating, num_ratings) rows of the highest rated books 
+    originally published between start_year and end_year (inclusive) with at
+    least min_ratings ratings, best first. Reads the publication-year keyed 
+    rollup mv_year_book_stats, so only the books published in the range are
+    read, however many ratings they have. cursor is the next_cursor of the 
+    previous page (None for the first page); next_cursor is None on the last
+    page. Raises CursorError for an invalid cursor.
+    """
+    filters = (int(start_year), int(end_year), int(min_ratings))
+    if cursor is None:
+        (sql, params) = (TOP_RATED_IN_TIMEFRAME_FIRST_PAGE_SQL, 
+            filters + (limit + 1,))
+    else:
+        (avg_rating, isbn_10) = decode_cursor(cursor, 'top_rated', filters,
+            (str, str))
+        (sql, params) = (TOP_RATED_IN_TIMEFRAME_NEXT_PAGE_SQL, 
+            filters + (avg_rating, avg_rating, isbn_10, limit + 1))
+    rows = execute_sql_query(sql, ("An error occurred, could not retrieve top "
+        "rated books in specified timeframe."), params)
+    return split_page(rows, limit, 'top_rated', filters, 
+        lambda row: (row[2], row[0]))
+
+
+@instrumented('top_rated_in_timeframe')
 def get_top_rated_in_timeframe():
     """
     Admin users may also view top-rated books within a specific timeframe to 
@@ -477,32 +1198,89 @@ def get_top_rated_in_timeframe():
 
     # If yes, prompt the user for start and end years
     if ans and ans.lower()[0] == 'y':
-        start_year = input('What is the starting year (inclusive)?')
-        end_year = input('What is the ending year (inclusive)?')
-
-    # If the user has entered start and end years, create the SQL query
-    if start_year and end_year:
-        sql = """
-            SELECT isbn_10, AVG(rating) AS avg_rating
-            FROM ratings NATURAL JOIN books
-            WHERE publication_year > %s AND publication_year < %s
-            GROUP BY isbn_10
-            ORDER BY avg_rating DESC;""" % (start_year, end_year)
-    
-        # Attempt to retrieve the user's top rated books
-        rows = execute_sql_query(sql, ("An error occurred, could not retrieve " 
-            "top rated books in specified timeframe."))
-    
-        # If there are no books, let the user know. Otherwise, display
-        # the results.
-        if not rows:
-            print(("Could not find top rated books between %s "
-                "and %s").format(start_year, end_year))
-        else:
-            print("Top rated books %s to %s:".format(start_year, end_year))
+        try:
+            start_year = int(input('What is the starting year (inclusive)? '))
+            end_year = int(input('What is the ending year (inclusive)? '))
+        except ValueError:
+            print('Not a valid year. Returning to the menu.')
+            return
+
+    # If the user has entered start and end years, display the top rated
+    # books, a page at a time
+    if start_year is not None and end_year is not None:
+        cursor = None
+        page = 0
+        while True:
+            (rows, cursor) = fetch_top_rated_in_timeframe_page(start_year, 
+                end_year, cursor)
+            page += 1
+            # If there are no books, let the user know.
+            if not rows:
+                if page == 1:
+                    print(("Could not find top rated books between {} "
+                        "and {}").format(start_year, end_year))
+                break
+            print(("Top rated books {} to {} (with at least {} "
+                "ratings, page {}):").format(start_year, end_year, 
+                TOP_RATED_MIN_RATINGS, page))
             for row in rows:
-                (isbn_10, avg_rating) = (row) 
-                print('    ', isbn_10, avg_rating)
+                (isbn_10, orig_title, avg_rating, num_ratings) = (row) 
+                print('    ', isbn_10, orig_title, round(avg_rating, 2), 
+                    num_ratings)
+            if not ask_next_page(cursor):
+                break
+
+
+def insert_book(isbn_10, title, year, lang, authors):
+    """
+    Adds a book and its authors to the catalog in one transaction, and to the
+    autocomplete index. Returns True if the book was added.
+    """
+    commands = [("""
+        INSERT INTO books(isbn_10, orig_title, orig_publication_yr, 
+            language_code)
+        VALUES (%s, %s, %s, %s)""", (isbn_10, title, year, lang))]
+    for author in authors:
+        commands.append((
+            "INSERT INTO authors(isbn_10, author) VALUES (%s, %s)", 
+            (isbn_10, author)))
+
+    if not execute_sql_commands(commands, 
+            'An error occurred, could not add book.'):
+        return False
+    # Keep the autocomplete index up to date without reloading it
+    if autocomplete_index is not None:
+        autocomplete_index.add(isbn_10, title, TITLE)
+        for author in authors:
+            autocomplete_index.add(isbn_10, author, AUTHOR)
+    return True
+
+
+@instrumented('add_book')
+def add_book():
+    """
+    Admin users can add a new book to the catalog, along with its authors.
+    The book becomes searchable by title and author straight away.
+    """
+    isbn_10 = input('What is the isbn_10 of the new book? ').strip().upper()
+    title = input('What is the original title of the book? ').strip()
+    year = input('In which year was the book originally published? ').strip()
+    lang = input('What is the book\'s language code (e.g. eng)? ').strip()
+    authors = input('Who are the book\'s authors (separated by commas)? ')
+    authors = [author.strip() for author in authors.split(',') 
+        if author.strip()]
+
+    if not (ISBN_10_RE.match(isbn_10) and title and lang):
+        print('Invalid book information. Returning to the menu.')
+        return
+    try:
+        year = int(year) if year else None
+    except ValueError:
+        print('Not a valid year. Returning to the menu.')
+        return
+
+    if insert_book(isbn_10, title, year, lang, authors):
+        print('Added {} [{}].'.format(title, isbn_10))
 
 
 # ----------------------------------------------------------------------
@@ -515,17 +1293,44 @@ def sign_up():
     username = input('Please enter your new username (<= 20 characters): ')
     password = input('Please enter your new password (<= 20 characters): ')
 
-    # If the user has entered a username and password, add them 
+    # If the user has entered a username and password, add them as a reader
     if username and password:
-        sql = """
-            CALL sp_add_user(%s, %s);
-            """ % (username, password)
-    
-    # Attempt to execute the SQL procedure
+        # Attempt to execute the SQL procedure
+        add_user(username, password)
+
+
+# A user's role, if their password is right
+LOGIN_SQL = """
+    SELECT user_role
+    FROM user_info
+    WHERE username = %s 
+        AND password_hash = SHA2(CONCAT(salt, %s), 256)"""
+
+
+def check_login(username, password):
+    """
+    Returns the role ('reader' or 'retailer') of the user if the username and
+    password are valid, and None otherwise.
+    """
+    # The password is checked against the user's salted hash in the same
+    # primary key lookup which reads their role, so logging in is one probe
+    # of user_info and one round trip (see also authenticate() in 
+    # setup-passwords.sql).
+    rows = execute_sql_query(LOGIN_SQL, "An error occurred, could not login.", 
+        (username, password))
+    return rows[0][0] if rows else None
+
+
+def add_user(username, password):
+    """
+    Creates a reader account.
+    """
+    sql = "CALL sp_add_user(%s, %s, 'reader')"
     execute_sql_command(sql, ("An error occurred, could not add user to "
-        "database."))
+        "database."), (username, password))
 
 
+@instrumented('login')
 def authenticate_login():
     """
     Ask for a user's login information, and verify whether their login
@@ -555,30 +1360,13 @@ def authenticate_login():
 
     # If the user has entered login info, create the SQL command
     if username and password:
-        sql = "SELECT authenticate('%s', '%s');" % (username, password)
-    
         # Attempt to authenticate this user
-        authenticated = execute_sql_query(sql, ("An error occurred, could not "
-            "login."))
-
-        row = authenticated[0]
-        is_authenticated = row[0]
-
-        if is_authenticated == 1:
+        role = check_login(username, password)
+        if role:
             print('Login successful!')
-            
-            # Get role of user 
-            sql = """
-                SELECT user_role
-                FROM user_info
-                WHERE username = '%s'""" % (username)
-
-            rows = execute_sql_query(sql, 
-                "An error occured, could not get user role.")
-
-            role = rows[0][0]
         else:
             print('Login failed. Please try again.')
+            role = ''
             
         return role
 
@@ -597,6 +1385,7 @@ def show_options():
     while ans != 'q':
         print('What would you like to do? ')
         print('  (s) - search for books by genre, language, and year')
+        print('  (f) - search for books by title, author, or description')
         print('  (r) - add a rating for a book')
         print('  (t) - add a book to your to-read shelf')
         print('  (p) - view information on books by popular series authors')
@@ -609,6 +1398,8 @@ def show_options():
             quit_ui()
         elif ans == 's':
             search_for_books()
+        elif ans == 'f':
+            full_text_search()
         elif ans == 'r':
             add_rating()
         elif ans == 't':
@@ -632,6 +1423,7 @@ def show_admin_options():
     print('What would you like to do? ')
     print('  (utr) - get a user\'s top rated')
     print('  (trt) - get top rated books in a specific timeframe')
+    print('  (ab) - add a book to the catalog')
     print('  (q) - quit')
     print()
     ans = input('Enter an option: ').lower()
@@ -641,12 +1433,16 @@ def show_admin_options():
         get_users_top_rated()
     elif ans == 'trt':
         get_top_rated_in_timeframe()
+    elif ans == 'ab':
+        add_book()
 
 
 def quit_ui():
     """
     Quits the program, printing a good bye message to the user.
     """
+    if METRICS_FILE:
+        instruments.write_json(METRICS_FILE)
     print('Good bye!')
     exit()
 
@@ -664,19 +1460,61 @@ def main():
         elif ans and ans.lower()[0] == 'y':
             role = authenticate_login()
 
-            # Depending on whether the user is admin or not, show options
+            # Depending on whether the user is admin or not, show options.
+            # The signed-in user's session keeps one pooled connection for
+            # all of their menu operations.
             if role == 'reader':
-                show_options()
+                with pool.session():
+                    show_options()
             elif role == 'retailer':
-                show_admin_options()
+                with pool.session():
+                    show_admin_options()
             else:
                 ans = 'n'
         else:
             print('Invalid input. Press n to quit.')
 
+# Globals shared by the functions above, set up by init_app
+pool = None
+result_cache = None
+instruments = None
+description_index = None
+autocomplete_index = None
+
+
+def init_app(use_result_cache=True, load_indexes=True):
+    """
+    Sets up the globals every operation uses: the connection pool, the query
+    result cache and the in-memory indexes. Call this once before using the
+    functions above from another program (e.g. benchmark.py). With 
+    use_result_cache=False nothing is cached, so every query reaches MySQL;
+    with load_indexes=False the autocomplete and description indexes are not
+    loaded.
+    """
+    global pool, result_cache, instruments, description_index
+    global autocomplete_index
+    # The query result cache is also global, shared by every query run with
+    # cache=True. A cache with no room for entries caches nothing.
+    result_cache = ResultCache(RESULT_CACHE_SIZE if use_result_cache else 0,
+        RESULT_CACHE_TTL, RESULT_CACHE_MAX_ROWS)
+    # Statement and operation metrics, also global
+    instruments = Metrics(SLOW_QUERY_SECONDS, 
+        open(SLOW_QUERY_LOG, 'a') if SLOW_QUERY_LOG else None,
+        PROFILE_OPERATION)
+    # This pool is a global object that other functions can access.
+    # Use `with pool.connection() as conn:` to check out a connection each
+    # time you are about to execute a query with cursor.execute(<sqlquery>)
+    pool = get_pool()
+    if load_indexes:
+        description_index = load_description_index()
+        autocomplete_index = load_autocomplete_index()
+
+
 if __name__ == '__main__':
-    # This conn is a global object that other functinos can access.
-    # You'll need to use cursor = conn.cursor() each time you are
-    # about to execute a query with cursor.execute(<sqlquery>)
-    conn = get_conn()
+    # With arguments, run them as commands (see commands.py) instead of
+    # showing the menus
+    if len(sys.argv) > 1:
+        import commands
+        sys.exit(commands.main(sys.argv[1:]))
+    init_app()
     main()
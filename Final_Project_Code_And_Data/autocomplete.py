@@ -0,0 +1,189 @@
+"""
+In-memory autocomplete index over book titles and authors.
+
+Resolves partial or misspelled input such as "harry pot", "the hobit" or
+"hunger gmes" to candidate books without a round trip to MySQL:
+- prefix matches: every word of the input is a prefix of some word of the
+  title/author, found by binary search in a sorted word list;
+- typo-tolerant matches: titles/authors sharing enough character trigrams
+  with the input, found through a trigram inverted index.
+
+The index is built once at startup (see load_autocomplete_index in app.py)
+and updated incrementally with add() when books are added.
+"""
+
+import bisect
+import re
+from collections import Counter
+
+# Minimum trigram similarity for a typo-tolerant match
+MIN_SIMILARITY = 0.3
+# Kinds of entries in the index
+TITLE = 'title'
+AUTHOR = 'author'
+
+WORD_RE = re.compile(r'[a-z0-9]+')
+
+
+def normalize(text):
+    """
+    Lowercases text and reduces it to its words separated by single spaces.
+    """
+    return ' '.join(WORD_RE.findall(text.lower()))
+
+
+def trigrams(text):
+    """
+    Returns the set of character trigrams of normalized text, padded so that
+    word beginnings and endings count.
+    """
+    padded = '  ' + text + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class AutocompleteIndex:
+    """
+    Prefix and trigram index from title/author text to isbn_10s.
+    """
+
+    def __init__(self):
+        # Entry id -> (isbn_10, text, kind)
+        self._entries = []
+        # isbn_10 -> title, for displaying books matched by author
+        self._titles = {}
+        # Entry id -> number of distinct trigrams in its text
+        self._num_trigrams = []
+        # Sorted list of (word, entry id) for every word of every entry
+        self._words = []
+        # Trigram -> list of entry ids whose text contains it
+        self._trigrams = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, isbn_10, text, kind):
+        """
+        Adds a title or author (kind is TITLE or AUTHOR) for a book.
+        """
+        normalized = normalize(text)
+        if not normalized:
+            return
+        entry_id = len(self._entries)
+        self._entries.append((isbn_10, text, kind))
+        if kind == TITLE:
+            self._titles[isbn_10] = text
+
+        for word in set(normalized.split()):
+            bisect.insort(self._words, (word, entry_id))
+
+        grams = trigrams(normalized)
+        self._num_trigrams.append(len(grams))
+        for gram in grams:
+            self._trigrams.setdefault(gram, []).append(entry_id)
+
+    def add_many(self, rows, kind):
+        """
+        Adds (isbn_10, text) rows of one kind at once. Much faster than
+        calling add() repeatedly when building the index from scratch.
+        """
+        new_words = []
+        for (isbn_10, text) in rows:
+            normalized = normalize(text)
+            if not normalized:
+                continue
+            entry_id = len(self._entries)
+            self._entries.append((isbn_10, text, kind))
+            if kind == TITLE:
+                self._titles[isbn_10] = text
+            new_words.extend((word, entry_id)
+                             for word in set(normalized.split()))
+            grams = trigrams(normalized)
+            self._num_trigrams.append(len(grams))
+            for gram in grams:
+                self._trigrams.setdefault(gram, []).append(entry_id)
+        self._words.extend(new_words)
+        self._words.sort()
+
+    def _prefix_entries(self, prefix):
+        """
+        Returns the set of entry ids with a word starting with prefix.
+        """
+        start = bisect.bisect_left(self._words, (prefix,))
+        entries = set()
+        for (word, entry_id) in self._words[start:]:
+            if not word.startswith(prefix):
+                break
+            entries.add(entry_id)
+        return entries
+
+    def _prefix_matches(self, query_words):
+        """
+        Returns the set of entry ids in which every query word is a prefix of
+        some word.
+        """
+        matches = None
+        # Start from the longest (most selective) word
+        for word in sorted(query_words, key=len, reverse=True):
+            entries = self._prefix_entries(word)
+            matches = entries if matches is None else matches & entries
+            if not matches:
+                break
+        return matches or set()
+
+    def _fuzzy_matches(self, normalized):
+        """
+        Returns a dictionary from entry id to trigram similarity for entries
+        at least MIN_SIMILARITY similar to the query. The similarity averages
+        the fraction of the query's trigrams found in the entry (so a 
+        misspelled surname still matches a full name) and the Jaccard 
+        similarity of the two trigram sets (so closer overall matches rank
+        first).
+        """
+        grams = trigrams(normalized)
+        overlap = Counter()
+        for gram in grams:
+            overlap.update(self._trigrams.get(gram, ()))
+        matches = {}
+        for (entry_id, shared) in overlap.items():
+            containment = shared / float(len(grams))
+            jaccard = shared / float(len(grams) + self._num_trigrams[entry_id]
+                                     - shared)
+            similarity = (containment + jaccard) / 2
+            if similarity >= MIN_SIMILARITY:
+                matches[entry_id] = similarity
+        return matches
+
+    def lookup(self, text, limit=10):
+        """
+        Returns up to limit (isbn_10, title, matched_text, score) candidates
+        for the given partial or misspelled title/author, best first, with at
+        most one candidate per book. matched_text is the title or author name
+        which matched. Prefix matches score above 1 and always rank ahead of
+        typo-tolerant matches, which score between 0 and 1.
+        """
+        normalized = normalize(text)
+        if not normalized:
+            return []
+
+        scores = {}
+        for entry_id in self._prefix_matches(normalized.split()):
+            # Prefer shorter texts, i.e. where the query covers more of it
+            entry_text = normalize(self._entries[entry_id][1])
+            scores[entry_id] = 1.0 + len(normalized) / float(len(entry_text))
+        if len(scores) < limit:
+            for (entry_id, similarity) in self._fuzzy_matches(
+                    normalized).items():
+                scores.setdefault(entry_id, similarity)
+
+        results = []
+        seen = set()
+        for entry_id in sorted(scores, key=lambda e: (-scores[e], e)):
+            (isbn_10, entry_text, kind) = self._entries[entry_id]
+            if isbn_10 in seen:
+                continue
+            seen.add(isbn_10)
+            results.append((isbn_10, self._titles.get(isbn_10, ''),
+                            entry_text, scores[entry_id]))
+            if len(results) == limit:
+                break
+        return results
@@ -0,0 +1,655 @@
+"""
+Benchmarks for the books database.
+
+Usage:
+    python3 benchmark.py indexes [--repeat N]
+    python3 benchmark.py fulltext [--repeat N] [TERMS ...]
+    python3 benchmark.py mv-maintenance [--repeat N] [--user-id ID]
+                                        [--remap OLD_ISBN NEW_ISBN]
+    python3 benchmark.py ops [--repeat N] [--seed S] [--cache]
+                             [--operations NAME,...] [--no-queries]
+                             [--out FILE] [--compare FILE] [--threshold T]
+    python3 benchmark.py synth --ratings N [--to-read N] [--seed S]
+    python3 benchmark.py synth-clean
+
+indexes
+    Runs every query in queries.sql with the secondary indexes from setup.sql
+    made invisible to the optimizer ("before") and then visible again
+    ("after"), and prints the median latency of each query in both cases.
+    Invisible indexes are still maintained, so no index has to be dropped
+    and rebuilt (and the foreign keys which rely on them keep working).
+
+fulltext
+    Compares keyword search with the full-text indexes (the query behind the
+    (f) option in app.py) against the equivalent LIKE '%...%' search over
+    titles, authors and descriptions, for each search term.
+
+mv-maintenance
+    Compares the per-row ratings triggers against the set-based maintenance
+    procedures in setup-routines.sql for purging a user's ratings (by
+    default the user with the most ratings) and for remapping one isbn_10
+    to another (by default the most rated book to the second most rated),
+    and times a full sp_rebuild_book_stats. Every run is rolled back, and
+    the first run of each method is checked with sp_verify_book_stats.
+
+ops
+    Drives every operation of app.py without prompts (see workload.py) and
+    every query in queries.sql, repeat times each with reproducible random
+    parameters, and reports latency percentiles and rows/second. Results
+    can be saved as JSON with --out, and compared against a saved run with
+    --compare, which exits with status 1 if any operation's median latency
+    grew by more than the threshold (default 20%). The query result cache
+    is off unless --cache is given, so every operation reaches MySQL.
+
+synth, synth-clean
+    Adds (about) N synthetic ratings and to_read rows, from synthetic users
+    with Zipf-like book popularity, to measure the operations at larger
+    data scales; synth-clean removes them again. Both rebuild the book
+    stats afterwards.
+
+Run against a loaded booksdb (see README.md); the numbers are only
+meaningful at a realistic ratings volume, so the table sizes are printed
+with the results.
+"""
+
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+
+import mysql.connector
+
+import app
+import workload
+from app import FULL_TEXT_SEARCH_SQL, SEARCH_LIMIT
+from db_pool import DB_CONFIG
+from ingest_ratings import ingest_ratings
+from metrics import percentile
+from sql_scripts import read_workload, secondary_indexes
+
+# Tables whose sizes are reported alongside the results
+TABLES = ['books', 'authors', 'genres', 'book_details', 'ratings', 'to_read']
+
+# Default search terms for the full-text benchmark
+SEARCH_TERMS = ['Harry Potter', 'Tolkien', 'dragon', 'civil war', 'love']
+
+# The LIKE-based search which full-text search replaces
+LIKE_SEARCH_SQL = """
+    SELECT DISTINCT b.isbn_10, b.orig_title, b.orig_publication_yr
+    FROM books AS b 
+        LEFT JOIN authors AS a ON a.isbn_10 = b.isbn_10
+        LEFT JOIN book_details AS d ON d.isbn_10 = b.isbn_10
+    WHERE b.orig_title LIKE %s OR a.author LIKE %s 
+        OR d.book_description LIKE %s
+    LIMIT %s"""
+
+
+# ----------------------------------------------------------------------
+# Timing Helpers
+# ----------------------------------------------------------------------
+def time_statement(cursor, sql, params=(), repeat=5):
+    """
+    Executes a statement repeat times, fetching all of its rows, and returns
+    the list of latencies in seconds.
+    """
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cursor.execute(sql, params)
+        if cursor.with_rows:
+            cursor.fetchall()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def summarize(latencies):
+    """
+    Returns a dictionary of summary statistics (in milliseconds) for a list of
+    latencies in seconds.
+    """
+    return {
+        'runs': len(latencies),
+        'min_ms': min(latencies) * 1000,
+        'median_ms': statistics.median(latencies) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies) * 1000,
+    }
+
+
+def table_sizes(cursor):
+    """
+    Returns a dictionary of exact row counts for the application's tables.
+    """
+    sizes = {}
+    for table in TABLES:
+        cursor.execute('SELECT COUNT(*) FROM %s' % table)
+        sizes[table] = cursor.fetchone()[0]
+    return sizes
+
+
+# ----------------------------------------------------------------------
+# Index Benchmark
+# ----------------------------------------------------------------------
+def set_index_visibility(cursor, indexes, visible):
+    """
+    Makes each (index_name, table_name, kind) index visible or invisible to
+    the optimizer.
+    """
+    for (name, table, _) in indexes:
+        cursor.execute('ALTER TABLE %s ALTER INDEX %s %s'
+                       % (table, name, 'VISIBLE' if visible else 'INVISIBLE'))
+
+
+def run_workload(cursor, workload, repeat):
+    """
+    Times every (label, sql) statement in the workload, returning a
+    dictionary from label to summary statistics.
+    """
+    results = {}
+    for (label, sql) in workload:
+        # One untimed run to warm the buffer pool
+        time_statement(cursor, sql, repeat=1)
+        results[label] = summarize(time_statement(cursor, sql, repeat=repeat))
+    return results
+
+
+def benchmark_indexes(conn, repeat):
+    """
+    Runs the queries.sql workload without and with the secondary indexes and
+    prints a before/after comparison.
+    """
+    cursor = conn.cursor()
+    workload = read_workload('queries.sql')
+    indexes = [index for index in secondary_indexes('setup.sql')
+               if index[2] != 'FULLTEXT']
+
+    print('Table sizes:', ', '.join('%s=%d' % item
+                                    for item in table_sizes(cursor).items()))
+    print('Secondary indexes:', ', '.join(name for (name, _, _) in indexes))
+
+    try:
+        set_index_visibility(cursor, indexes, False)
+        before = run_workload(cursor, workload, repeat)
+    finally:
+        set_index_visibility(cursor, indexes, True)
+    after = run_workload(cursor, workload, repeat)
+
+    print()
+    print('%-10s %14s %14s %9s' % ('query', 'before (ms)', 'after (ms)',
+                                    'speedup'))
+    for (label, _) in workload:
+        b = before[label]['median_ms']
+        a = after[label]['median_ms']
+        print('%-10s %14.2f %14.2f %8.1fx' % (label, b, a,
+                                              b / a if a else float('inf')))
+    total_before = sum(r['median_ms'] for r in before.values())
+    total_after = sum(r['median_ms'] for r in after.values())
+    print('%-10s %14.2f %14.2f %8.1fx' % (
+        'total', total_before, total_after,
+        total_before / total_after if total_after else float('inf')))
+    cursor.close()
+
+
+# ----------------------------------------------------------------------
+# Full-Text Search Benchmark
+# ----------------------------------------------------------------------
+def benchmark_fulltext(conn, terms, repeat):
+    """
+    Prints the median latency of LIKE and full-text searches for each term.
+    """
+    cursor = conn.cursor()
+    print('%-16s %12s %12s %9s' % ('terms', 'LIKE (ms)', 'MATCH (ms)',
+                                    'speedup'))
+    for term in terms:
+        pattern = '%' + term + '%'
+        like = time_statement(cursor, LIKE_SEARCH_SQL,
+                              (pattern, pattern, pattern, SEARCH_LIMIT),
+                              repeat)
+        match = time_statement(cursor, FULL_TEXT_SEARCH_SQL,
+                               (term,) * 6 + (SEARCH_LIMIT,), repeat)
+        l = summarize(like)['median_ms']
+        m = summarize(match)['median_ms']
+        print('%-16s %12.2f %12.2f %8.1fx' % (term[:16], l, m,
+                                              l / m if m else float('inf')))
+    cursor.close()
+
+
+# ----------------------------------------------------------------------
+# Materialized Stats Maintenance Benchmark
+# ----------------------------------------------------------------------
+# Per-row (trigger) and set-based versions of each maintenance operation
+MAINTENANCE_OPERATIONS = [
+    ('delete user', [
+        'DELETE FROM ratings WHERE user_id = %(user_id)s',
+    ], [
+        'CALL sp_delete_user_ratings(%(user_id)s)',
+    ]),
+    ('remap isbn', [
+        'DELETE old_r FROM ratings AS old_r '
+        'JOIN ratings AS new_r ON new_r.user_id = old_r.user_id '
+        'AND new_r.isbn_10 = %(new_isbn)s '
+        'WHERE old_r.isbn_10 = %(old_isbn)s',
+        'UPDATE ratings SET isbn_10 = %(new_isbn)s '
+        'WHERE isbn_10 = %(old_isbn)s',
+    ], [
+        'CALL sp_remap_isbn(%(old_isbn)s, %(new_isbn)s)',
+    ]),
+]
+
+
+def count_stats_mismatches(cursor):
+    """
+    Returns the number of rows reported by sp_verify_book_stats (0 if the
+    materialized stats match the ratings table).
+    """
+    cursor.callproc('sp_verify_book_stats')
+    return sum(len(result.fetchall()) for result in cursor.stored_results())
+
+
+def time_maintenance(conn, statements, params, repeat, verify=True):
+    """
+    Times executing the statements as one transaction, which is rolled back
+    after every run. Returns (latencies, mismatches), where mismatches is the
+    sp_verify_book_stats row count after the first run (None if verify is
+    false).
+    """
+    cursor = conn.cursor()
+    latencies = []
+    mismatches = None
+    for run in range(repeat):
+        conn.rollback()
+        conn.start_transaction()
+        try:
+            start = time.perf_counter()
+            for sql in statements:
+                cursor.execute(sql, params)
+            latencies.append(time.perf_counter() - start)
+            if verify and run == 0:
+                mismatches = count_stats_mismatches(cursor)
+        finally:
+            conn.rollback()
+    cursor.close()
+    return (latencies, mismatches)
+
+
+def default_maintenance_params(cursor):
+    """
+    Returns the user with the most ratings and the two most rated books, as
+    parameters for MAINTENANCE_OPERATIONS.
+    """
+    cursor.execute('SELECT user_id, COUNT(*) FROM ratings '
+                   'GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1')
+    (user_id, _) = cursor.fetchone()
+    cursor.execute('SELECT isbn_10 FROM mv_book_stats '
+                   'ORDER BY num_ratings DESC, isbn_10 LIMIT 2')
+    (old_isbn, new_isbn) = [row[0] for row in cursor.fetchall()]
+    return {'user_id': user_id, 'old_isbn': old_isbn, 'new_isbn': new_isbn}
+
+
+def benchmark_mv_maintenance(conn, repeat, user_id=None, remap=None):
+    """
+    Prints the median latency of the per-row triggers and the set-based
+    procedures for each maintenance operation, whether the stats were still
+    correct afterwards, and the latency of a full rebuild.
+    """
+    cursor = conn.cursor()
+    params = default_maintenance_params(cursor)
+    if user_id is not None:
+        params['user_id'] = user_id
+    if remap is not None:
+        (params['old_isbn'], params['new_isbn']) = remap
+    cursor.execute('SELECT COUNT(*) FROM ratings WHERE user_id = %s',
+                   (params['user_id'],))
+    user_ratings = cursor.fetchone()[0]
+    cursor.execute('SELECT COUNT(*) FROM ratings WHERE isbn_10 = %s',
+                   (params['old_isbn'],))
+    isbn_ratings = cursor.fetchone()[0]
+    print('Table sizes:', ', '.join('%s=%d' % item
+                                    for item in table_sizes(cursor).items()))
+    cursor.close()
+    conn.rollback()
+
+    print('Deleting the %d ratings of user %s; remapping the %d ratings of '
+          '%s to %s' % (user_ratings, params['user_id'], isbn_ratings,
+                        params['old_isbn'], params['new_isbn']))
+    print()
+    print('%-12s %15s %15s %9s  %s' % ('operation', 'per-row (ms)',
+                                       'set-based (ms)', 'speedup',
+                                       'stats verified'))
+    for (label, per_row, set_based) in MAINTENANCE_OPERATIONS:
+        (row_latencies, row_bad) = time_maintenance(conn, per_row, params,
+                                                    repeat)
+        (set_latencies, set_bad) = time_maintenance(conn, set_based, params,
+                                                    repeat)
+        r = summarize(row_latencies)['median_ms']
+        b = summarize(set_latencies)['median_ms']
+        print('%-12s %15.2f %15.2f %8.1fx  %s' % (
+            label, r, b, r / b if b else float('inf'),
+            'per-row %s, set-based %s' % (
+                'ok' if row_bad == 0 else '%d mismatches' % row_bad,
+                'ok' if set_bad == 0 else '%d mismatches' % set_bad)))
+
+    (latencies, bad) = time_maintenance(
+        conn, ['CALL sp_rebuild_book_stats()'], {}, repeat)
+    print('%-12s %15s %15.2f %9s  %s' % (
+        'rebuild', '-', summarize(latencies)['median_ms'], '-',
+        'ok' if bad == 0 else '%d mismatches' % bad))
+
+
+# ----------------------------------------------------------------------
+# Application Operations Benchmark
+# ----------------------------------------------------------------------
+# Default maximum slowdown of an operation's median latency before --compare
+# reports a regression
+REGRESSION_THRESHOLD = 0.2
+# Rows inserted per transaction by synth
+SYNTH_CHUNK_SIZE = 10000
+# Synthetic users deleted per transaction by synth-clean
+SYNTH_CLEAN_USERS = 2000
+
+
+def time_operation(operation, repeat):
+    """
+    Calls operation() repeat times (after one untimed warm-up call), and
+    returns its summary statistics plus the rows it returned in total and
+    rows_per_second.
+    """
+    operation()
+    latencies = []
+    rows = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows += operation()
+        latencies.append(time.perf_counter() - start)
+    result = summarize(latencies)
+    result['rows'] = rows
+    result['rows_per_second'] = rows / sum(latencies) if sum(latencies) else 0.0
+    return result
+
+
+def query_operation(sql):
+    """
+    Returns an operation which runs a queries.sql statement on a pooled
+    connection and returns the number of rows.
+    """
+    def operation():
+        with app.pool.connection(read_only=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql)
+            rows = len(cursor.fetchall()) if cursor.with_rows else 0
+            cursor.close()
+        return rows
+    return operation
+
+
+def app_table_sizes():
+    """
+    Returns table_sizes, read through the application's pool.
+    """
+    return {table: app.execute_sql_query('SELECT COUNT(*) FROM %s' % table,
+                                         'Could not count rows.')[0][0]
+            for table in TABLES}
+
+
+def benchmark_operations(repeat, seed, names=None, queries=True):
+    """
+    Times each workload operation (all read operations, or those in names)
+    with parameters drawn from random.Random(seed), and the queries.sql
+    workload. Returns a dictionary from operation name to results.
+    """
+    data = workload.WorkloadData.load()
+    results = {}
+    for (name, operation) in workload.READ_OPERATIONS.items():
+        if names and name not in names:
+            continue
+        rng = random.Random('%s:%s' % (seed, name))
+        results[name] = time_operation(lambda: operation(data, rng), repeat)
+        print('%-28s %10.2f %10.2f %10.2f %12.0f' % (
+            name, results[name]['median_ms'], results[name]['p95_ms'],
+            results[name]['p99_ms'], results[name]['rows_per_second']))
+    if queries:
+        for (label, sql) in read_workload('queries.sql'):
+            name = 'queries.sql ' + label
+            results[name] = time_operation(query_operation(sql), repeat)
+            print('%-28s %10.2f %10.2f %10.2f %12.0f' % (
+                name, results[name]['median_ms'], results[name]['p95_ms'],
+                results[name]['p99_ms'], results[name]['rows_per_second']))
+    return results
+
+
+def compare_results(old, new, threshold=REGRESSION_THRESHOLD):
+    """
+    Prints the change in median latency of every operation in two saved
+    runs, and returns the names of the operations which slowed down by more
+    than threshold (a fraction).
+    """
+    print('%-28s %12s %12s %9s' % ('operation', 'old (ms)', 'new (ms)',
+                                   'change'))
+    regressions = []
+    for (name, result) in new['operations'].items():
+        if name not in old['operations']:
+            continue
+        before = old['operations'][name]['median_ms']
+        after = result['median_ms']
+        change = (after - before) / before if before else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-28s %12.2f %12.2f %+8.0f%%%s' % (name, before, after,
+                                                   change * 100, flag))
+    return regressions
+
+
+def run_ops_benchmark(args):
+    """
+    The ops subcommand. Returns the exit status.
+    """
+    app.RAISE_ERRORS = True
+    try:
+        app.init_app(use_result_cache=args.cache)
+    except mysql.connector.Error as err:
+        sys.stderr.write('Could not connect to the database: %s\n' % err)
+        return 1
+    sizes = app_table_sizes()
+    print('Table sizes:', ', '.join('%s=%d' % item for item in sizes.items()))
+    print()
+    print('%-28s %10s %10s %10s %12s' % ('operation', 'p50 (ms)', 'p95 (ms)',
+                                         'p99 (ms)', 'rows/s'))
+    names = set(args.operations.split(',')) if args.operations else None
+    run = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': {'repeat': args.repeat, 'seed': args.seed,
+                     'cache': args.cache},
+        'table_sizes': sizes,
+        'operations': benchmark_operations(args.repeat, args.seed, names,
+                                           not args.no_queries),
+    }
+    app.pool.close()
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(run, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print()
+        if old['table_sizes'] != sizes:
+            print('Note: the table sizes differ from the compared run.')
+        regressions = compare_results(old, run, args.threshold)
+        if regressions:
+            print('%d operations regressed: %s' % (len(regressions),
+                                                   ', '.join(regressions)))
+            return 1
+    return 0
+
+
+def insert_rows(conn, sql, rows, chunk_size=SYNTH_CHUNK_SIZE):
+    """
+    Inserts rows with executemany, committing every chunk_size rows.
+    Returns the number of rows inserted.
+    """
+    cursor = conn.cursor()
+    count = 0
+    rows = iter(rows)
+    while True:
+        chunk = [row for (_, row) in zip(range(chunk_size), rows)]
+        if not chunk:
+            break
+        cursor.executemany(sql, chunk)
+        conn.commit()
+        count += len(chunk)
+    cursor.close()
+    return count
+
+
+def clean_synthetic_data(conn):
+    """
+    Deletes every synthetic user's ratings and to_read rows, a block of
+    users per transaction, and rebuilds the book stats.
+    """
+    cursor = conn.cursor()
+    cursor.execute('SELECT MAX(user_id) FROM ratings')
+    max_ratings_user = cursor.fetchone()[0] or 0
+    cursor.execute('SELECT MAX(user_id) FROM to_read')
+    max_user = max(max_ratings_user, cursor.fetchone()[0] or 0)
+    cursor.execute('SET @skip_book_stats_triggers = 1')
+    try:
+        for start in range(workload.SYNTHETIC_USER_BASE, max_user + 1,
+                           SYNTH_CLEAN_USERS):
+            for table in ('ratings', 'to_read'):
+                cursor.execute('DELETE FROM %s WHERE user_id >= %%s '
+                               'AND user_id < %%s' % table,
+                               (start, start + SYNTH_CLEAN_USERS))
+            conn.commit()
+    finally:
+        cursor.execute('SET @skip_book_stats_triggers = NULL')
+    cursor.execute('CALL sp_rebuild_book_stats()')
+    conn.commit()
+    cursor.close()
+
+
+def add_synthetic_data(conn, num_ratings, num_to_read, seed):
+    """
+    Replaces any synthetic data with about num_ratings synthetic ratings and
+    num_to_read to_read rows, printing the insert rates.
+    """
+    clean_synthetic_data(conn)
+    cursor = conn.cursor()
+    cursor.execute('SELECT b.isbn_10 FROM books AS b '
+                   'LEFT JOIN mv_book_stats AS s ON s.isbn_10 = b.isbn_10 '
+                   'ORDER BY IFNULL(s.num_ratings, 0) DESC, b.isbn_10')
+    isbns = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+
+    result = ingest_ratings(conn, workload.synthetic_ratings(
+        isbns, num_ratings, seed=seed), SYNTH_CHUNK_SIZE,
+        bypass_triggers=True)
+    print('Inserted %d synthetic ratings (%.0f rows/s)'
+          % (result['rows'], result['rows_per_second']))
+
+    start = time.perf_counter()
+    count = insert_rows(conn, 'INSERT INTO to_read(user_id, isbn_10) '
+                        'VALUES (%s, %s)',
+                        workload.synthetic_to_read(isbns, num_to_read,
+                                                   seed=seed))
+    seconds = time.perf_counter() - start
+    print('Inserted %d synthetic to_read rows (%.0f rows/s)'
+          % (count, count / seconds if seconds else 0.0))
+
+
+# ----------------------------------------------------------------------
+# Command-Line Functionality
+# ----------------------------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    indexes_parser = subparsers.add_parser('indexes',
+        help='compare queries.sql latency without and with indexes')
+    indexes_parser.add_argument('--repeat', type=int, default=5,
+        help='timed runs per query (default: 5)')
+
+    fulltext_parser = subparsers.add_parser('fulltext',
+        help='compare full-text search latency against LIKE')
+    fulltext_parser.add_argument('terms', nargs='*', default=SEARCH_TERMS,
+        help='search terms (default: %s)' % ', '.join(SEARCH_TERMS))
+    fulltext_parser.add_argument('--repeat', type=int, default=5,
+        help='timed runs per search (default: 5)')
+
+    mv_parser = subparsers.add_parser('mv-maintenance',
+        help='compare per-row and set-based book stats maintenance')
+    mv_parser.add_argument('--repeat', type=int, default=3,
+        help='timed runs per operation (default: 3)')
+    mv_parser.add_argument('--user-id', type=int,
+        help='user whose ratings are deleted (default: the most active)')
+    mv_parser.add_argument('--remap', nargs=2,
+        metavar=('OLD_ISBN', 'NEW_ISBN'),
+        help='isbn_10s to remap (default: the two most rated books)')
+
+    ops_parser = subparsers.add_parser('ops',
+        help='time every app.py operation and queries.sql query')
+    ops_parser.add_argument('--repeat', type=int, default=20,
+        help='timed runs per operation (default: 20)')
+    ops_parser.add_argument('--seed', type=int, default=0,
+        help='seed for the operation parameters (default: 0)')
+    ops_parser.add_argument('--cache', action='store_true',
+        help='use the query result cache')
+    ops_parser.add_argument('--operations',
+        help='comma-separated operations to run (default: all); one of %s'
+             % ', '.join(workload.READ_OPERATIONS))
+    ops_parser.add_argument('--no-queries', action='store_true',
+        help='skip the queries.sql workload')
+    ops_parser.add_argument('--out', help='save the results as JSON')
+    ops_parser.add_argument('--compare',
+        help='compare against results saved with --out')
+    ops_parser.add_argument('--threshold', type=float,
+        default=REGRESSION_THRESHOLD,
+        help='slowdown counted as a regression (default: %.1f)'
+             % REGRESSION_THRESHOLD)
+
+    synth_parser = subparsers.add_parser('synth',
+        help='add synthetic ratings and to_read rows')
+    synth_parser.add_argument('--ratings', type=int, required=True,
+        help='(approximate) number of synthetic ratings')
+    synth_parser.add_argument('--to-read', type=int, default=0,
+        help='(approximate) number of synthetic to_read rows (default: 0)')
+    synth_parser.add_argument('--seed', type=int, default=0)
+
+    subparsers.add_parser('synth-clean',
+        help='remove the synthetic ratings and to_read rows')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'ops':
+        return run_ops_benchmark(args)
+
+    try:
+        conn = mysql.connector.connect(**DB_CONFIG)
+    except mysql.connector.Error as err:
+        sys.stderr.write('Could not connect to the database: %s\n' % err)
+        return 1
+
+    try:
+        if args.command == 'indexes':
+            benchmark_indexes(conn, args.repeat)
+        elif args.command == 'fulltext':
+            benchmark_fulltext(conn, args.terms, args.repeat)
+        elif args.command == 'mv-maintenance':
+            benchmark_mv_maintenance(conn, args.repeat, args.user_id,
+                                     args.remap)
+        elif args.command == 'synth':
+            add_synthetic_data(conn, args.ratings, args.to_read, args.seed)
+        elif args.command == 'synth-clean':
+            clean_synthetic_data(conn)
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,286 @@
+"""
+Offline builder for the book_neighbors table (see setup-routines.sql).
+
+Loads the ratings table into a sparse user x book matrix, computes the
+adjusted cosine similarity between every pair of books (each user's ratings
+are centered on that user's mean rating, so generous and harsh raters are
+comparable), and stores the top-k most similar books for each book.
+
+Usage:
+    python3 build_book_neighbors.py [--k 20] [--incremental]
+                                    [--snapshot DIR]
+
+With --incremental, only the books listed in book_neighbors_stale (books
+whose ratings changed since the last build) are recomputed, together with
+the books whose neighbor lists include one of them.
+
+With --snapshot, ratings are read from a snapshot written by snapshot.py
+instead of from the database (the results are still written there).
+
+Requires NumPy and SciPy (pip install numpy scipy).
+"""
+
+import argparse
+import sys
+import time
+
+import mysql.connector
+import numpy as np
+import scipy.sparse as sp
+
+from db_pool import DB_CONFIG
+from snapshot import Snapshot, export_table
+
+# Number of books whose similarities are computed at once. Each block needs a
+# dense block_size x num_books array of floats.
+BLOCK_SIZE = 256
+
+
+# ----------------------------------------------------------------------
+# Loading Ratings
+# ----------------------------------------------------------------------
+def load_ratings(conn):
+    """
+    Streams the ratings table into compact arrays. Returns a tuple
+    (user_ids, book_codes, ratings, isbns), where book_codes index into the
+    list isbns.
+    """
+    isbns = []
+    (user_ids, book_codes, ratings) = export_table(
+        conn, 'SELECT user_id, isbn_10, rating FROM ratings', {}, isbns, True)
+    return (user_ids, book_codes, ratings, isbns)
+
+
+def build_item_matrix(user_ids, book_codes, ratings, num_books):
+    """
+    Returns a CSC sparse matrix with one row per user and one column per
+    book, holding mean-centered ratings, with every column scaled to unit
+    length. The dot product of two columns is then the adjusted cosine
+    similarity of the two books.
+    """
+    # Renumber users densely so the matrix has no empty rows
+    _, user_rows = np.unique(user_ids, return_inverse=True)
+    num_users = int(user_rows.max()) + 1 if len(user_rows) else 0
+    values = ratings.astype(np.float32)
+
+    # Center each user's ratings on the user's mean rating
+    sums = np.bincount(user_rows, weights=values, minlength=num_users)
+    counts = np.bincount(user_rows, minlength=num_users)
+    means = sums / np.maximum(counts, 1)
+    values = values - means[user_rows].astype(np.float32)
+
+    matrix = sp.csc_matrix((values, (user_rows, book_codes)),
+                           shape=(num_users, num_books), dtype=np.float32)
+
+    # Scale every book's column to unit length
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0))).ravel()
+    norms[norms == 0] = 1.0
+    return matrix @ sp.diags(1.0 / norms).astype(np.float32)
+
+
+# ----------------------------------------------------------------------
+# Computing Neighbors
+# ----------------------------------------------------------------------
+def compute_neighbors(matrix, books, k, min_similarity=0.0):
+    """
+    Generator yielding (book, [(neighbor, similarity), ...]) for each book
+    column index in books, with up to k neighbors sorted from most to least
+    similar. Similarities are computed BLOCK_SIZE books at a time.
+    """
+    matrix_t = matrix.T.tocsr()
+    for start in range(0, len(books), BLOCK_SIZE):
+        block = np.asarray(books[start:start + BLOCK_SIZE])
+        # Dense (len(block) x num_books) similarities for this block
+        sims = (matrix_t[block] @ matrix).toarray()
+        # A book is not its own neighbor
+        sims[np.arange(len(block)), block] = -np.inf
+
+        num_candidates = min(k, sims.shape[1] - 1)
+        if num_candidates <= 0:
+            for book in block:
+                yield (int(book), [])
+            continue
+        top = np.argpartition(-sims, num_candidates - 1,
+                              axis=1)[:, :num_candidates]
+        for (i, book) in enumerate(block):
+            neighbors = top[i][np.argsort(-sims[i, top[i]])]
+            yield (int(book), [(int(n), float(sims[i, n])) for n in neighbors
+                               if sims[i, n] > min_similarity])
+
+
+def write_neighbors(conn, isbns, results):
+    """
+    Replaces the book_neighbors rows of every book in results, committing
+    once per BLOCK_SIZE books. Returns the number of books written.
+    """
+    cursor = conn.cursor()
+    written = 0
+    batch = []
+
+    def flush():
+        cursor.executemany('DELETE FROM book_neighbors WHERE isbn_10 = %s',
+                           [(isbns[book],) for (book, _) in batch])
+        rows = [(isbns[book], rank, isbns[neighbor], similarity)
+                for (book, neighbors) in batch
+                for (rank, (neighbor, similarity))
+                in enumerate(neighbors, start=1)]
+        if rows:
+            cursor.executemany(
+                'INSERT INTO book_neighbors(isbn_10, neighbor_rank, '
+                'neighbor_isbn_10, similarity) VALUES (%s, %s, %s, %s)', rows)
+        conn.commit()
+
+    for result in results:
+        batch.append(result)
+        if len(batch) == BLOCK_SIZE:
+            flush()
+            written += len(batch)
+            batch = []
+    if batch:
+        flush()
+        written += len(batch)
+    cursor.close()
+    return written
+
+
+# ----------------------------------------------------------------------
+# Full and Incremental Builds
+# ----------------------------------------------------------------------
+def read_stale_books(conn):
+    """
+    Returns the list of isbn_10s currently in book_neighbors_stale.
+    """
+    cursor = conn.cursor()
+    cursor.execute('SELECT isbn_10 FROM book_neighbors_stale')
+    stale = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return stale
+
+
+def clear_stale_books(conn, stale):
+    """
+    Removes the given isbn_10s from book_neighbors_stale. Books which were
+    marked stale after we read the table (and so may not be reflected in
+    this build) are left for the next run.
+    """
+    cursor = conn.cursor()
+    cursor.executemany('DELETE FROM book_neighbors_stale WHERE isbn_10 = %s',
+                       [(isbn_10,) for isbn_10 in stale])
+    conn.commit()
+    cursor.close()
+
+
+def books_to_refresh(conn, stale, codes):
+    """
+    Returns the column indices of the stale books and of every book whose
+    stored neighbor list includes a stale book.
+    """
+    cursor = conn.cursor()
+    affected = set(stale)
+    for start in range(0, len(stale), 1000):
+        chunk = stale[start:start + 1000]
+        cursor.execute('SELECT DISTINCT isbn_10 FROM book_neighbors '
+                       'WHERE neighbor_isbn_10 IN (%s)'
+                       % ', '.join(['%s'] * len(chunk)), chunk)
+        affected.update(row[0] for row in cursor.fetchall())
+    cursor.close()
+    return sorted(codes[isbn_10] for isbn_10 in affected if isbn_10 in codes)
+
+
+def load_snapshot_ratings(snapshot_dir):
+    """
+    Returns the same tuple as load_ratings, read from a snapshot. The arrays
+    are memory-mapped, not copied.
+    """
+    snapshot = Snapshot.load(snapshot_dir)
+    (user_ids, book_codes, ratings) = snapshot.ratings
+    return (user_ids, book_codes, ratings, snapshot.isbn_list())
+
+
+def build(conn, k, min_similarity, incremental, snapshot_dir=None):
+    """
+    Builds (or incrementally refreshes) book_neighbors, printing progress.
+    Ratings are read from the snapshot in snapshot_dir if given.
+    """
+    start = time.perf_counter()
+    # Read the stale list before the ratings, so any rating added while we
+    # build marks its book stale again for the next run
+    stale = read_stale_books(conn)
+    if incremental and not stale:
+        print('No books have changed ratings; nothing to do.')
+        return
+
+    if snapshot_dir is None:
+        (user_ids, book_codes, ratings, isbns) = load_ratings(conn)
+    else:
+        (user_ids, book_codes, ratings, isbns) = load_snapshot_ratings(
+            snapshot_dir)
+    print('Loaded %d ratings of %d books in %.1fs'
+          % (len(ratings), len(isbns), time.perf_counter() - start))
+
+    matrix = build_item_matrix(user_ids, book_codes, ratings, len(isbns))
+    codes = {isbn_10: code for (code, isbn_10) in enumerate(isbns)}
+
+    if incremental:
+        books = books_to_refresh(conn, stale, codes)
+    else:
+        books = list(range(len(isbns)))
+
+    written = write_neighbors(conn, isbns,
+                              compute_neighbors(matrix, books, k,
+                                                min_similarity))
+
+    cursor = conn.cursor()
+    if not incremental:
+        # Drop neighbor lists of books which no longer have any ratings
+        cursor.execute('DELETE FROM book_neighbors WHERE isbn_10 NOT IN '
+                       '(SELECT DISTINCT isbn_10 FROM ratings)')
+    else:
+        # Stale books whose ratings were all deleted have no column
+        gone = [(isbn_10,) for isbn_10 in stale if isbn_10 not in codes]
+        cursor.executemany('DELETE FROM book_neighbors WHERE isbn_10 = %s',
+                           gone)
+    conn.commit()
+    cursor.close()
+    if snapshot_dir is None:
+        # A snapshot may predate some of the stale books' changes, so they
+        # are left for the next --incremental run
+        clear_stale_books(conn, stale)
+
+    print('Wrote neighbors for %d books in %.1fs'
+          % (written, time.perf_counter() - start))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--k', type=int, default=20,
+        help='neighbors to keep per book (default: 20)')
+    parser.add_argument('--min-similarity', type=float, default=0.0,
+        help='only keep neighbors more similar than this (default: 0)')
+    parser.add_argument('--incremental', action='store_true',
+        help='only refresh books whose ratings changed since the last build')
+    parser.add_argument('--snapshot', metavar='DIR',
+        help='read ratings from a snapshot.py snapshot instead of the database')
+    args = parser.parse_args(argv)
+    if args.incremental and args.snapshot:
+        # The stale list may include changes made after the snapshot
+        parser.error('--incremental needs the current ratings, not a '
+                     'snapshot')
+
+    try:
+        conn = mysql.connector.connect(**DB_CONFIG)
+    except mysql.connector.Error as err:
+        sys.stderr.write('Could not connect to the database: %s\n' % err)
+        return 1
+
+    try:
+        build(conn, args.k, args.min_similarity, args.incremental,
+              args.snapshot)
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,467 @@
+"""
+Non-interactive command mode for the application: runs the operations from
+app.py's menus as command-line subcommands, or a batch of them read from a
+file or stdin, and writes each result to stdout as one line of JSON.
+
+Usage:
+    python3 app.py --user USERNAME COMMAND [ARGS...]
+    python3 app.py --user USERNAME batch [FILE]
+
+(python3 commands.py ... works too.) The password is read from --password,
+or else from the BOOKS_APP_PASSWORD environment variable. Retailer commands
+(users-top-rated, top-rated-in-timeframe, add-book) need a retailer account.
+
+A batch file has one command per line, written as on the command line
+(quote arguments containing spaces); blank lines and lines starting with #
+are skipped. All of a batch's commands run back to back on one pooled
+session, and a failing command doesn't stop the ones after it. A line
+"login USERNAME PASSWORD" switches the user the following lines run as;
+each user's password is only checked against the database once per batch
+(see sessions.py).
+
+Each output line is a JSON object with the command's line number ("line"),
+name ("command"), "ok", the "result" or "error", and "ms" taken, e.g.
+    {"line": 1, "command": "rate", "ok": true, "result": {"added": true},
+     "ms": 3.1}
+
+--slow-query-log FILE logs statements slower than --slow-query-seconds,
+--profile COMMAND runs that command under cProfile and tracemalloc, and
+--metrics FILE saves the statement and per-command metrics as JSON at the
+end (see metrics.py).
+
+The exit status is 0 if every command succeeded and 1 otherwise.
+"""
+
+import argparse
+import contextlib
+import decimal
+import json
+import os
+import shlex
+import sys
+import time
+
+import mysql.connector
+
+import app
+from pagination import CursorError
+from sessions import SessionCache
+
+# Environment variable the password is read from if --password isn't given
+PASSWORD_ENV_VAR = 'BOOKS_APP_PASSWORD'
+
+
+class CommandError(Exception):
+    """
+    A command which could not be run (bad arguments, or not allowed for the
+    signed-in user's role).
+    """
+
+
+class CommandParser(argparse.ArgumentParser):
+    """
+    An ArgumentParser which raises CommandError instead of exiting, so one
+    bad line of a batch doesn't end the whole batch.
+    """
+
+    def error(self, message):
+        raise CommandError(message)
+
+
+def rows_to_dicts(columns, rows):
+    """
+    Returns a list of {column: value} dictionaries for a list of row tuples.
+    """
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def page_to_dict(columns, page):
+    """
+    Returns the result for a (rows, next_cursor) page of a paged list:
+    {"books": [...], "next_cursor": ...}. Pass next_cursor back as --cursor
+    (or the cursor parameter of service.py) to get the next page; it is null
+    on the last page.
+    """
+    (rows, next_cursor) = page
+    return {'books': rows_to_dicts(columns, rows), 'next_cursor': next_cursor}
+
+
+def json_default(value):
+    """
+    json.dumps fallback for the non-JSON types MySQL returns (DECIMAL
+    averages, and bytearrays from some prepared statements).
+    """
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8')
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+# ----------------------------------------------------------------------
+# Commands
+# ----------------------------------------------------------------------
+# Each command takes the parsed arguments and returns a JSON-serializable
+# result.
+def cmd_search(args):
+    return page_to_dict(('isbn_10', 'title', 'year'), app.fetch_search_page(
+        args.genre, args.language_code, args.after_year, args.cursor,
+        args.limit))
+
+
+def cmd_full_text_search(args):
+    return rows_to_dicts(('isbn_10', 'title', 'year', 'relevance'),
+        app.fetch_full_text_matches(args.terms, args.limit))
+
+
+def cmd_rate(args):
+    app.insert_rating(args.user_id, args.isbn_10, args.rating)
+    return {'added': True}
+
+
+def cmd_to_read(args):
+    app.insert_to_read(args.user_id, args.isbn_10)
+    return {'added': True}
+
+
+def cmd_popular_series(args):
+    rows = app.fetch_books_by_author(args.author)
+    averages = app.fetch_average_ratings([row[0] for row in rows])
+    books = rows_to_dicts(('isbn_10', 'title', 'year', 'author', 'num_pages',
+                           'num_comments', 'num_editions'), rows)
+    for book in books:
+        (book['num_ratings'], book['avg_rating']) = averages.get(
+            book['isbn_10'], (0, None))
+    return books
+
+
+def cmd_recommend(args):
+    return {
+        'recommendations': rows_to_dicts(('isbn_10', 'title', 'year', 'score'),
+            app.fetch_recommendations(args.isbn_10, args.limit)),
+        'similar_descriptions': rows_to_dicts(
+            ('isbn_10', 'title', 'similarity'),
+            app.fetch_similar_descriptions(args.isbn_10, args.limit)),
+        'also_liked': rows_to_dicts(('isbn_10', 'title', 'similarity'),
+            app.fetch_also_liked(args.isbn_10, args.limit)),
+    }
+
+
+def cmd_users_top_rated(args):
+    page = app.fetch_users_top_rated_page(args.user_id, args.cursor,
+                                          args.limit)
+    averages = app.fetch_average_ratings([row[0] for row in page[0]])
+    result = page_to_dict(('isbn_10', 'rating'), page)
+    for book in result['books']:
+        (book['num_ratings'], book['avg_rating']) = averages.get(
+            book['isbn_10'], (0, None))
+    return result
+
+
+def cmd_top_rated_in_timeframe(args):
+    return page_to_dict(('isbn_10', 'title', 'avg_rating', 'num_ratings'),
+        app.fetch_top_rated_in_timeframe_page(args.start_year, args.end_year,
+            args.cursor, args.min_ratings, args.limit))
+
+
+def cmd_add_book(args):
+    isbn_10 = args.isbn_10.strip().upper()
+    if not app.ISBN_10_RE.match(isbn_10):
+        raise CommandError('invalid isbn_10 %s' % args.isbn_10)
+    return {'added': app.insert_book(isbn_10, args.title, args.year,
+                                     args.language_code, args.authors)}
+
+
+# Name -> (function, role required or None, help)
+COMMANDS = {
+    'search': (cmd_search, None,
+        'books in a genre and language published after a year'),
+    'full-text-search': (cmd_full_text_search, None,
+        'books matching keywords in their title, author or description'),
+    'rate': (cmd_rate, None, 'add a rating'),
+    'to-read': (cmd_to_read, None, 'add a book to a to-read shelf'),
+    'popular-series': (cmd_popular_series, None,
+        'books by an author, with their average ratings'),
+    'recommend': (cmd_recommend, None, 'recommendations for a book'),
+    'users-top-rated': (cmd_users_top_rated, 'retailer',
+        'a user\'s top rated books'),
+    'top-rated-in-timeframe': (cmd_top_rated_in_timeframe, 'retailer',
+        'top rated books published in a range of years'),
+    'add-book': (cmd_add_book, 'retailer', 'add a book to the catalog'),
+}
+
+
+def add_command_parsers(subparsers):
+    """
+    Adds a subparser for each of COMMANDS.
+    """
+    def add(name):
+        return subparsers.add_parser(name, help=COMMANDS[name][2])
+
+    parser = add('search')
+    parser.add_argument('genre')
+    parser.add_argument('language_code')
+    parser.add_argument('after_year', type=int)
+    parser.add_argument('--cursor', help='next_cursor of the previous page')
+    parser.add_argument('--limit', type=int, default=app.SEARCH_PAGE_SIZE)
+
+    parser = add('full-text-search')
+    parser.add_argument('terms')
+    parser.add_argument('--limit', type=int, default=app.SEARCH_LIMIT)
+
+    parser = add('rate')
+    parser.add_argument('user_id', type=int)
+    parser.add_argument('isbn_10')
+    parser.add_argument('rating', type=int, choices=range(1, 6))
+
+    parser = add('to-read')
+    parser.add_argument('user_id', type=int)
+    parser.add_argument('isbn_10')
+
+    parser = add('popular-series')
+    parser.add_argument('author')
+
+    parser = add('recommend')
+    parser.add_argument('isbn_10')
+    parser.add_argument('--limit', type=int, default=app.RECOMMENDATION_LIMIT)
+
+    parser = add('users-top-rated')
+    parser.add_argument('user_id', type=int)
+    parser.add_argument('--cursor', help='next_cursor of the previous page')
+    parser.add_argument('--limit', type=int, default=app.USER_TOP_RATED_LIMIT)
+
+    parser = add('top-rated-in-timeframe')
+    parser.add_argument('start_year', type=int)
+    parser.add_argument('end_year', type=int)
+    parser.add_argument('--min-ratings', type=int,
+                        default=app.TOP_RATED_MIN_RATINGS)
+    parser.add_argument('--cursor', help='next_cursor of the previous page')
+    parser.add_argument('--limit', type=int, default=app.TOP_RATED_LIMIT)
+
+    parser = add('add-book')
+    parser.add_argument('isbn_10')
+    parser.add_argument('title')
+    parser.add_argument('year', type=int)
+    parser.add_argument('language_code')
+    parser.add_argument('authors', nargs='*')
+
+
+def add_instrumentation_arguments(parser):
+    """
+    Adds the options configuring app.py's instrumentation (see
+    configure_instrumentation).
+    """
+    parser.add_argument('--slow-query-log', metavar='FILE',
+        help='log slow statements, with their parameters, to FILE')
+    parser.add_argument('--slow-query-seconds', type=float,
+        default=app.SLOW_QUERY_SECONDS,
+        help='statements logged as slow take at least this long (default: '
+             '%s)' % app.SLOW_QUERY_SECONDS)
+    parser.add_argument('--profile', metavar='COMMAND',
+        help='run COMMAND under cProfile and tracemalloc')
+
+
+def configure_instrumentation(args):
+    """
+    Applies the options from add_instrumentation_arguments; call it before
+    app.init_app.
+    """
+    app.SLOW_QUERY_LOG = args.slow_query_log
+    app.SLOW_QUERY_SECONDS = args.slow_query_seconds
+    app.PROFILE_OPERATION = args.profile
+
+
+def make_parser():
+    parser = CommandParser(prog='app.py', description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--user', required=True, help='username to sign in as')
+    parser.add_argument('--password',
+        help='password (default: $%s)' % PASSWORD_ENV_VAR)
+    add_instrumentation_arguments(parser)
+    parser.add_argument('--metrics', metavar='FILE',
+        help='save the metrics to FILE as JSON at the end')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_command_parsers(subparsers)
+    batch_parser = subparsers.add_parser('batch',
+        help='run the commands in a file, one per line')
+    batch_parser.add_argument('file', nargs='?', default='-',
+        help='file of commands (default: - for stdin)')
+    return parser
+
+
+def make_line_parser():
+    """
+    Returns the parser for a line of a batch: any command except batch, or
+    login.
+    """
+    parser = CommandParser(prog='batch line')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_command_parsers(subparsers)
+    login_parser = subparsers.add_parser('login',
+        help='run the following lines as another user')
+    login_parser.add_argument('username')
+    login_parser.add_argument('password')
+    return parser
+
+
+# ----------------------------------------------------------------------
+# Running Commands
+# ----------------------------------------------------------------------
+def call_command(name, args):
+    """
+    Calls a command's function, recording its statements under the
+    command's name in app.instruments.
+    """
+    with app.instruments.operation(name):
+        try:
+            return COMMANDS[name][0](args)
+        except CursorError as err:
+            raise CommandError(str(err))
+
+
+def run_command(args, session):
+    """
+    Runs one parsed command for a signed-in user's session (None if the
+    user is not signed in). Returns the output record for it.
+    """
+    required_role = COMMANDS[args.command][1]
+    record = {'command': args.command}
+    start = time.perf_counter()
+    try:
+        if session is None:
+            raise CommandError('not signed in')
+        if required_role is not None and session.role != required_role:
+            raise CommandError('%s requires a %s account'
+                               % (args.command, required_role))
+        record['result'] = call_command(args.command, args)
+        record['ok'] = True
+    except (CommandError, mysql.connector.Error) as err:
+        record['ok'] = False
+        record['error'] = str(err)
+    record['ms'] = round((time.perf_counter() - start) * 1000, 3)
+    return record
+
+
+def write_record(record, out):
+    out.write(json.dumps(record, default=json_default) + '\n')
+
+
+def run_login(args, sessions):
+    """
+    Runs a batch's login line. Returns (the new session or None, the output
+    record).
+    """
+    record = {'command': 'login'}
+    start = time.perf_counter()
+    try:
+        session = sessions.login(args.username, args.password,
+                                 app.check_login)
+    except mysql.connector.Error as err:
+        session = None
+        record.update(ok=False, error=str(err))
+    else:
+        if session is None:
+            record.update(ok=False, error='login failed')
+        else:
+            record.update(ok=True, result={'username': session.username,
+                                           'role': session.role})
+    record['ms'] = round((time.perf_counter() - start) * 1000, 3)
+    return (session, record)
+
+
+def run_batch(lines, session, sessions, out=sys.stdout):
+    """
+    Runs each command line in lines (see the module docstring), writing one
+    JSON record per command to out. Commands run as the user of session
+    until a login line changes it; logins go through sessions (a
+    SessionCache). Returns the number of commands which failed.
+    """
+    parser = make_line_parser()
+    failures = 0
+    for (line_number, line) in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            args = parser.parse_args(shlex.split(line))
+            if args.command == 'login':
+                # After a failed login, nothing runs until the next login
+                (session, record) = run_login(args, sessions)
+            else:
+                record = run_command(args, session)
+        except (CommandError, ValueError) as err:
+            # ValueError: unbalanced quotes in the line
+            record = {'command': line.split()[0], 'ok': False,
+                      'error': str(err)}
+        record = dict(line=line_number, **record)
+        if not record['ok']:
+            failures += 1
+        write_record(record, out)
+    return failures
+
+
+def main(argv=None):
+    parser = make_parser()
+    try:
+        args = parser.parse_args(argv)
+    except CommandError as err:
+        parser.print_usage(sys.stderr)
+        sys.stderr.write('app.py: error: %s\n' % err)
+        return 2
+    password = args.password or os.environ.get(PASSWORD_ENV_VAR)
+    if not password:
+        sys.stderr.write('No password: use --password or set $%s.\n'
+                         % PASSWORD_ENV_VAR)
+        return 2
+
+    batch_file = None
+    if args.command == 'batch' and args.file != '-':
+        try:
+            batch_file = open(args.file, 'r', encoding='utf-8')
+        except OSError as err:
+            sys.stderr.write('Could not read the batch file: %s\n' % err)
+            return 2
+
+    # stdout is for results only, so send app's connection messages to stderr
+    app.RAISE_ERRORS = True
+    configure_instrumentation(args)
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            app.init_app(load_indexes=False)
+        # Titles aren't resolved here (isbn_10s must be given), so only the
+        # description index is needed
+        app.description_index = app.load_description_index()
+    except mysql.connector.Error as err:
+        sys.stderr.write('Could not connect to the database: %s\n' % err)
+        if batch_file is not None:
+            batch_file.close()
+        return 1
+
+    sessions = SessionCache()
+    try:
+        with app.pool.session():
+            session = sessions.login(args.user, password, app.check_login)
+            if session is None:
+                sys.stderr.write('Login failed.\n')
+                return 1
+            if args.command == 'batch':
+                failures = run_batch(batch_file or sys.stdin, session,
+                                     sessions)
+            else:
+                record = run_command(args, session)
+                failures = 0 if record['ok'] else 1
+                write_record(record, sys.stdout)
+    except mysql.connector.Error as err:
+        sys.stderr.write('Database error: %s\n' % err)
+        return 1
+    finally:
+        if batch_file is not None:
+            batch_file.close()
+        app.pool.close()
+        if args.metrics:
+            app.instruments.write_json(args.metrics)
+    return 0 if failures == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
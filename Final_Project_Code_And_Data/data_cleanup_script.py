@@ -1,57 +1,291 @@
 # CS 121 Winter 2022 Final Project
 
+# Data cleaning script. Each input file is cleaned by a streaming pipeline
+# which runs across a process pool, so the full ratings and to_read dumps can
+# be cleaned quickly and without holding them in memory:
+# 1. The file is split into byte ranges on line boundaries, and each worker
+#    cleans one range at a time, writing the cleaned rows (tagged with the
+#    position of the line they came from) into one part file per key
+#    partition.
+# 2. Each partition is deduplicated on the table's primary key, keeping the
+#    first occurrence, so a worker only ever holds one partition's keys.
+# 3. The deduplicated partitions are merged back into input order.
+# The files must not contain line breaks inside quoted fields (ours don't).
+
 import csv
+import glob
+import heapq
+import os
+import time
+import zlib
+from multiprocessing import Pool, cpu_count
+
+# Number of byte ranges per worker process, so that faster workers can pick
+# up more of the file
+RANGES_PER_WORKER = 4
+# Lines parsed at a time within a range
+BATCH_LINES = 10000
+
+# The book_id -> isbn_13 mapping, set once in each worker by init_worker
+book_id_to_isbn_13 = None
+
+
+def init_worker(mapping):
+    """
+    Process pool initializer: receives the book_id -> isbn_13 mapping once
+    per worker process, rather than once per task.
+    """
+    global book_id_to_isbn_13
+    book_id_to_isbn_13 = mapping
+
+
+# ----------------------------------------------------------------------
+# Row Transformations and Keys
+# ----------------------------------------------------------------------
+# Splits a row whose last column is a list such as "['fantasy', 'fiction']"
+# into one row per list item.
+def split_list_values(row):
+    items_list = row[-1].strip('][').split(', ')
+    return [row[:-1] + [item.replace('\'', '')] for item in items_list]
+
+
+# Maps the book_id in the second column of a ratings or to_read row to its
+# isbn_13 number. Rows with invalid book_ids are removed from the data.
+def convert_book_id(row):
+    isbn_13 = book_id_to_isbn_13.get(row[1])
+    if isbn_13 is None:
+        return []
+    return [row[:1] + [isbn_13] + row[2:]]
+
+
+# Primary key of genres and authors rows: the whole row
+def whole_row_key(row):
+    return tuple(row)
+
+
+# Primary key of ratings and to_read rows: (user_id, book)
+def user_book_key(row):
+    return (row[0], row[1])
+
+
+# ----------------------------------------------------------------------
+# Pipeline
+# ----------------------------------------------------------------------
+def byte_ranges(filename, start, num_ranges):
+    """
+    Splits the file from byte offset start to its end into up to num_ranges
+    (start, end) byte ranges which begin and end on line boundaries.
+    """
+    size = os.path.getsize(filename)
+    boundaries = [start]
+    with open(filename, 'rb') as f:
+        for i in range(1, num_ranges):
+            f.seek(start + (size - start) * i // num_ranges)
+            f.readline()
+            if f.tell() > boundaries[-1]:
+                boundaries.append(f.tell())
+    if boundaries[-1] < size:
+        boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def part_filename(output_filename, range_index, partition):
+    return '%s.part-%05d-%03d' % (output_filename, range_index, partition)
+
+
+def partition_filename(output_filename, partition):
+    return '%s.dedup-%03d' % (output_filename, partition)
+
+
+def clean_range(task):
+    """
+    Cleans the lines in one byte range of the input file, writing the cleaned
+    rows into one part file per key partition. Each output row is prefixed
+    with the byte offset of its input line and its index among that line's
+    output rows, which together give its position in the output. Returns
+    (range_index, bytes read, rows read, rows written).
+    """
+    (input_filename, output_filename, range_index, start, end, transform,
+        key, num_partitions) = task
+    part_files = [open(part_filename(output_filename, range_index, p), 'w',
+                       newline='', encoding='utf-8')
+                  for p in range(num_partitions)]
+    writers = [csv.writer(f) for f in part_files]
+    rows_in = 0
+    rows_out = 0
+
+    def flush(offsets, lines):
+        nonlocal rows_in, rows_out
+        for (offset, row) in zip(offsets, csv.reader(lines)):
+            rows_in += 1
+            for (i, new_row) in enumerate(transform(row)):
+                partition = zlib.crc32(
+                    '\x00'.join(key(new_row)).encode('utf-8')) % num_partitions
+                writers[partition].writerow([offset, i] + new_row)
+                rows_out += 1
+
+    with open(input_filename, 'rb') as f:
+        f.seek(start)
+        offset = start
+        offsets = []
+        lines = []
+        while offset < end:
+            line = f.readline()
+            if not line:
+                break
+            text = line.decode('utf-8').rstrip('\r\n')
+            if text:
+                offsets.append(offset)
+                lines.append(text)
+            offset += len(line)
+            if len(lines) == BATCH_LINES:
+                flush(offsets, lines)
+                offsets = []
+                lines = []
+        flush(offsets, lines)
+
+    for part_file in part_files:
+        part_file.close()
+    return (range_index, offset - start, rows_in, rows_out)
 
-# Data cleaning script
-def remove_list_values(old_filename, new_filename):
-    with open(old_filename, 'r', encoding="utf-8") as f_in, \
-        open(new_filename, 'w', newline='', encoding="utf-8") as f_out:
+
+def dedup_partition(task):
+    """
+    Concatenates one partition's part files (which are already in input
+    order, as the byte ranges are) into a single file, dropping every row
+    whose key was already seen. Returns the number of duplicates dropped.
+    """
+    (output_filename, partition, num_ranges, key) = task
+    seen = set()
+    duplicates = 0
+    with open(partition_filename(output_filename, partition), 'w',
+              newline='', encoding='utf-8') as f_out:
         csv_out = csv.writer(f_out)
-        for row in csv.reader(f_in):
-            items_list = row[-1].strip('][').split(', ')
-            clean_list = []
-            for item in items_list:
-                clean_list.append(item.replace('\'', ''))
-            for i in clean_list:
-                csv_out.writerow(row[:-1] + [i])
+        for range_index in range(num_ranges):
+            filename = part_filename(output_filename, range_index, partition)
+            with open(filename, 'r', newline='', encoding='utf-8') as f_in:
+                for row in csv.reader(f_in):
+                    row_key = key(row[2:])
+                    if row_key in seen:
+                        duplicates += 1
+                        continue
+                    seen.add(row_key)
+                    csv_out.writerow(row)
+            os.remove(filename)
+    return duplicates
 
 
-# Map every instance of book_id to its corresponding isbn_13 number in ratings
-# and to_read
-def convert_ids(input_filename, output_filename, book_id_to_isbn_13):
-    with open(input_filename, 'r', encoding="utf-8") as f_in, \
-        open(output_filename, 'w', newline='', encoding="utf-8") as f_out:
+def read_positioned(filename):
+    """
+    Generator yielding ((offset, index), row) for a deduplicated partition.
+    """
+    with open(filename, 'r', newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            yield ((int(row[0]), int(row[1])), row[2:])
+
+
+def clean_file(input_filename, output_filename, transform, key,
+               workers=None, mapping=None):
+    """
+    Runs the cleanup pipeline on one CSV file: applies transform (a function
+    from a row to a list of rows) to every row after the header, drops rows
+    whose key was already seen, and writes the rest to output_filename in
+    input order, printing progress. mapping is passed to init_worker.
+    """
+    workers = workers or cpu_count()
+    start_time = time.perf_counter()
+
+    with open(input_filename, 'rb') as f:
+        header = f.readline()
+    ranges = byte_ranges(input_filename, len(header),
+                         workers * RANGES_PER_WORKER)
+    total_bytes = os.path.getsize(input_filename) - len(header)
+    num_partitions = workers
+
+    with Pool(workers, initializer=init_worker, initargs=(mapping,)) as pool:
+        tasks = [(input_filename, output_filename, i, start, end, transform,
+                  key, num_partitions)
+                 for (i, (start, end)) in enumerate(ranges)]
+        done_bytes = 0
+        rows_in = 0
+        rows_out = 0
+        for (_, num_bytes, num_in, num_out) in pool.imap_unordered(
+                clean_range, tasks):
+            done_bytes += num_bytes
+            rows_in += num_in
+            rows_out += num_out
+            elapsed = time.perf_counter() - start_time
+            print('  %s: %5.1f%% (%d rows, %.1f MB/s)' % (
+                input_filename, 100.0 * done_bytes / max(total_bytes, 1),
+                rows_in, done_bytes / 1e6 / elapsed if elapsed else 0.0))
+
+        duplicates = sum(pool.map(
+            dedup_partition, [(output_filename, p, len(ranges), key)
+                              for p in range(num_partitions)]))
+
+    partitions = [partition_filename(output_filename, p)
+                  for p in range(num_partitions)]
+    with open(output_filename, 'w', newline='', encoding='utf-8') as f_out:
+        f_out.write(header.decode('utf-8').rstrip('\r\n') + '\r\n')
         csv_out = csv.writer(f_out)
-        for row in csv.reader(f_in):
-            for i in row[-1].split():
-                try:
-                    # For invalid keys, remove from data by not writing to the 
-                    # output file.
-                    isbn_13 = book_id_to_isbn_13[row[1]]
-                    csv_out.writerow(row[:1] + [isbn_13] + row[2:])
-                except KeyError:
-                    pass
-                
+        for (_, row) in heapq.merge(*[read_positioned(p) for p in partitions],
+                                    key=lambda item: item[0]):
+            csv_out.writerow(row)
+    for p in partitions:
+        os.remove(p)
+
+    elapsed = time.perf_counter() - start_time
+    print('%s -> %s: %d rows in, %d rows out (%d duplicates removed) in '
+          '%.1fs (%.0f rows/s)' % (
+              input_filename, output_filename, rows_in, rows_out - duplicates,
+              duplicates, elapsed, rows_in / elapsed if elapsed else 0.0))
+
+
+def remove_stale_parts(output_filename):
+    """
+    Removes part files left behind by an interrupted run.
+    """
+    for filename in (glob.glob(output_filename + '.part-*')
+                     + glob.glob(output_filename + '.dedup-*')):
+        os.remove(filename)
+
+
+# Modify a file such as genres.csv or authors.csv, whose last column is a
+# list, to have one item per row
+def remove_list_values(old_filename, new_filename, workers=None):
+    remove_stale_parts(new_filename)
+    clean_file(old_filename, new_filename, split_list_values, whole_row_key,
+               workers)
+
+
+# Map every instance of book_id to its corresponding isbn_13 number in ratings
+# and to_read, keeping one row per (user_id, book)
+def convert_ids(input_filename, output_filename, book_id_to_isbn_13,
+                workers=None):
+    remove_stale_parts(output_filename)
+    clean_file(input_filename, output_filename, convert_book_id,
+               user_book_key, workers, book_id_to_isbn_13)
+
+
+# Read the book_id -> isbn_13 mapping from a file of book_id,isbn_13 rows
+def read_book_id_to_isbn_13(filename):
+    book_id_to_isbn_13 = {}
+    with open(filename, 'r', newline='', encoding='utf-8') as csvfile:
+        for row in csv.reader(csvfile):
+            book_id_to_isbn_13[row[0]] = row[1]
+    return book_id_to_isbn_13
+
+
 if __name__ == "__main__":
-    # Modify genres.csv and authors.csv to have one book and one author per 
+    # Modify genres.csv and authors.csv to have one book and one author per
     # row
     remove_list_values('genres.csv', 'new_genres.csv')
     # remove_list_values('authors.csv', 'new_authors.csv')
 
-    # From books.csv, creating a dictionary from book_id to isbn_13
-    """ 
-    book_id_to_isbn_13 = {}
-    filename = 'book_id_to_isbn_13.csv'
-
-    with open(filename, 'r') as csvfile:
-        datareader = csv.reader(csvfile)
-        for row in datareader:
-            books_row = list(row)
-            book_id = books_row[0]
-            isbn_13 = books_row[1]
-            book_id_to_isbn_13[book_id] = isbn_13
-
-    # Modify ratings and to_read to use isbn_13 instead of book_id
+    # From books.csv, creating a dictionary from book_id to isbn_13, then
+    # modify ratings and to_read to use isbn_13 instead of book_id
+    """
+    book_id_to_isbn_13 = read_book_id_to_isbn_13('book_id_to_isbn_13.csv')
     convert_ids('ratings.csv', 'new_ratings.csv', book_id_to_isbn_13)
     convert_ids('to_read.csv', 'new_to_read.csv', book_id_to_isbn_13)
-    """
\ No newline at end of file
+    """
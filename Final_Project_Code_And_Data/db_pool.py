@@ -0,0 +1,515 @@
+"""
+Connection pooling for the books database application.
+
+Instead of every part of the application sharing one global connection, a
+ConnectionPool hands out connections to callers for the duration of a single
+operation (or a whole session, see ConnectionPool.session) and takes them back
+afterwards. Connections are created lazily up to a configurable size, health
+checked before they are handed out, replaced when the server connection has
+been lost, and the pool keeps statistics about how long callers waited and
+how many connections were in use.
+
+Pooled connections run in autocommit mode, so read-only checkouts never pay
+for a COMMIT round trip. Checkouts that write open an explicit transaction,
+which is committed when the checkout ends (or rolled back if it fails).
+
+Each pooled connection also keeps a StatementCache of server-side prepared
+statements, so a statement text which is executed many times is only parsed
+and planned by MySQL once per connection; later executions just send the
+bound parameters.
+"""
+
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import mysql.connector
+import mysql.connector.errorcode as errorcode
+
+# Default connection settings for the application's MySQL user. Other scripts
+# in this directory (loaders, benchmarks, etc.) use the same settings.
+DB_CONFIG = {
+    'host': 'localhost',
+    'user': 'bookretailer',
+    # Find port in MAMP or MySQL Workbench GUI or with
+    # SHOW VARIABLES WHERE variable_name LIKE 'port';
+    'port': '3306',
+    'password': '8sXjJK',
+    'database': 'booksdb',
+}
+
+# Client error codes which mean the connection to the server is gone, and the
+# connection should be thrown away rather than returned to the pool.
+CONNECTION_LOST_ERRORS = (
+    errorcode.CR_SERVER_GONE_ERROR,
+    errorcode.CR_SERVER_LOST,
+    errorcode.CR_SERVER_LOST_EXTENDED,
+    errorcode.CR_CONNECTION_ERROR,
+    errorcode.CR_CONN_HOST_ERROR,
+)
+
+
+class PoolTimeoutError(mysql.connector.Error):
+    """
+    Raised when no connection becomes available within the pool's timeout.
+    """
+
+
+def is_connection_lost(err):
+    """
+    Returns True if the given mysql.connector error means that the connection
+    to the server has been lost.
+    """
+    return err.errno in CONNECTION_LOST_ERRORS
+
+
+class StatementCache:
+    """
+    A bounded, least-recently-used cache of server-side prepared statements
+    for one connection, keyed on the statement text. Statements use %s
+    placeholders for their parameters, e.g.
+        SELECT orig_title FROM books WHERE isbn_10 = %s
+    """
+
+    def __init__(self, conn, capacity=64):
+        self.conn = conn
+        self.capacity = capacity
+        # Maps statement text to a prepared cursor holding that statement
+        self._cursors = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def cursor(self, sql):
+        """
+        Returns a prepared cursor for the given statement text. The statement
+        is prepared on the server the first time the cursor executes it, and
+        re-used by later executions with different parameters.
+        """
+        cursor = self._cursors.get(sql)
+        if cursor is not None:
+            self._cursors.move_to_end(sql)
+            self.hits += 1
+            return cursor
+
+        self.misses += 1
+        cursor = self.conn.cursor(prepared=True)
+        self._cursors[sql] = cursor
+        if len(self._cursors) > self.capacity:
+            # Closing the cursor deallocates its statement on the server
+            _, evicted = self._cursors.popitem(last=False)
+            self._close_cursor(evicted)
+            self.evictions += 1
+        return cursor
+
+    def discard(self, sql):
+        """
+        Drops the statement for the given text, e.g. after it failed.
+        """
+        cursor = self._cursors.pop(sql, None)
+        if cursor is not None:
+            self._close_cursor(cursor)
+
+    def clear(self):
+        """
+        Drops every cached statement. Used when the connection is closed or
+        reconnected, since prepared statements do not survive a reconnect.
+        """
+        while self._cursors:
+            _, cursor = self._cursors.popitem()
+            self._close_cursor(cursor)
+
+    def __len__(self):
+        return len(self._cursors)
+
+    @staticmethod
+    def _close_cursor(cursor):
+        try:
+            cursor.close()
+        except mysql.connector.Error:
+            pass
+
+
+class PooledConnection:
+    """
+    A MySQL connection owned by a ConnectionPool, along with the bookkeeping
+    the pool needs for it.
+    """
+
+    def __init__(self, conn, statement_cache_size=64):
+        self.conn = conn
+        # Prepared statements for this connection
+        self.statements = StatementCache(conn, statement_cache_size)
+        # Time the connection was last returned to the pool, used to decide
+        # whether a health check is due
+        self.last_used = time.monotonic()
+        # Set when an error shows that the server connection is gone
+        self.broken = False
+
+    def close(self):
+        """
+        Closes the underlying connection, ignoring errors from connections
+        which are already dead.
+        """
+        if not self.broken:
+            self.statements.clear()
+        try:
+            self.conn.close()
+        except mysql.connector.Error:
+            pass
+
+
+class ConnectionPool:
+    """
+    A fixed-size pool of MySQL connections.
+
+    Usage:
+        pool = ConnectionPool(size=5, **DB_CONFIG)
+        with pool.connection(read_only=True) as conn:
+            cursor = conn.cursor()
+            ...
+    """
+
+    def __init__(self, size=5, timeout=10.0, health_check_interval=30.0,
+                 reconnect_attempts=3, reconnect_delay=0.5,
+                 statement_cache_size=64, **connect_args):
+        """
+        size: maximum number of open connections.
+        timeout: seconds to wait for a free connection before raising
+            PoolTimeoutError.
+        health_check_interval: connections idle for longer than this many
+            seconds are pinged before being handed out.
+        reconnect_attempts, reconnect_delay: how hard to try re-establishing
+            a connection which failed its health check.
+        statement_cache_size: maximum number of prepared statements kept
+            open on each connection.
+        connect_args: passed through to mysql.connector.connect.
+        """
+        if size < 1:
+            raise ValueError('Pool size must be at least 1.')
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_delay = reconnect_delay
+        self.statement_cache_size = statement_cache_size
+        self.connect_args = connect_args
+
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._num_open = 0
+        # Set by close(); connections returned after that are closed
+        self._closed = False
+        # Connections pinned to a thread by session()
+        self._local = threading.local()
+        # Every connection currently open, for statement cache statistics
+        self._open = set()
+        self._stats = {
+            'checkouts': 0,
+            'read_only_checkouts': 0,
+            'timeouts': 0,
+            'connections_created': 0,
+            'connections_discarded': 0,
+            'health_checks': 0,
+            'reconnects': 0,
+            'total_wait_seconds': 0.0,
+            'max_wait_seconds': 0.0,
+            'in_use': 0,
+            'peak_in_use': 0,
+            # Prepared statement cache counters of connections which have
+            # since been closed
+            'statement_cache_hits': 0,
+            'statement_cache_misses': 0,
+            'statement_cache_evictions': 0,
+        }
+
+        # Open one connection up front so that configuration errors (bad
+        # password, missing database) surface immediately.
+        self._reserve_slot()
+        self._idle.put(self._new_connection())
+
+    # ------------------------------------------------------------------
+    # Connection lifecycle
+    # ------------------------------------------------------------------
+    def _reserve_slot(self):
+        """
+        Reserves room for one more open connection. Returns False if the pool
+        is already at full size.
+        """
+        with self._lock:
+            if self._num_open >= self.size:
+                return False
+            self._num_open += 1
+            return True
+
+    def _new_connection(self):
+        """
+        Opens a new autocommit connection in a slot already reserved with
+        _reserve_slot. The slot is given back if the connection fails.
+        """
+        try:
+            conn = mysql.connector.connect(**self.connect_args)
+            conn.autocommit = True
+        except mysql.connector.Error:
+            with self._lock:
+                self._num_open -= 1
+            raise
+        pooled = PooledConnection(conn, self.statement_cache_size)
+        with self._lock:
+            self._stats['connections_created'] += 1
+            self._open.add(pooled)
+        return pooled
+
+    def _forget(self, pooled):
+        """
+        Folds a closed connection's statement cache counters into the pool
+        totals. Must be called with the lock held.
+        """
+        if pooled in self._open:
+            self._open.remove(pooled)
+            statements = pooled.statements
+            self._stats['statement_cache_hits'] += statements.hits
+            self._stats['statement_cache_misses'] += statements.misses
+            self._stats['statement_cache_evictions'] += statements.evictions
+
+    def _discard(self, pooled):
+        """
+        Closes a connection and frees up its slot in the pool.
+        """
+        pooled.close()
+        with self._lock:
+            self._num_open -= 1
+            self._stats['connections_discarded'] += 1
+            self._forget(pooled)
+
+    def _ensure_healthy(self, pooled):
+        """
+        Pings a connection which has been idle for a while, reconnecting if
+        the server has gone away. Returns a usable PooledConnection.
+        """
+        idle_for = time.monotonic() - pooled.last_used
+        if idle_for < self.health_check_interval:
+            return pooled
+
+        with self._lock:
+            self._stats['health_checks'] += 1
+        try:
+            pooled.conn.ping(reconnect=False)
+            return pooled
+        except mysql.connector.Error:
+            pass
+
+        # The connection is dead; try to bring it back. Its prepared
+        # statements died with the old server session.
+        pooled.broken = True
+        pooled.statements.clear()
+        try:
+            pooled.conn.reconnect(attempts=self.reconnect_attempts,
+                                  delay=self.reconnect_delay)
+            pooled.conn.autocommit = True
+            pooled.broken = False
+            with self._lock:
+                self._stats['reconnects'] += 1
+            return pooled
+        except mysql.connector.Error:
+            # Keep the slot so the caller can open a replacement
+            pooled.close()
+            with self._lock:
+                self._stats['connections_discarded'] += 1
+                self._forget(pooled)
+            raise
+
+    def _acquire(self):
+        """
+        Takes an idle connection, opens a new one if the pool is not yet at
+        full size, or waits for one to be returned.
+        """
+        start = time.monotonic()
+        pooled = None
+        try:
+            pooled = self._idle.get_nowait()
+        except queue.Empty:
+            if self._reserve_slot():
+                pooled = self._new_connection()
+            else:
+                try:
+                    pooled = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._stats['timeouts'] += 1
+                    raise PoolTimeoutError(
+                        msg='Timed out waiting for a database connection.')
+        waited = time.monotonic() - start
+
+        try:
+            pooled = self._ensure_healthy(pooled)
+        except mysql.connector.Error:
+            # Replace the dead connection with a fresh one
+            pooled = self._new_connection()
+
+        with self._lock:
+            stats = self._stats
+            stats['checkouts'] += 1
+            stats['total_wait_seconds'] += waited
+            stats['max_wait_seconds'] = max(stats['max_wait_seconds'], waited)
+            stats['in_use'] += 1
+            stats['peak_in_use'] = max(stats['peak_in_use'], stats['in_use'])
+        return pooled
+
+    def _release(self, pooled):
+        """
+        Returns a connection to the pool, or discards it if it is broken.
+        """
+        with self._lock:
+            self._stats['in_use'] -= 1
+            closed = self._closed
+        if pooled.broken or closed:
+            self._discard(pooled)
+            return
+        pooled.last_used = time.monotonic()
+        self._idle.put(pooled)
+
+    def _pinned_connection(self):
+        """
+        Returns the connection pinned to the current thread by session(),
+        health checking it if it has been idle for a while, and replacing it
+        with another connection from the pool if it is broken (so a retry
+        after a lost connection doesn't reuse the dead one).
+        """
+        pooled = self._local.pinned
+        if pooled is not None and not pooled.broken:
+            try:
+                return self._ensure_healthy(pooled)
+            except mysql.connector.Error:
+                # The dead connection is closed but its slot is kept
+                self._local.pinned = None
+                with self._lock:
+                    self._stats['in_use'] -= 1
+                    self._num_open -= 1
+        elif pooled is not None:
+            self._local.pinned = None
+            self._release(pooled)
+        self._local.pinned = self._acquire()
+        return self._local.pinned
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+    @contextmanager
+    def checkout(self, read_only=False):
+        """
+        Context manager yielding a PooledConnection. Read-only checkouts run
+        in autocommit mode with no transaction; other checkouts run inside a
+        transaction which is committed when the block exits normally and
+        rolled back otherwise.
+
+        If the current thread is inside session(), the session's connection
+        is used instead of taking another one from the pool.
+        """
+        pinned = getattr(self._local, 'in_session', False)
+        pooled = self._pinned_connection() if pinned else self._acquire()
+        if read_only:
+            with self._lock:
+                self._stats['read_only_checkouts'] += 1
+
+        in_transaction = False
+        try:
+            if not read_only and not pooled.conn.in_transaction:
+                pooled.conn.start_transaction()
+                in_transaction = True
+            yield pooled
+            if in_transaction:
+                pooled.conn.commit()
+        except mysql.connector.Error as err:
+            if is_connection_lost(err):
+                pooled.broken = True
+            elif in_transaction:
+                try:
+                    pooled.conn.rollback()
+                except mysql.connector.Error:
+                    pooled.broken = True
+            raise
+        except BaseException:
+            if in_transaction:
+                try:
+                    pooled.conn.rollback()
+                except mysql.connector.Error:
+                    pooled.broken = True
+            raise
+        finally:
+            if pinned:
+                pooled.last_used = time.monotonic()
+            else:
+                self._release(pooled)
+
+    @contextmanager
+    def connection(self, read_only=False):
+        """
+        Like checkout(), but yields the raw mysql.connector connection.
+        """
+        with self.checkout(read_only=read_only) as pooled:
+            yield pooled.conn
+
+    @contextmanager
+    def session(self):
+        """
+        Pins one pooled connection to the current thread for the duration of
+        the block, so that a sequence of operations (e.g. one signed-in user's
+        menu session) reuses the same connection without going back to the
+        pool each time.
+        """
+        if getattr(self._local, 'in_session', False):
+            # Already in a session; nested sessions share the connection
+            yield
+            return
+        self._local.pinned = self._acquire()
+        self._local.in_session = True
+        try:
+            yield
+        finally:
+            # The connection may have been replaced during the session
+            pooled = self._local.pinned
+            self._local.pinned = None
+            self._local.in_session = False
+            if pooled is not None:
+                if pooled.conn.in_transaction and not pooled.broken:
+                    try:
+                        pooled.conn.rollback()
+                    except mysql.connector.Error:
+                        pooled.broken = True
+                self._release(pooled)
+
+    def stats(self):
+        """
+        Returns a dictionary of pool usage and wait statistics.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self.size
+            stats['open'] = self._num_open
+            for pooled in self._open:
+                statements = pooled.statements
+                stats['statement_cache_hits'] += statements.hits
+                stats['statement_cache_misses'] += statements.misses
+                stats['statement_cache_evictions'] += statements.evictions
+        stats['idle'] = self._idle.qsize()
+        checkouts = stats['checkouts']
+        stats['avg_wait_seconds'] = (stats['total_wait_seconds'] / checkouts
+                                     if checkouts else 0.0)
+        return stats
+
+    def close(self):
+        """
+        Closes all idle connections. Connections currently checked out are
+        closed when they are returned.
+        """
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                pooled = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(pooled)
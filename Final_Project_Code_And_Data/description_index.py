@@ -0,0 +1,268 @@
+"""
+Content-based similarity index over book descriptions.
+
+Each book's description (book_details.book_description) is turned into a
+TF-IDF vector over hashed word unigrams and bigrams, and the vectors are
+stored as a sparse CSR matrix in a directory of .npy files. Loading the
+index memory-maps those files, so startup takes milliseconds and the
+operating system shares the pages between processes; finding "books like
+this one" is then a sparse matrix-vector product which never touches MySQL.
+
+Usage:
+    python3 description_index.py build [--csv book_details.csv]
+                                       [--out description_index]
+    python3 description_index.py similar ISBN_10 [--k 10]
+
+Requires NumPy and SciPy (pip install numpy scipy).
+"""
+
+import argparse
+import csv
+import math
+import os
+import re
+import sys
+import time
+import zlib
+
+import numpy as np
+import scipy.sparse as sp
+
+# Default location of the index, relative to this directory
+DEFAULT_INDEX_DIR = 'description_index'
+# Number of hash buckets for terms. Collisions between rare terms barely
+# affect similarities, and 2^18 buckets keep the IDF table at 1 MB.
+NUM_FEATURES = 2 ** 18
+
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+# Very common words which say nothing about a book's content
+STOP_WORDS = frozenset('''
+    a about after all also an and any are as at be been before but by can
+    could did do does for from had has have he her him his how i if in into
+    is it its just more most my no not of on one only or other our out over
+    she so some such than that the their them then there these they this
+    those through to too up very was we were what when where which while who
+    will with would you your
+'''.split())
+
+
+# ----------------------------------------------------------------------
+# Text Processing
+# ----------------------------------------------------------------------
+def terms(text):
+    """
+    Returns the list of terms (unigrams and bigrams, minus stop words) in a
+    piece of text.
+    """
+    words = [word for word in TOKEN_RE.findall(text.lower())
+             if word not in STOP_WORDS]
+    return words + [a + ' ' + b for (a, b) in zip(words, words[1:])]
+
+
+def term_counts(text):
+    """
+    Returns a dictionary from hash bucket to the number of terms in text
+    which fall into it.
+    """
+    counts = {}
+    for term in terms(text):
+        # crc32 (unlike hash()) is stable between Python processes
+        bucket = zlib.crc32(term.encode('utf-8')) % NUM_FEATURES
+        counts[bucket] = counts.get(bucket, 0) + 1
+    return counts
+
+
+def to_vector(counts, idf):
+    """
+    Returns the (indices, values) of the unit-length TF-IDF vector for the
+    given term counts, using sublinear term frequencies.
+    """
+    indices = np.array(sorted(counts), dtype=np.int32)
+    values = np.array([(1.0 + math.log(counts[i])) * idf[i]
+                       for i in indices], dtype=np.float32)
+    norm = float(np.sqrt(np.dot(values, values)))
+    if norm > 0:
+        values /= norm
+    return (indices, values)
+
+
+# ----------------------------------------------------------------------
+# Building the Index
+# ----------------------------------------------------------------------
+def read_descriptions(filename):
+    """
+    Generator yielding (isbn_10, description) for every book with a
+    non-empty description in a book_details.csv style file.
+    """
+    with open(filename, 'r', newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        next(reader)  # skip the header
+        for row in reader:
+            if len(row) > 1 and row[1].strip():
+                yield (row[0].strip(), row[1])
+
+
+def build_index(descriptions, out_dir):
+    """
+    Builds the index for an iterable of (isbn_10, description) pairs and
+    writes it to out_dir. Returns the number of books indexed.
+    """
+    isbns = []
+    all_counts = []
+    doc_freq = np.zeros(NUM_FEATURES, dtype=np.int32)
+    for (isbn_10, description) in descriptions:
+        counts = term_counts(description)
+        isbns.append(isbn_10)
+        all_counts.append(counts)
+        doc_freq[list(counts)] += 1
+
+    num_docs = len(isbns)
+    idf = (np.log((1.0 + num_docs) / (1.0 + doc_freq)) + 1.0).astype(
+        np.float32)
+
+    indptr = np.zeros(num_docs + 1, dtype=np.int64)
+    indices = []
+    data = []
+    for (i, counts) in enumerate(all_counts):
+        (row_indices, row_values) = to_vector(counts, idf)
+        indices.append(row_indices)
+        data.append(row_values)
+        indptr[i + 1] = indptr[i] + len(row_indices)
+
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, 'indptr.npy'), indptr)
+    np.save(os.path.join(out_dir, 'indices.npy'),
+            np.concatenate(indices) if indices
+            else np.zeros(0, dtype=np.int32))
+    np.save(os.path.join(out_dir, 'data.npy'),
+            np.concatenate(data) if data else np.zeros(0, dtype=np.float32))
+    np.save(os.path.join(out_dir, 'idf.npy'), idf)
+    np.save(os.path.join(out_dir, 'isbns.npy'),
+            np.array(isbns, dtype='S10'))
+    return num_docs
+
+
+# ----------------------------------------------------------------------
+# Querying the Index
+# ----------------------------------------------------------------------
+class DescriptionIndex:
+    """
+    A memory-mapped description similarity index. Use DescriptionIndex.load
+    to open one written by build_index.
+    """
+
+    def __init__(self, matrix, idf, isbns):
+        self.matrix = matrix
+        self.idf = idf
+        self.isbns = isbns
+        self._rows = {isbn_10.decode('ascii'): i
+                      for (i, isbn_10) in enumerate(isbns)}
+
+    @classmethod
+    def load(cls, index_dir=DEFAULT_INDEX_DIR):
+        """
+        Memory-maps the index files in index_dir.
+        """
+        def mapped(name):
+            return np.load(os.path.join(index_dir, name + '.npy'),
+                           mmap_mode='r')
+
+        isbns = mapped('isbns')
+        matrix = sp.csr_matrix(
+            (mapped('data'), mapped('indices'), mapped('indptr')),
+            shape=(len(isbns), NUM_FEATURES), copy=False)
+        return cls(matrix, mapped('idf'), isbns)
+
+    def __len__(self):
+        return len(self.isbns)
+
+    def __contains__(self, isbn_10):
+        return isbn_10 in self._rows
+
+    def _top_k(self, scores, k, exclude=None):
+        """
+        Returns the (isbn_10, score) pairs of the k highest positive scores.
+        """
+        if exclude is not None:
+            scores[exclude] = 0.0
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.isbns[i].decode('ascii'), float(scores[i]))
+                for i in top if scores[i] > 0]
+
+    def similar(self, isbn_10, k=10):
+        """
+        Returns up to k (isbn_10, similarity) pairs for the books whose
+        descriptions are most similar to the given book's, most similar
+        first. Returns an empty list for books without a description.
+        """
+        row = self._rows.get(isbn_10)
+        if row is None:
+            return []
+        scores = np.asarray((self.matrix @ self.matrix[row].T).todense()
+                            ).ravel()
+        return self._top_k(scores, k, exclude=row)
+
+    def similar_to_text(self, text, k=10):
+        """
+        Returns up to k (isbn_10, similarity) pairs for the books whose
+        descriptions are most similar to an arbitrary piece of text.
+        """
+        (indices, values) = to_vector(term_counts(text), self.idf)
+        if not len(indices):
+            return []
+        query = sp.csr_matrix((values, indices, [0, len(indices)]),
+                              shape=(1, NUM_FEATURES))
+        scores = np.asarray((self.matrix @ query.T).todense()).ravel()
+        return self._top_k(scores, k)
+
+
+# ----------------------------------------------------------------------
+# Command-Line Functionality
+# ----------------------------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build',
+        help='build the index from book descriptions')
+    build_parser.add_argument('--csv', default='book_details.csv',
+        help='book details file (default: book_details.csv)')
+    build_parser.add_argument('--out', default=DEFAULT_INDEX_DIR,
+        help='index directory (default: %s)' % DEFAULT_INDEX_DIR)
+
+    similar_parser = subparsers.add_parser('similar',
+        help='print the books most similar to a book')
+    similar_parser.add_argument('isbn_10')
+    similar_parser.add_argument('--k', type=int, default=10)
+    similar_parser.add_argument('--index', default=DEFAULT_INDEX_DIR)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        start = time.perf_counter()
+        num_docs = build_index(read_descriptions(args.csv), args.out)
+        print('Indexed %d descriptions in %.2fs'
+              % (num_docs, time.perf_counter() - start))
+    elif args.command == 'similar':
+        start = time.perf_counter()
+        index = DescriptionIndex.load(args.index)
+        loaded = time.perf_counter()
+        results = index.similar(args.isbn_10, args.k)
+        done = time.perf_counter()
+        if not results:
+            print('No description indexed for isbn_10 %s' % args.isbn_10)
+            return 1
+        for (isbn_10, similarity) in results:
+            print('    ', isbn_10, '%.3f' % similarity)
+        print('(loaded in %.1f ms, queried in %.1f ms)'
+              % ((loaded - start) * 1000, (done - loaded) * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,414 @@
+"""
+Query plan advisor for the books database.
+
+Runs every query in queries.sql, and every query template in app.py (with
+representative parameters), through EXPLAIN FORMAT=JSON against a loaded
+booksdb, and flags:
+    full_scan        a table read in full (access_type ALL)
+    full_index_scan  an index read in full (access_type index)
+    filesort         rows sorted after they were read
+    temporary_table  an internal temporary table (for GROUP BY, DISTINCT,
+                     UNION etc.)
+Scans of fewer than MIN_SCAN_ROWS estimated rows, and of derived tables, are
+not flagged. For full scans, an index is suggested on the columns the
+scanned table is filtered by (equality columns first).
+
+Each plan is reduced to a fingerprint of its shape (the tables in join
+order, how each is accessed and through which index, and where it sorts or
+uses temporary tables), which doesn't change with row estimates. "save"
+records the fingerprints, costs and issues, along with the database's
+indexes; "check" compares the current plans against a saved baseline and
+exits with status 1 if any plan regressed: its fingerprint changed and it
+gained an issue, or its estimated cost grew by more than the threshold.
+
+Usage:
+    python3 explain_advisor.py report [--json]
+    python3 explain_advisor.py save [--out plan_baseline.json]
+    python3 explain_advisor.py check [--baseline plan_baseline.json]
+                                     [--cost-threshold T]
+
+Run it against a loaded booksdb (see README.md) after analyzing the tables,
+so the optimizer's estimates are realistic.
+"""
+
+import argparse
+import collections
+import hashlib
+import json
+import re
+import sys
+import time
+
+import mysql.connector
+
+import app
+from db_pool import DB_CONFIG
+from sql_scripts import read_workload
+
+DEFAULT_BASELINE = 'plan_baseline.json'
+# Estimated rows below which scans aren't worth flagging
+MIN_SCAN_ROWS = 1000
+# Growth in estimated cost counted as a regression (1.0 = doubled)
+COST_THRESHOLD = 1.0
+
+# Representative parameters for the app.py templates: the book is the one
+# app.get_isbn_10 offers for Harry Potter, and the login is a sample account
+# from setup-passwords.sql (with a wrong password, which plans the same).
+SAMPLE_ISBN = '439554934'
+APP_QUERIES = [
+    ('app search', app.SEARCH_BOOKS_FIRST_PAGE_SQL,
+     ('fantasy', 'eng', 2000, app.SEARCH_PAGE_SIZE + 1)),
+    ('app search (next page)', app.SEARCH_BOOKS_NEXT_PAGE_SQL,
+     ('fantasy', 'eng', 2000, 2010, 2010, SAMPLE_ISBN,
+      app.SEARCH_PAGE_SIZE + 1)),
+    ('app full_text_search', app.FULL_TEXT_SEARCH_SQL,
+     ('dragon',) * 6 + (app.SEARCH_LIMIT,)),
+    ('app recommend', app.RECOMMENDATION_SQL,
+     (SAMPLE_ISBN,) * 3 + (app.RECOMMENDATION_LIMIT,)),
+    ('app also_liked', app.ALSO_LIKED_SQL,
+     (SAMPLE_ISBN, app.RECOMMENDATION_LIMIT)),
+    ('app average_ratings', app.AVERAGE_RATINGS_SQL,
+     (json.dumps([SAMPLE_ISBN, '345538374']),)),
+    ('app titles', app.TITLES_SQL,
+     (json.dumps([SAMPLE_ISBN, '345538374']),)),
+    ('app books_by_author', app.BOOKS_BY_AUTHOR_SQL, ('J.K. Rowling',)),
+    ('app users_top_rated', app.USERS_TOP_RATED_FIRST_PAGE_SQL,
+     (1, app.USER_TOP_RATED_LIMIT + 1)),
+    ('app users_top_rated (next page)', app.USERS_TOP_RATED_NEXT_PAGE_SQL,
+     (1, 4, 4, SAMPLE_ISBN, app.USER_TOP_RATED_LIMIT + 1)),
+    ('app top_rated_in_timeframe', app.TOP_RATED_IN_TIMEFRAME_FIRST_PAGE_SQL,
+     (2000, 2010, app.TOP_RATED_MIN_RATINGS, app.TOP_RATED_LIMIT + 1)),
+    ('app top_rated_in_timeframe (next page)',
+     app.TOP_RATED_IN_TIMEFRAME_NEXT_PAGE_SQL,
+     (2000, 2010, app.TOP_RATED_MIN_RATINGS, '4.2', '4.2', SAMPLE_ISBN,
+      app.TOP_RATED_LIMIT + 1)),
+    ('app login', app.LOGIN_SQL, ('avidreader', '')),
+    ('app find_books_by_title', app.TITLE_LIKE_SQL,
+     ('%Potter%', app.AUTOCOMPLETE_LIMIT)),
+]
+
+# `db`.`table`.`column` references in attached conditions; an equality test
+# if followed by "="
+COLUMN_RE = re.compile(r'`\w+`\.`(\w+)`\.`(\w+)`(\s*=)?')
+# Table (and alias) after FROM or JOIN
+TABLE_ALIAS_RE = re.compile(
+    r'\b(?:FROM|JOIN)\s+`?(\w+)`?(?:\s+(?:AS\s+)?`?(\w+)`?)?', re.IGNORECASE)
+# Words which can follow a table name without being its alias
+NOT_ALIASES = {'natural', 'join', 'inner', 'left', 'right', 'cross', 'on',
+               'using', 'where', 'group', 'order', 'limit', 'having',
+               'straight_join', 'union', 'window'}
+ORDER_BY_RE = re.compile(r'\bORDER\s+BY\s+(.+?)(?:\bLIMIT\b|$)',
+                         re.IGNORECASE | re.DOTALL)
+
+
+# ----------------------------------------------------------------------
+# Plan Analysis
+# ----------------------------------------------------------------------
+def walk(node, key=None):
+    """
+    Generator yielding (key, dictionary) for every dictionary in an EXPLAIN
+    JSON document, depth first, where key is the name it appears under.
+    """
+    if isinstance(node, dict):
+        yield (key, node)
+        for (child_key, child) in node.items():
+            yield from walk(child, child_key)
+    elif isinstance(node, list):
+        for child in node:
+            yield from walk(child, key)
+
+
+def table_aliases(sql):
+    """
+    Returns a dictionary from table alias (or name) to table name for the
+    tables a statement reads.
+    """
+    aliases = {}
+    for (table, alias) in TABLE_ALIAS_RE.findall(sql):
+        if table.lower() in ('json_table', 'lateral'):
+            continue
+        aliases[table] = table
+        if alias and alias.lower() not in NOT_ALIASES:
+            aliases[alias] = table
+    return aliases
+
+
+def suggest_index(table, condition):
+    """
+    Returns the columns of table (as named in the plan) which an attached
+    condition filters on, for an index: the equality columns, then the
+    first other column. Returns an empty list if there are none.
+    """
+    equality = []
+    other = []
+    for (alias, column, equals) in COLUMN_RE.findall(condition):
+        if alias != table:
+            continue
+        target = equality if equals else other
+        if column not in equality and column not in other:
+            target.append(column)
+    return equality + other[:1]
+
+
+def analyze_plan(plan, sql):
+    """
+    Returns (tables, issues, suggestions) for an EXPLAIN FORMAT=JSON plan of
+    sql: tables is a list of (table, access_type, key, rows) in plan order,
+    issues a list of (kind, detail), and suggestions a list of CREATE INDEX
+    statements.
+    """
+    aliases = table_aliases(sql)
+    tables = []
+    issues = []
+    suggestions = []
+    for (key, node) in walk(plan):
+        if 'access_type' in node:
+            name = node.get('table_name', '?')
+            access = node['access_type']
+            rows = int(node.get('rows_examined_per_scan', 0))
+            tables.append((name, access, node.get('key'), rows))
+            derived = name.startswith('<')
+            if access == 'ALL' and rows >= MIN_SCAN_ROWS and not derived:
+                issues.append(('full_scan', '%s (~%d rows)' % (name, rows)))
+                columns = suggest_index(name, node.get('attached_condition',
+                                                       ''))
+                table = aliases.get(name, name)
+                if columns:
+                    suggestions.append('CREATE INDEX idx_%s_%s ON %s(%s)' % (
+                        table, '_'.join(columns), table, ', '.join(columns)))
+            elif access == 'index' and rows >= MIN_SCAN_ROWS and not derived:
+                issues.append(('full_index_scan', '%s via %s (~%d rows)' % (
+                    name, node.get('key'), rows)))
+        if node.get('using_filesort'):
+            issues.append(('filesort', key or 'query_block'))
+        if node.get('using_temporary_table'):
+            issues.append(('temporary_table', key or 'query_block'))
+
+    if any(kind == 'filesort' for (kind, _) in issues):
+        match = ORDER_BY_RE.search(sql)
+        if match:
+            suggestions.append('filesort: an index ending in the ORDER BY '
+                               'columns (%s) could return rows in order'
+                               % ' '.join(match.group(1).split()))
+    return (tables, issues, suggestions)
+
+
+def fingerprint(tables, issues):
+    """
+    Returns a short hash of a plan's shape: its tables with their access
+    types and keys, and the kinds and places of its issues (not row
+    estimates, which drift with the data).
+    """
+    shape = {
+        'tables': [(name, access, key) for (name, access, key, _) in tables],
+        'issues': sorted(set((kind, detail) for (kind, detail) in issues
+                             if kind in ('filesort', 'temporary_table'))),
+    }
+    return hashlib.sha1(json.dumps(shape, sort_keys=True).encode(
+        'utf-8')).hexdigest()[:16]
+
+
+def explain(cursor, sql, params=()):
+    """
+    Returns the EXPLAIN FORMAT=JSON plan of a statement as a dictionary.
+    """
+    cursor.execute('EXPLAIN FORMAT=JSON ' + sql.strip(), params)
+    (document,) = cursor.fetchone()
+    return json.loads(document)
+
+
+def workload_queries():
+    """
+    Returns (name, sql, params) for every query the advisor explains.
+    """
+    queries = [('queries.sql ' + label, sql, ())
+               for (label, sql) in read_workload('queries.sql')]
+    return queries + APP_QUERIES
+
+
+def analyze_workload(cursor):
+    """
+    Explains and analyzes every query. Returns a dictionary from query name
+    to its analysis.
+    """
+    results = collections.OrderedDict()
+    for (name, sql, params) in workload_queries():
+        try:
+            plan = explain(cursor, sql, params)
+        except mysql.connector.Error as err:
+            results[name] = {'error': str(err)}
+            continue
+        (tables, issues, suggestions) = analyze_plan(plan, sql)
+        cost = plan.get('query_block', {}).get('cost_info', {}).get(
+            'query_cost')
+        results[name] = {
+            'fingerprint': fingerprint(tables, issues),
+            'cost': float(cost) if cost is not None else None,
+            'tables': tables,
+            'issues': issues,
+            'suggestions': suggestions,
+        }
+    return results
+
+
+def database_indexes(cursor):
+    """
+    Returns the sorted "table.index(columns)" descriptions of every index in
+    the database.
+    """
+    cursor.execute("""
+        SELECT table_name, index_name,
+            GROUP_CONCAT(column_name ORDER BY seq_in_index)
+        FROM information_schema.statistics
+        WHERE table_schema = DATABASE()
+        GROUP BY table_name, index_name""")
+    return sorted('%s.%s(%s)' % row for row in cursor.fetchall())
+
+
+# ----------------------------------------------------------------------
+# Reports and Checks
+# ----------------------------------------------------------------------
+def print_report(results):
+    suggested = collections.OrderedDict()
+    for (name, result) in results.items():
+        if 'error' in result:
+            print('%s: could not explain: %s' % (name, result['error']))
+            continue
+        cost = result['cost']
+        print('%s (cost %s, plan %s)' % (
+            name, '%.1f' % cost if cost is not None else '?',
+            result['fingerprint']))
+        for (kind, detail) in result['issues']:
+            print('    %-16s %s' % (kind, detail))
+        for suggestion in result['suggestions']:
+            print('    suggest          %s' % suggestion)
+            if suggestion.startswith('CREATE INDEX'):
+                suggested.setdefault(suggestion, []).append(name)
+    if suggested:
+        print()
+        print('Suggested indexes:')
+        for (suggestion, names) in suggested.items():
+            print('    %s;  -- %s' % (suggestion, ', '.join(names)))
+
+
+def issue_counts(issues):
+    return collections.Counter(kind for (kind, _) in issues)
+
+
+def compare_plans(baseline, current, cost_threshold=COST_THRESHOLD):
+    """
+    Compares current query analyses against baseline ones. Returns a list
+    of (name, status, detail), where status is 'regressed', 'changed' or
+    'missing'; unchanged plans are left out.
+    """
+    differences = []
+    for (name, old) in baseline.items():
+        new = current.get(name)
+        if new is None or 'error' in new:
+            differences.append((name, 'missing',
+                                new['error'] if new else 'query removed'))
+            continue
+        if 'error' in old or old['fingerprint'] == new['fingerprint']:
+            continue
+        old_counts = issue_counts(old['issues'])
+        new_counts = issue_counts(new['issues'])
+        gained = [kind for kind in new_counts
+                  if new_counts[kind] > old_counts.get(kind, 0)]
+        cost_growth = (new['cost'] / old['cost'] - 1
+                       if old['cost'] and new['cost'] is not None else 0.0)
+        if gained or cost_growth > cost_threshold:
+            detail = []
+            if gained:
+                detail.append('gained %s' % ', '.join(gained))
+            if cost_growth > cost_threshold:
+                detail.append('cost %.1f -> %.1f' % (old['cost'],
+                                                     new['cost']))
+            differences.append((name, 'regressed', '; '.join(detail)))
+        else:
+            differences.append((name, 'changed', 'plan %s -> %s' % (
+                old['fingerprint'], new['fingerprint'])))
+    return differences
+
+
+def run_check(cursor, baseline_filename, cost_threshold):
+    try:
+        with open(baseline_filename) as f:
+            baseline = json.load(f)
+    except OSError as err:
+        sys.stderr.write('Could not read the baseline: %s\n' % err)
+        return 1
+    current = analyze_workload(cursor)
+    indexes = database_indexes(cursor)
+
+    old_indexes = set(baseline.get('indexes', []))
+    for index in sorted(old_indexes - set(indexes)):
+        print('index dropped: %s' % index)
+    for index in sorted(set(indexes) - old_indexes):
+        print('index added:   %s' % index)
+    differences = compare_plans(baseline['queries'], current, cost_threshold)
+    for (name, status, detail) in differences:
+        print('%-9s %s: %s' % (status, name, detail))
+    regressions = sum(1 for (_, status, _) in differences
+                      if status == 'regressed')
+    print('%d plans checked, %d changed, %d regressed' % (
+        len(current), len(differences), regressions))
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    report_parser = subparsers.add_parser('report',
+        help='print every query\'s plan issues and suggested indexes')
+    report_parser.add_argument('--json', action='store_true',
+        help='print the analyses as JSON')
+
+    save_parser = subparsers.add_parser('save',
+        help='save the plans as a baseline')
+    save_parser.add_argument('--out', default=DEFAULT_BASELINE)
+
+    check_parser = subparsers.add_parser('check',
+        help='compare the plans against a baseline')
+    check_parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    check_parser.add_argument('--cost-threshold', type=float,
+        default=COST_THRESHOLD,
+        help='cost growth counted as a regression (default: %.1f, i.e. '
+             'doubled)' % COST_THRESHOLD)
+
+    args = parser.parse_args(argv)
+
+    try:
+        conn = mysql.connector.connect(**DB_CONFIG)
+    except mysql.connector.Error as err:
+        sys.stderr.write('Could not connect to the database: %s\n' % err)
+        return 1
+
+    cursor = conn.cursor()
+    try:
+        if args.command == 'report':
+            results = analyze_workload(cursor)
+            if args.json:
+                print(json.dumps(results, indent=2))
+            else:
+                print_report(results)
+        elif args.command == 'save':
+            results = analyze_workload(cursor)
+            with open(args.out, 'w') as f:
+                json.dump({
+                    'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'indexes': database_indexes(cursor),
+                    'queries': results,
+                }, f, indent=2)
+            print('Saved %d plans to %s' % (len(results), args.out))
+        elif args.command == 'check':
+            return run_check(cursor, args.baseline, args.cost_threshold)
+    finally:
+        cursor.close()
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+"""
+Bulk ingestion of ratings, e.g. a partner's batch of millions of ratings.
+
+Ratings are inserted CHUNK_SIZE rows at a time with executemany, which the
+connector sends as a single multi-row INSERT, and every chunk is committed
+as its own transaction, so a failure only loses the chunk in progress.
+
+By default the ratings triggers maintain mv_book_stats, mv_year_book_stats
+and book_neighbors_stale once per row. With --bypass-triggers they are
+turned off for this session (see @skip_book_stats_triggers in
+setup-routines.sql); instead each chunk's ratings are summed per book and
+the sums are applied to those tables by sp_apply_book_stats_deltas, in the
+same transaction as the chunk's rows.
+
+Usage:
+    python3 ingest_ratings.py FILE [--chunk-size N] [--bypass-triggers]
+
+FILE is a CSV file of user_id,isbn_10,rating rows with a header row (the
+format of ratings.csv), or - to read from standard input.
+"""
+
+import argparse
+import csv
+import itertools
+import sys
+import time
+
+import mysql.connector
+
+from db_pool import DB_CONFIG
+
+# Rows inserted (and committed) at a time
+CHUNK_SIZE = 10000
+# Seconds between progress reports
+PROGRESS_INTERVAL = 5.0
+
+INSERT_RATINGS_SQL = """
+    INSERT INTO ratings(user_id, isbn_10, rating) VALUES (%s, %s, %s)"""
+
+# Per-book sums of a chunk's ratings, used when bypassing the triggers. The
+# temporary table is created by sp_create_book_stats_deltas and applied (and
+# emptied) by sp_apply_book_stats_deltas (see setup-routines.sql).
+INSERT_DELTAS_SQL = """
+    INSERT INTO tmp_book_stats_deltas(isbn_10, num_ratings, total_stars)
+    VALUES (%s, %s, %s)"""
+
+
+class IngestError(Exception):
+    """
+    Raised when a chunk of ratings could not be inserted. All earlier chunks
+    have been committed; rows_committed says how many rows that is.
+    """
+
+    def __init__(self, message, rows_committed):
+        super().__init__(message)
+        self.rows_committed = rows_committed
+
+
+def read_ratings_csv(f):
+    """
+    Generator yielding (user_id, isbn_10, rating) tuples from an open CSV
+    file of user_id,isbn_10,rating rows, skipping the header row.
+    """
+    reader = csv.reader(f)
+    next(reader, None)
+    for row in reader:
+        if row:
+            yield (int(row[0]), row[1].strip(), int(row[2]))
+
+
+def rating_deltas(chunk):
+    """
+    Returns a list of (isbn_10, num_ratings, total_stars) sums of a chunk of
+    (user_id, isbn_10, rating) rows, one per book.
+    """
+    deltas = {}
+    for (_, isbn_10, rating) in chunk:
+        delta = deltas.get(isbn_10)
+        if delta is None:
+            deltas[isbn_10] = [1, rating]
+        else:
+            delta[0] += 1
+            delta[1] += rating
+    return [(isbn_10, num_ratings, total_stars)
+            for (isbn_10, (num_ratings, total_stars)) in deltas.items()]
+
+
+def ingest_ratings(conn, rows, chunk_size=CHUNK_SIZE, bypass_triggers=False,
+                   progress=None):
+    """
+    Inserts an iterable of (user_id, isbn_10, rating) rows into ratings,
+    committing every chunk_size rows. If bypass_triggers is set, the ratings
+    triggers are skipped and the book stats are updated once per chunk
+    instead. progress, if given, is called with the number of rows
+    committed so far after each chunk.
+
+    Returns a dictionary with the number of rows and chunks, the elapsed
+    seconds and rows_per_second. Raises IngestError if a chunk fails (e.g.
+    a duplicate rating or an unknown isbn_10); that chunk is rolled back.
+    """
+    # A non-prepared cursor, so executemany becomes one multi-row INSERT
+    cursor = conn.cursor()
+    if bypass_triggers:
+        cursor.execute('CALL sp_create_book_stats_deltas()')
+        cursor.execute('SET @skip_book_stats_triggers = 1')
+
+    rows = iter(rows)
+    num_rows = 0
+    num_chunks = 0
+    start = time.perf_counter()
+    try:
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            try:
+                cursor.executemany(INSERT_RATINGS_SQL, chunk)
+                if bypass_triggers:
+                    cursor.executemany(INSERT_DELTAS_SQL,
+                                       rating_deltas(chunk))
+                    cursor.execute('CALL sp_apply_book_stats_deltas()')
+                conn.commit()
+            except mysql.connector.Error as err:
+                conn.rollback()
+                raise IngestError('Could not insert rows %d to %d: %s'
+                                  % (num_rows + 1, num_rows + len(chunk),
+                                     err), num_rows)
+            num_rows += len(chunk)
+            num_chunks += 1
+            if progress is not None:
+                progress(num_rows)
+    finally:
+        if bypass_triggers:
+            cursor.execute('SET @skip_book_stats_triggers = NULL')
+        cursor.close()
+
+    seconds = time.perf_counter() - start
+    return {
+        'rows': num_rows,
+        'chunks': num_chunks,
+        'seconds': seconds,
+        'rows_per_second': num_rows / seconds if seconds > 0 else 0.0,
+    }
+
+
+def progress_printer(interval=PROGRESS_INTERVAL):
+    """
+    Returns a progress callback for ingest_ratings which prints the rows
+    committed and the rate so far at most every interval seconds.
+    """
+    start = last = time.perf_counter()
+
+    def report(num_rows):
+        nonlocal last
+        now = time.perf_counter()
+        if now - last >= interval:
+            last = now
+            print('    %d rows (%.0f rows/s)'
+                  % (num_rows, num_rows / (now - start)))
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file',
+        help='CSV file of user_id,isbn_10,rating rows, or - for stdin')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+        help='rows per INSERT and transaction (default: %d)' % CHUNK_SIZE)
+    parser.add_argument('--bypass-triggers', action='store_true',
+        help='update the book stats once per chunk instead of once per row')
+    args = parser.parse_args(argv)
+
+    try:
+        conn = mysql.connector.connect(**DB_CONFIG)
+    except mysql.connector.Error as err:
+        sys.stderr.write('Could not connect to the database: %s\n' % err)
+        return 1
+
+    f = (sys.stdin if args.file == '-'
+         else open(args.file, 'r', newline='', encoding='utf-8'))
+    try:
+        result = ingest_ratings(conn, read_ratings_csv(f), args.chunk_size,
+                                args.bypass_triggers, progress_printer())
+    except IngestError as err:
+        sys.stderr.write('%s\n%d rows were committed before the error.\n'
+                         % (err, err.rows_committed))
+        return 1
+    finally:
+        if f is not sys.stdin:
+            f.close()
+        conn.close()
+
+    print('Inserted %d ratings in %d chunks in %.1fs (%.0f rows/s)'
+          % (result['rows'], result['chunks'], result['seconds'],
+             result['rows_per_second']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
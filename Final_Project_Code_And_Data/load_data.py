@@ -0,0 +1,204 @@
+"""
+Parallel loader for the books database, replacing "source load-data.sql".
+
+Runs the LOAD DATA statements from load-data.sql concurrently, one table per
+connection. Each connection turns off foreign key and unique checks and the
+per-row ratings triggers (@skip_book_stats_triggers) for its own session,
+and the table's secondary indexes from setup.sql are dropped before its load
+and re-created afterwards, so they are built once by sorting instead of
+being updated row by row. Indexes which a foreign key relies on can't be
+dropped and are left in place. Once every table is loaded, the materialized
+book stats are rebuilt with sp_rebuild_book_stats.
+
+Usage:
+    python3 load_data.py [--workers N] [--truncate]
+
+Run it from this directory (the CSV paths in load-data.sql are relative)
+after sourcing setup.sql, and ideally setup-routines.sql. The server must
+allow LOAD DATA LOCAL (local_infile=ON). Rebuild book_neighbors afterwards
+with build_book_neighbors.py.
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import mysql.connector
+import mysql.connector.errorcode as errorcode
+
+from db_pool import DB_CONFIG
+from sql_scripts import index_definitions, load_data_statements
+
+SESSION_SETUP_SQL = [
+    'SET foreign_key_checks = 0',
+    'SET unique_checks = 0',
+    'SET @skip_book_stats_triggers = 1',
+]
+
+
+def connect():
+    """
+    Opens a connection which may send local files for LOAD DATA LOCAL.
+    """
+    return mysql.connector.connect(allow_local_infile=True, **DB_CONFIG)
+
+
+def drop_indexes(cursor, indexes):
+    """
+    Drops the given (index_name, table_name, kind, statement) indexes,
+    returning the ones which were dropped (and so must be re-created).
+    """
+    dropped = []
+    for index in indexes:
+        (name, table, _, _) = index
+        try:
+            cursor.execute('ALTER TABLE %s DROP INDEX %s' % (table, name))
+        except mysql.connector.Error as err:
+            if err.errno == errorcode.ER_DROP_INDEX_FK:
+                # A foreign key relies on this index; keep it
+                continue
+            if err.errno == errorcode.ER_CANT_DROP_FIELD_OR_KEY:
+                # Not there (e.g. a previous load failed), but re-create it
+                dropped.append(index)
+                continue
+            raise
+        dropped.append(index)
+    return dropped
+
+
+def load_table(table, data_filename, statement, indexes, truncate=False):
+    """
+    Loads one table over its own connection, deferring its secondary
+    indexes. Returns a dictionary of the table's load statistics.
+    """
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        for sql in SESSION_SETUP_SQL:
+            cursor.execute(sql)
+        if truncate:
+            cursor.execute('TRUNCATE TABLE %s' % table)
+        dropped = drop_indexes(cursor, indexes)
+
+        start = time.perf_counter()
+        cursor.execute(statement)
+        rows = cursor.rowcount
+        conn.commit()
+        load_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for (_, _, _, index_sql) in dropped:
+            cursor.execute(index_sql)
+        index_seconds = time.perf_counter() - start
+    finally:
+        cursor.close()
+        conn.close()
+
+    return {
+        'table': table,
+        'rows': rows,
+        'bytes': os.path.getsize(data_filename),
+        'load_seconds': load_seconds,
+        'indexes': len(dropped),
+        'index_seconds': index_seconds,
+    }
+
+
+def rebuild_stats():
+    """
+    Rebuilds mv_book_stats and mv_year_book_stats from the loaded ratings.
+    Returns the seconds taken, or None if setup-routines.sql hasn't been
+    sourced yet (it populates the stats itself).
+    """
+    conn = connect()
+    cursor = conn.cursor()
+    try:
+        start = time.perf_counter()
+        cursor.execute('CALL sp_rebuild_book_stats()')
+        conn.commit()
+        return time.perf_counter() - start
+    except mysql.connector.Error as err:
+        if err.errno == errorcode.ER_SP_DOES_NOT_EXIST:
+            return None
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def print_result(result):
+    """
+    Prints one table's line of the throughput report.
+    """
+    seconds = result['load_seconds']
+    print('%-14s %10d %9.1f %9.2f %12.0f %8.1f %9.2f (%d)' % (
+        result['table'], result['rows'], result['bytes'] / 1e6, seconds,
+        result['rows'] / seconds if seconds else 0.0,
+        result['bytes'] / 1e6 / seconds if seconds else 0.0,
+        result['index_seconds'], result['indexes']))
+
+
+def load_all(workers, truncate=False):
+    """
+    Loads every table in load-data.sql, up to workers tables at a time, and
+    rebuilds the book stats, printing per-table throughput. Returns True if
+    everything loaded.
+    """
+    loads = load_data_statements('load-data.sql')
+    indexes = index_definitions('setup.sql')
+    missing = [load[1] for load in loads if not os.path.exists(load[1])]
+    if missing:
+        sys.stderr.write('Missing data files: %s\n' % ', '.join(missing))
+        return False
+    # Start the biggest files first, so they don't finish last on their own
+    loads.sort(key=lambda load: os.path.getsize(load[1]), reverse=True)
+
+    print('%-14s %10s %9s %9s %12s %8s %9s' % (
+        'table', 'rows', 'MB', 'load (s)', 'rows/s', 'MB/s', 'index (s)'))
+    start = time.perf_counter()
+    ok = True
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(load_table, table, data_filename, statement,
+                            [index for index in indexes if index[1] == table],
+                            truncate): table
+            for (table, data_filename, statement) in loads
+        }
+        for future in as_completed(futures):
+            try:
+                print_result(future.result())
+            except (mysql.connector.Error, OSError) as err:
+                sys.stderr.write('Could not load %s: %s\n'
+                                 % (futures[future], err))
+                ok = False
+    print('Finished loading in %.1fs' % (time.perf_counter() - start))
+
+    if ok:
+        seconds = rebuild_stats()
+        if seconds is None:
+            print('Book stats not rebuilt: source setup-routines.sql next.')
+        else:
+            print('Rebuilt book stats in %.1fs' % seconds)
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=6,
+        help='tables loaded at once (default: 6, i.e. all of them)')
+    parser.add_argument('--truncate', action='store_true',
+        help='empty each table before loading it')
+    args = parser.parse_args(argv)
+
+    try:
+        return 0 if load_all(args.workers, args.truncate) else 1
+    except mysql.connector.Error as err:
+        sys.stderr.write('Database error: %s\n' % err)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,290 @@
+"""
+Concurrent load driver: simulates many app.py sessions at once.
+
+Each simulated session is a thread which logs in, holds one pooled
+connection for the rest of its session (as app.main does), and then runs
+operations from workload.py picked at random according to a mix, waiting a
+random think time (exponentially distributed around --think-time) between
+them. Reader sessions use the reader menu's operations (searching, rating,
+adding to-read books, recommendations); retailer sessions use the admin
+menu's reports.
+
+At the end, the driver prints throughput and p50/p95/p99 latency for each
+operation, and the errors, lock wait timeouts and deadlocks each one hit,
+together with the server's InnoDB row lock statistics over the run.
+
+Usage:
+    python3 load_driver.py [--sessions N] [--retailers FRACTION]
+                           [--duration SECONDS] [--think-time SECONDS]
+                           [--reader-mix NAME=WEIGHT,...]
+                           [--retailer-mix NAME=WEIGHT,...]
+                           [--seed S] [--cache] [--out FILE]
+
+Rating and to-read operations write rows for synthetic users; remove them
+afterwards with "python3 benchmark.py synth-clean".
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+
+import mysql.connector
+import mysql.connector.errorcode as errorcode
+
+import app
+import workload
+from metrics import percentile
+
+# Default operation mixes (operation name -> relative weight)
+READER_MIX = {
+    'search': 30,
+    'full_text_search': 20,
+    'recommend': 20,
+    'popular_series': 10,
+    'rate': 10,
+    'add_to_read': 10,
+}
+RETAILER_MIX = {
+    'users_top_rated': 50,
+    'top_rated_in_timeframe': 50,
+}
+OPERATIONS = dict(workload.READ_OPERATIONS, **workload.WRITE_OPERATIONS)
+# Server status counters reported for the run
+LOCK_STATUS_VARIABLES = ['Innodb_row_lock_waits', 'Innodb_row_lock_time',
+                         'Innodb_deadlocks']
+
+
+class OperationStats:
+    """
+    Latencies and error counts of one operation, for one session or (once
+    merged) for the whole run.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.lock_wait_timeouts = 0
+        self.deadlocks = 0
+
+    def record_error(self, err):
+        self.errors += 1
+        if err.errno == errorcode.ER_LOCK_WAIT_TIMEOUT:
+            self.lock_wait_timeouts += 1
+        elif err.errno == errorcode.ER_LOCK_DEADLOCK:
+            self.deadlocks += 1
+
+    def merge(self, other):
+        self.latencies.extend(other.latencies)
+        self.errors += other.errors
+        self.lock_wait_timeouts += other.lock_wait_timeouts
+        self.deadlocks += other.deadlocks
+
+    def summary(self, duration):
+        """
+        Returns a dictionary of this operation's results over a run of
+        duration seconds.
+        """
+        latencies = self.latencies
+        return {
+            'count': len(latencies),
+            'errors': self.errors,
+            'lock_wait_timeouts': self.lock_wait_timeouts,
+            'deadlocks': self.deadlocks,
+            'ops_per_second': len(latencies) / duration,
+            'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+            'p95_ms': percentile(latencies, 95) * 1000 if latencies else None,
+            'p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+        }
+
+
+def parse_mix(text, default):
+    """
+    Parses "name=weight,..." into a mix dictionary, or returns default if
+    text is empty.
+    """
+    if not text:
+        return default
+    mix = {}
+    for item in text.split(','):
+        (name, weight) = item.split('=')
+        if name not in OPERATIONS:
+            raise ValueError('unknown operation %s' % name)
+        mix[name] = float(weight)
+    return mix
+
+
+def run_session(data, mix, think_time, stop, seed, stats):
+    """
+    Runs one simulated session until stop is set, recording into stats (a
+    dictionary from operation name to OperationStats).
+    """
+    rng = random.Random(seed)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+
+    def timed(name, operation):
+        op_stats = stats.setdefault(name, OperationStats())
+        start = time.perf_counter()
+        try:
+            operation(data, rng)
+        except mysql.connector.Error as err:
+            op_stats.record_error(err)
+            return
+        op_stats.latencies.append(time.perf_counter() - start)
+
+    # Start sessions at different times, as real users would
+    stop.wait(rng.uniform(0, think_time))
+    with app.pool.session():
+        timed('login', workload.op_login)
+        while not stop.is_set():
+            name = rng.choices(names, weights)[0]
+            timed(name, OPERATIONS[name])
+            if think_time > 0:
+                stop.wait(rng.expovariate(1.0 / think_time))
+
+
+def lock_status():
+    """
+    Returns the server's LOCK_STATUS_VARIABLES as a dictionary.
+    """
+    rows = app.execute_sql_query(
+        'SHOW GLOBAL STATUS WHERE Variable_name IN (%s)'
+        % ', '.join(['%s'] * len(LOCK_STATUS_VARIABLES)),
+        'Could not read server status.', tuple(LOCK_STATUS_VARIABLES))
+    return {name: int(value) for (name, value) in rows}
+
+
+def run_load(sessions, retailers, duration, think_time, reader_mix,
+             retailer_mix, seed):
+    """
+    Runs the simulated sessions for duration seconds. Returns a dictionary
+    of results per operation and in total, with the server's lock counters
+    and the connection pool's wait statistics over the run.
+    """
+    data = workload.WorkloadData.load()
+    num_retailers = int(round(sessions * retailers))
+    stop = threading.Event()
+    session_stats = []
+    threads = []
+    for i in range(sessions):
+        stats = {}
+        session_stats.append(stats)
+        mix = retailer_mix if i < num_retailers else reader_mix
+        threads.append(threading.Thread(
+            target=run_session, daemon=True,
+            args=(data, mix, think_time, stop, '%s:%d' % (seed, i), stats)))
+
+    status_before = lock_status()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    stop.wait(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    status_after = lock_status()
+    pool_stats = app.pool.stats()
+
+    merged = {}
+    total = OperationStats()
+    for stats in session_stats:
+        for (name, op_stats) in stats.items():
+            merged.setdefault(name, OperationStats()).merge(op_stats)
+            total.merge(op_stats)
+    return {
+        'settings': {'sessions': sessions, 'retailer_sessions': num_retailers,
+                     'duration': duration, 'think_time': think_time,
+                     'reader_mix': reader_mix, 'retailer_mix': retailer_mix,
+                     'seed': seed},
+        'elapsed_seconds': elapsed,
+        'operations': {name: op_stats.summary(elapsed)
+                       for (name, op_stats) in sorted(merged.items())},
+        'total': total.summary(elapsed),
+        'server': {name: status_after[name] - status_before.get(name, 0)
+                   for name in status_after},
+        'pool': {name: pool_stats[name]
+                 for name in ('avg_wait_seconds', 'max_wait_seconds',
+                              'timeouts', 'peak_in_use')},
+    }
+
+
+def print_results(results):
+    def ms(value):
+        return '%10.2f' % value if value is not None else '%10s' % '-'
+
+    print('%-24s %8s %9s %10s %10s %10s %7s %6s %9s' % (
+        'operation', 'count', 'ops/s', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)',
+        'errors', 'lock', 'deadlock'))
+    rows = list(results['operations'].items()) + [('total',
+                                                   results['total'])]
+    for (name, r) in rows:
+        print('%-24s %8d %9.1f %s %s %s %7d %6d %9d' % (
+            name, r['count'], r['ops_per_second'], ms(r['p50_ms']),
+            ms(r['p95_ms']), ms(r['p99_ms']), r['errors'],
+            r['lock_wait_timeouts'], r['deadlocks']))
+    print()
+    print('Server: %s' % ', '.join('%s=%d' % item
+                                   for item in results['server'].items()))
+    pool = results['pool']
+    print('Pool: %.1f ms average wait, %.1f ms max wait, %d timeouts, '
+          '%d connections in use at peak' % (
+              pool['avg_wait_seconds'] * 1000, pool['max_wait_seconds'] * 1000,
+              pool['timeouts'], pool['peak_in_use']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=20,
+        help='concurrent sessions (default: 20)')
+    parser.add_argument('--retailers', type=float, default=0.1,
+        help='fraction of sessions which are retailers (default: 0.1)')
+    parser.add_argument('--duration', type=float, default=60.0,
+        help='seconds to run for (default: 60)')
+    parser.add_argument('--think-time', type=float, default=1.0,
+        help='mean seconds between a session\'s operations (default: 1; '
+             '0 runs operations back to back)')
+    parser.add_argument('--reader-mix',
+        help='reader operation weights, e.g. search=50,rate=50')
+    parser.add_argument('--retailer-mix',
+        help='retailer operation weights, e.g. users_top_rated=1')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache', action='store_true',
+        help='use the query result cache')
+    parser.add_argument('--out', help='save the results as JSON')
+    args = parser.parse_args(argv)
+
+    try:
+        reader_mix = parse_mix(args.reader_mix, READER_MIX)
+        retailer_mix = parse_mix(args.retailer_mix, RETAILER_MIX)
+    except ValueError as err:
+        parser.error(str(err))
+
+    # One connection per session, plus one for the status queries
+    app.POOL_SIZE = args.sessions + 1
+    app.RAISE_ERRORS = True
+    try:
+        app.init_app(use_result_cache=args.cache)
+    except mysql.connector.Error as err:
+        sys.stderr.write('Could not connect to the database: %s\n' % err)
+        return 1
+    try:
+        results = run_load(args.sessions, args.retailers, args.duration,
+                           args.think_time, reader_mix, retailer_mix,
+                           args.seed)
+    finally:
+        app.pool.close()
+
+    print_results(results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
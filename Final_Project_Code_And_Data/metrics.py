@@ -0,0 +1,412 @@
+"""
+Instrumentation for the application's database access.
+
+app.py records every statement it runs into a Metrics registry: a latency
+histogram, rows and (approximate) bytes fetched, and errors, per distinct
+statement. Statements run inside an operation block (a menu option, a
+commands.py command) are also added up per operation, whose latency
+histogram gets one observation per call. Statements slower than
+a threshold are written to a slow-query log as JSON lines, with their bound
+parameters (except for statements on user_info, whose parameters are
+passwords). One operation can also be run under cProfile and tracemalloc.
+
+The registry can be exported as JSON (snapshot) or in the Prometheus text
+format (prometheus_text).
+"""
+
+import bisect
+import contextlib
+import cProfile
+import functools
+import hashlib
+import io
+import json
+import math
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+from result_cache import normalize_sql
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Characters of a statement's text kept in snapshots and the slow-query log
+SQL_TEXT_LENGTH = 200
+# Statements whose parameters are never logged
+REDACTED_SQL_RE = re.compile(r'\b(?:user_info|sp_add_user|sp_change_password'
+                             r'|authenticate\w*)\b', re.IGNORECASE)
+# Lines of cProfile and tracemalloc output kept in a profile report
+PROFILE_LINES = 25
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_id(sql):
+    """
+    Returns a short stable identifier for a statement, for metric labels.
+    """
+    return hashlib.sha1(normalize_sql(sql).encode('utf-8')).hexdigest()[:12]
+
+
+def estimate_bytes(rows):
+    """
+    Returns the approximate number of bytes of data in a list of row tuples:
+    the length of each string value, and 8 bytes for any other value.
+    """
+    size = 0
+    for row in rows:
+        for value in row:
+            if isinstance(value, (str, bytes, bytearray)):
+                size += len(value)
+            elif value is not None:
+                size += 8
+    return size
+
+
+def percentile(latencies, pct):
+    """
+    Returns the pct-th percentile (0-100) of a list of latencies, using the
+    nearest-rank method.
+    """
+    ordered = sorted(latencies)
+    rank = max(0, min(len(ordered) - 1,
+                      math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+class Histogram:
+    """
+    A cumulative-bucket latency histogram, as in Prometheus.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # counts[i] is the number of observations in bucket i (not
+        # cumulative); the last count is for observations above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Returns an upper bound for the q-th quantile (0 to 1): the upper
+        bound of the bucket it falls in, or None if there are no
+        observations (or it is above every bucket).
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for (bound, count) in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum_seconds': self.sum,
+            'mean_ms': self.sum / self.count * 1000 if self.count else None,
+            'p50_ms_le': _ms(self.quantile(0.5)),
+            'p95_ms_le': _ms(self.quantile(0.95)),
+            'p99_ms_le': _ms(self.quantile(0.99)),
+            'buckets': {str(bound): count for (bound, count)
+                        in zip(self.buckets + ('+Inf',), self.counts)},
+        }
+
+
+def _ms(seconds):
+    return seconds * 1000 if seconds is not None else None
+
+
+class StatementStats:
+    """
+    What one distinct statement (or every statement of one operation) did.
+    """
+
+    def __init__(self, sql=None):
+        self.sql = sql
+        self.latency = Histogram()
+        self.rows = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def snapshot(self):
+        snapshot = {
+            'latency': self.latency.snapshot(),
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'errors': self.errors,
+        }
+        if self.sql is not None:
+            snapshot['sql'] = self.sql
+        return snapshot
+
+
+class OperationStats:
+    """
+    The calls of one operation. latency has one observation per call: the
+    time spent in statements during the call (so it doesn't include
+    prompts), including those of operations nested in it. rows, bytes and
+    errors add up the statements run directly inside the operation.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.latency = Histogram()
+        self.rows = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def snapshot(self):
+        return {
+            'calls': self.calls,
+            'latency': self.latency.snapshot(),
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'errors': self.errors,
+        }
+
+
+class _OperationCall:
+    """
+    One call of an operation in progress.
+    """
+
+    def __init__(self, name, stats):
+        self.name = name
+        self.stats = stats
+        # Seconds spent in statements so far
+        self.seconds = 0.0
+
+
+class Metrics:
+    """
+    A thread-safe registry of statement and operation metrics.
+
+    Usage:
+        metrics = Metrics(slow_query_seconds=0.2, slow_query_log=sys.stderr)
+        with metrics.operation('search'):
+            start = time.perf_counter()
+            ... run a statement ...
+            metrics.record_statement(sql, params,
+                time.perf_counter() - start, rows, estimate_bytes(rows))
+    """
+
+    def __init__(self, slow_query_seconds=None, slow_query_log=None,
+                 profile_operation=None, profile_dir='.'):
+        """
+        slow_query_seconds: statements taking at least this long are logged
+            to slow_query_log (a file object), if both are given.
+        profile_operation: the name of an operation to run under cProfile
+            and tracemalloc; reports are written to profile_dir.
+        """
+        self.slow_query_seconds = slow_query_seconds
+        self.slow_query_log = slow_query_log
+        self.profile_operation = profile_operation
+        self.profile_dir = profile_dir
+        self.statements = {}
+        self.operations = {}
+        self.slow_queries = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+        # Stack of the _OperationCalls the current thread is inside
+        self._local = threading.local()
+
+    def _operation_calls(self):
+        """
+        Returns the stack of operation calls the current thread is inside,
+        innermost last.
+        """
+        stack = getattr(self._local, 'operations', None)
+        if stack is None:
+            stack = self._local.operations = []
+        return stack
+
+    def record_statement(self, sql, params, seconds, rows, num_bytes,
+                         error=False):
+        """
+        Records one execution of a statement (and its fetches).
+        """
+        key = statement_id(sql)
+        calls = self._operation_calls()
+        # Only this thread touches its calls, so they don't need the lock
+        for call in calls:
+            call.seconds += seconds
+        operation_name = calls[-1].name if calls else None
+        with self._lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = StatementStats(
+                    normalize_sql(sql)[:SQL_TEXT_LENGTH])
+            stats.latency.observe(seconds)
+            targets = [stats] + ([calls[-1].stats] if calls else [])
+            for target in targets:
+                target.rows += rows
+                target.bytes += num_bytes
+                target.errors += 1 if error else 0
+            slow = (self.slow_query_seconds is not None
+                    and seconds >= self.slow_query_seconds)
+            if slow:
+                self.slow_queries += 1
+        if slow and self.slow_query_log is not None:
+            self.log_slow_query(key, sql, params, seconds, rows, error,
+                                operation_name)
+
+    def log_slow_query(self, key, sql, params, seconds, rows, error,
+                       operation_name):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'statement': key,
+            'seconds': round(seconds, 6),
+            'rows': rows,
+            'error': error,
+            'operation': operation_name,
+            'sql': normalize_sql(sql),
+            'params': (None if REDACTED_SQL_RE.search(sql)
+                       else [str(value) if not isinstance(value, (int, float))
+                             else value for value in params]),
+        }
+        with self._lock:
+            self.slow_query_log.write(json.dumps(entry) + '\n')
+            self.slow_query_log.flush()
+
+    @contextlib.contextmanager
+    def operation(self, name):
+        """
+        Context manager attributing the statements run by this thread inside
+        it to the operation called name, and recording the time they took
+        as one observation of the operation's latency when the block exits.
+        Operations may nest: statements count towards the rows, bytes and
+        errors of the innermost one, and towards the time of all of them.
+        """
+        with self._lock:
+            stats = self.operations.get(name)
+            if stats is None:
+                stats = self.operations[name] = OperationStats()
+            stats.calls += 1
+        call = _OperationCall(name, stats)
+        calls = self._operation_calls()
+        calls.append(call)
+        try:
+            if name == self.profile_operation:
+                with self.profiled(name):
+                    yield
+            else:
+                yield
+        finally:
+            calls.pop()
+            with self._lock:
+                stats.latency.observe(call.seconds)
+
+    @contextlib.contextmanager
+    def profiled(self, name):
+        """
+        Runs the block under cProfile and tracemalloc, then writes the
+        profile (<name>-<time>.prof, for pstats or snakeviz) and a text
+        report of the slowest functions and largest allocations
+        (<name>-<time>.txt) to profile_dir.
+        """
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            after = tracemalloc.take_snapshot()
+            (_, peak) = tracemalloc.get_traced_memory()
+            if not tracing:
+                tracemalloc.stop()
+
+            base = os.path.join(self.profile_dir, '%s-%s' % (
+                re.sub(r'\W+', '_', name), time.strftime('%Y%m%d-%H%M%S')))
+            profiler.dump_stats(base + '.prof')
+            report = io.StringIO()
+            stats = pstats.Stats(profiler, stream=report)
+            stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+            report.write('Peak traced memory: %d bytes\n' % peak)
+            report.write('Largest allocations:\n')
+            for stat in after.compare_to(before, 'lineno')[:PROFILE_LINES]:
+                report.write('  %s\n' % stat)
+            with open(base + '.txt', 'w') as f:
+                f.write(report.getvalue())
+            sys.stderr.write('Profile of %s written to %s.txt\n'
+                             % (name, base))
+
+    def snapshot(self):
+        """
+        Returns every metric as a JSON-serializable dictionary.
+        """
+        with self._lock:
+            return {
+                'uptime_seconds': time.time() - self.started,
+                'slow_queries': self.slow_queries,
+                'statements': {key: stats.snapshot() for (key, stats)
+                               in self.statements.items()},
+                'operations': {name: stats.snapshot() for (name, stats)
+                               in sorted(self.operations.items())},
+            }
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def prometheus_text(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def histogram(metric, labels, latency):
+            cumulative = 0
+            for (bound, count) in zip(latency.buckets + ('+Inf',),
+                                      latency.counts):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%s"} %d'
+                             % (metric, labels, bound, cumulative))
+            lines.append('%s_sum{%s} %f' % (metric, labels, latency.sum))
+            lines.append('%s_count{%s} %d' % (metric, labels, latency.count))
+
+        with self._lock:
+            groups = [
+                ('statement', 'booksdb_statement',
+                 [(key, stats) for (key, stats)
+                  in sorted(self.statements.items())]),
+                ('operation', 'booksdb_operation',
+                 sorted(self.operations.items())),
+            ]
+            for (label, prefix, items) in groups:
+                lines.append('# TYPE %s_seconds histogram' % prefix)
+                for (name, stats) in items:
+                    histogram(prefix + '_seconds', '%s="%s"' % (label, name),
+                              stats.latency)
+                for (suffix, attribute) in [('rows', 'rows'),
+                                            ('bytes', 'bytes'),
+                                            ('errors', 'errors')]:
+                    lines.append('# TYPE %s_%s_total counter'
+                                 % (prefix, suffix))
+                    for (name, stats) in items:
+                        lines.append('%s_%s_total{%s="%s"} %d' % (
+                            prefix, suffix, label, name,
+                            getattr(stats, attribute)))
+            lines.append('# TYPE booksdb_operation_calls_total counter')
+            for (name, stats) in sorted(self.operations.items()):
+                lines.append('booksdb_operation_calls_total{operation="%s"} %d'
+                             % (name, stats.calls))
+            lines.append('# TYPE booksdb_slow_queries_total counter')
+            lines.append('booksdb_slow_queries_total %d' % self.slow_queries)
+        return '\n'.join(lines) + '\n'
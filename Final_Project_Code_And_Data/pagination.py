@@ -0,0 +1,89 @@
+"""
+Opaque cursors for keyset ("seek") pagination.
+
+A paged query orders its rows by a unique key (e.g. rating DESC, isbn_10)
+and fetches one page at a time. Rather than skipping rows with OFFSET, which
+reads and throws away every earlier page, the next page starts from the key
+of the last row shown:
+    WHERE ... AND (rating < %s OR (rating = %s AND isbn_10 > %s))
+    ORDER BY rating DESC, isbn_10
+    LIMIT %s
+so with an index in that order every page costs the same as the first.
+
+A cursor holds that key, the kind of list it belongs to, and a hash of the
+list's filters (so a cursor from one search can't be used to page through
+another), encoded as a URL-safe string. Cursors are stable: rows added or
+removed before the cursor don't shift later pages.
+
+Usage:
+    (rows, next_cursor) = split_page(rows, page_size, 'search', filters,
+                                     lambda row: (row[2], row[0]))
+    ...
+    (year, isbn_10) = decode_cursor(next_cursor, 'search', filters,
+                                    (int, str))
+"""
+
+import base64
+import binascii
+import decimal
+import hashlib
+import json
+
+
+class CursorError(ValueError):
+    """
+    A cursor which is malformed, or belongs to a different list.
+    """
+
+
+def filters_digest(filters):
+    """
+    Returns a short hash of the filter values a list was fetched with.
+    """
+    return hashlib.sha1(json.dumps([str(value) for value in filters]).encode(
+        'utf-8')).hexdigest()[:8]
+
+
+def encode_cursor(kind, filters, key):
+    """
+    Returns the cursor for the page after the row with this key, in the list
+    of the given kind fetched with the given filters.
+    """
+    payload = json.dumps([kind, filters_digest(filters),
+                          [str(value) for value in key]],
+                         separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode(
+        'ascii').rstrip('=')
+
+
+def decode_cursor(cursor, kind, filters, types):
+    """
+    Returns the key values held by a cursor, converted with types (one
+    function per key column, e.g. (int, str)). Raises CursorError if the
+    cursor is malformed or was made for a different list.
+    """
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        (cursor_kind, digest, key) = json.loads(payload.decode('utf-8'))
+        if cursor_kind != kind or digest != filters_digest(filters):
+            raise CursorError('cursor is for a different list')
+        if len(key) != len(types):
+            raise CursorError('invalid cursor')
+        return tuple(convert(value) for (convert, value) in zip(types, key))
+    except CursorError:
+        raise
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError,
+            decimal.InvalidOperation):
+        raise CursorError('invalid cursor')
+
+
+def split_page(rows, page_size, kind, filters, key):
+    """
+    Splits the rows fetched for a page (up to page_size + 1 of them, the
+    extra row only showing that there is another page) into (page rows,
+    cursor for the next page or None). key(row) returns a row's key values.
+    """
+    if len(rows) <= page_size:
+        return (rows, None)
+    rows = rows[:page_size]
+    return (rows, encode_cursor(kind, filters, key(rows[-1])))
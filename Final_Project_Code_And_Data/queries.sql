@@ -126,10 +126,11 @@ SELECT genre, orig_title FROM
 
 -- [Query 11]
 -- Get top rated books within a specific timeframe 
-SELECT isbn_10, AVG(rating) AS avg_rating
-    FROM ratings NATURAL JOIN books
+-- (Reads the publication-year keyed rollup from setup-routines.sql instead of
+-- averaging every rating of every book in the timeframe.)
+SELECT isbn_10, total_stars / num_ratings AS avg_rating
+    FROM mv_year_book_stats
     WHERE orig_publication_yr > 2000 AND orig_publication_yr < 2005
-    GROUP BY isbn_10
     ORDER BY avg_rating DESC;
 
 -- [Query 12]
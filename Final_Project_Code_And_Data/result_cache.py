@@ -0,0 +1,234 @@
+"""
+An in-process cache of query results for the books database application.
+
+Results are cached per (statement, parameters) for at most a time-to-live,
+and the cache holds a bounded number of entries, evicting the least recently
+used. Every cached result remembers which tables its statement reads, and
+when the application writes to a table (see invalidate_for), every cached
+result which reads that table is dropped, so the application never sees its
+own writes missing from a cached result.
+
+Writes made by other processes (other app sessions, offline builders) are
+not seen by this cache; the time-to-live bounds how stale a result can get.
+"""
+
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# Names which follow FROM or JOIN in a statement
+READ_TABLES_RE = re.compile(r'\b(?:FROM|JOIN)\s+`?(\w+)`?', re.IGNORECASE)
+# Names of common table expressions (WITH name AS (...)), which are not tables
+CTE_NAMES_RE = re.compile(r'(?:\bWITH|,)\s*(\w+)\s+AS\s*\(', re.IGNORECASE)
+# The table an INSERT, REPLACE, UPDATE, DELETE or TRUNCATE writes to
+WRITE_TABLE_RE = re.compile(
+    r'^\s*(?:INSERT(?:\s+IGNORE)?\s+INTO|REPLACE\s+INTO|UPDATE'
+    r'|DELETE\s+FROM|TRUNCATE(?:\s+TABLE)?)\s+`?(\w+)`?', re.IGNORECASE)
+
+# Views, and the tables they read
+VIEW_TABLES = {
+    'book_stats': {'mv_book_stats'},
+}
+# Tables whose triggers also write to other tables (see setup-routines.sql)
+TRIGGER_WRITES = {
+    'ratings': {'mv_book_stats', 'mv_year_book_stats', 'book_neighbors_stale'},
+    'books': {'mv_year_book_stats'},
+}
+
+
+def normalize_sql(sql):
+    """
+    Collapses runs of whitespace so that the same statement formatted
+    differently shares a cache key.
+    """
+    return ' '.join(sql.split())
+
+
+def tables_read(sql):
+    """
+    Returns the set of (lower-case) tables a query reads, with views
+    expanded to the tables behind them.
+    """
+    ctes = {name.lower() for name in CTE_NAMES_RE.findall(sql)}
+    tables = set()
+    for name in READ_TABLES_RE.findall(sql):
+        name = name.lower()
+        if name in ctes or name == 'json_table':
+            continue
+        tables.add(name)
+        tables.update(VIEW_TABLES.get(name, ()))
+    return tables
+
+
+def tables_written(sql):
+    """
+    Returns the set of tables a command writes to, including tables written
+    by triggers, or None if this can't be told from the statement (e.g. a
+    CALL to a stored procedure).
+    """
+    match = WRITE_TABLE_RE.match(sql)
+    if not match:
+        return None
+    table = match.group(1).lower()
+    return {table} | TRIGGER_WRITES.get(table, set())
+
+
+def estimate_size(rows):
+    """
+    Returns a rough estimate of the memory used by a list of row tuples, in
+    bytes.
+    """
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for value in row:
+            size += sys.getsizeof(value)
+    return size
+
+
+class CacheEntry:
+    """
+    One cached result.
+    """
+
+    def __init__(self, rows, tables, expires, size):
+        self.rows = rows
+        self.tables = tables
+        self.expires = expires
+        self.size = size
+
+
+class ResultCache:
+    """
+    A bounded LRU + TTL cache of query results with table-level
+    invalidation. Safe to share between threads.
+    """
+
+    def __init__(self, max_entries=256, ttl=300.0, max_rows=10000):
+        """
+        max_entries: maximum number of cached results.
+        ttl: seconds a result stays valid.
+        max_rows: results with more rows than this are not cached.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self._entries = OrderedDict()
+        # Table -> set of keys of entries which read it
+        self._by_table = {}
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'expirations': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+
+    @staticmethod
+    def make_key(sql, params):
+        return (normalize_sql(sql), tuple(params))
+
+    def _remove(self, key):
+        """
+        Removes an entry. Must be called with the lock held.
+        """
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        for table in entry.tables:
+            keys = self._by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_table[table]
+
+    def get(self, sql, params=()):
+        """
+        Returns the cached rows for a query, or None if there are none (or
+        they have expired).
+        """
+        key = self.make_key(sql, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            if entry.expires <= time.monotonic():
+                self._remove(key)
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry.rows
+
+    def put(self, sql, params, rows):
+        """
+        Caches the rows of a query, unless there are more than max_rows.
+        """
+        if len(rows) > self.max_rows:
+            return
+        key = self.make_key(sql, params)
+        rows = list(rows)
+        entry = CacheEntry(rows, tables_read(sql),
+                           time.monotonic() + self.ttl, estimate_size(rows))
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            for table in entry.tables:
+                self._by_table.setdefault(table, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def invalidate_tables(self, tables):
+        """
+        Drops every cached result which reads one of the given tables.
+        """
+        with self._lock:
+            keys = set()
+            for table in tables:
+                keys.update(self._by_table.get(table.lower(), ()))
+            for key in keys:
+                self._remove(key)
+            self._stats['invalidations'] += len(keys)
+
+    def invalidate_for(self, sql):
+        """
+        Drops every cached result which may be out of date after executing
+        the given command. Commands whose writes can't be determined (such as
+        procedure calls) clear the whole cache.
+        """
+        tables = tables_written(sql)
+        if tables is None:
+            self.clear()
+        else:
+            self.invalidate_tables(tables)
+
+    def clear(self):
+        """
+        Drops every cached result.
+        """
+        with self._lock:
+            self._stats['invalidations'] += len(self._entries)
+            self._entries.clear()
+            self._by_table.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Returns a dictionary of cache statistics, including the hit rate and
+        estimated memory use.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / float(lookups) if lookups else 0.0
+        return stats
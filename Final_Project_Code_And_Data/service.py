@@ -0,0 +1,560 @@
+"""
+HTTP/JSON service exposing the reader and retailer operations from app.py,
+so many users can be served by one process and one connection pool instead
+of one terminal session (and connection) each.
+
+The server runs on asyncio, using only the standard library. There is no
+asynchronous MySQL driver here: app.py's functions block on
+mysql.connector and the synchronous pool in db_pool.py, so
+DatabaseThreadPool offloads each call to a worker thread (one per pooled
+connection), and requests wait (without blocking the event loop) for a
+free thread. Database concurrency is therefore bounded by --pool-size
+threads, not by the event loop. At most --max-requests requests are handled at once; beyond
+that the service answers 503 straight away rather than queueing without
+bound.
+
+Endpoints (GET parameters go in the query string, POST parameters in a JSON
+body; the results are those of the matching commands.py command):
+    GET  /search?genre=&language_code=&after_year=[&cursor=][&limit=]
+    GET  /full-text-search?terms=[&limit=]
+    GET  /popular-series?author=
+    GET  /recommendations?isbn_10=[&limit=]
+    POST /ratings             {"user_id", "isbn_10", "rating"}
+    POST /to-read             {"user_id", "isbn_10"}
+    GET  /users-top-rated?user_id=[&cursor=][&limit=]       (retailers)
+    GET  /top-rated?start_year=&end_year=[&min_ratings=][&cursor=][&limit=]
+                                                            (retailers)
+    POST /login               {"username", "password"} -> {"token", ...}
+    POST /logout
+    GET  /metrics[?format=prometheus]
+                              per-endpoint latency, pool statistics, and
+                              per-statement metrics (see metrics.py)
+/search, /users-top-rated and /top-rated return a page of results as
+{"books": [...], "next_cursor": ...}; pass next_cursor as the cursor
+parameter to get the next page.
+Every other endpoint needs either the token from /login (as an
+"Authorization: Bearer TOKEN" header) or HTTP Basic authentication with an
+application account. Either way, the database is only asked to check a
+user's password once per session (see sessions.py).
+
+Usage:
+    python3 service.py [--host 127.0.0.1] [--port 8080] [--pool-size N]
+                       [--max-requests N]
+    curl -u avidreader:WRAYp7e 'localhost:8080/search?genre=fantasy&\\
+language_code=eng&after_year=2000'
+"""
+
+import argparse
+import asyncio
+import base64
+import collections
+import functools
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+
+import mysql.connector
+import mysql.connector.errorcode as errorcode
+
+import app
+import commands
+from db_pool import PoolTimeoutError
+from metrics import percentile
+from sessions import SessionCache
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+# Requests handled at once before new ones are turned away with a 503
+MAX_REQUESTS = 256
+# Largest request body accepted
+MAX_BODY_BYTES = 64 * 1024
+# Seconds a client has to send a request's headers
+HEADER_TIMEOUT = 30.0
+# Latencies kept per endpoint for the percentiles in /metrics
+LATENCY_SAMPLE_SIZE = 10000
+# Seconds between sweeps of expired sessions
+SESSION_PURGE_INTERVAL = 60.0
+
+# Marks a parameter without a default
+REQUIRED = object()
+
+# (method, path) -> (command name, [(parameter, type, default)]). The
+# commands (and so the roles they need and the shapes of their results) are
+# those of commands.py.
+ENDPOINTS = {
+    ('GET', '/search'): ('search', [
+        ('genre', str, REQUIRED), ('language_code', str, REQUIRED),
+        ('after_year', int, REQUIRED), ('cursor', str, None),
+        ('limit', int, app.SEARCH_PAGE_SIZE)]),
+    ('GET', '/full-text-search'): ('full-text-search', [
+        ('terms', str, REQUIRED), ('limit', int, app.SEARCH_LIMIT)]),
+    ('GET', '/popular-series'): ('popular-series', [
+        ('author', str, REQUIRED)]),
+    ('GET', '/recommendations'): ('recommend', [
+        ('isbn_10', str, REQUIRED), ('limit', int, app.RECOMMENDATION_LIMIT)]),
+    ('POST', '/ratings'): ('rate', [
+        ('user_id', int, REQUIRED), ('isbn_10', str, REQUIRED),
+        ('rating', int, REQUIRED)]),
+    ('POST', '/to-read'): ('to-read', [
+        ('user_id', int, REQUIRED), ('isbn_10', str, REQUIRED)]),
+    ('GET', '/users-top-rated'): ('users-top-rated', [
+        ('user_id', int, REQUIRED), ('cursor', str, None),
+        ('limit', int, app.USER_TOP_RATED_LIMIT)]),
+    ('GET', '/top-rated'): ('top-rated-in-timeframe', [
+        ('start_year', int, REQUIRED), ('end_year', int, REQUIRED),
+        ('min_ratings', int, app.TOP_RATED_MIN_RATINGS), ('cursor', str, None),
+        ('limit', int, app.TOP_RATED_LIMIT)]),
+}
+
+STATUS_REASONS = {
+    200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 403: 'Forbidden',
+    404: 'Not Found', 405: 'Method Not Allowed', 409: 'Conflict',
+    413: 'Payload Too Large', 500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+
+class HTTPError(Exception):
+    """
+    An error response: the status code and a message for the client.
+    """
+
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+# ----------------------------------------------------------------------
+# Database Threads
+# ----------------------------------------------------------------------
+class DatabaseThreadPool:
+    """
+    Lets coroutines await app.py's blocking database functions by running
+    them on a thread pool the size of app.pool, one call per thread (and so
+    per pooled connection) at a time. Each call holds its thread until the
+    blocking call returns; this is a thread-offload adapter, not an
+    asynchronous connection pool.
+
+    Usage:
+        db = DatabaseThreadPool(app.POOL_SIZE)
+        rows = await db.run(app.fetch_full_text_matches, 'dragon')
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._executor = ThreadPoolExecutor(max_workers=size,
+                                            thread_name_prefix='db')
+        # Held while a call is running, so waiting happens here (where it
+        # can be measured) rather than inside the executor's queue
+        self._slots = asyncio.Semaphore(size)
+        self.waiting = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    async def run(self, function, *args):
+        """
+        Calls function(*args) on a database thread, waiting for a free one
+        if they are all busy, and returns its result.
+        """
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        wait = time.perf_counter() - start
+        self.total_wait_seconds += wait
+        self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, functools.partial(function, *args))
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'waiting': self.waiting,
+            'total_wait_seconds': self.total_wait_seconds,
+            'max_wait_seconds': self.max_wait_seconds,
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+# ----------------------------------------------------------------------
+# Metrics
+# ----------------------------------------------------------------------
+class EndpointMetrics:
+    """
+    Request counts and latencies of one endpoint. Only the latest
+    LATENCY_SAMPLE_SIZE latencies are kept for the percentiles.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLE_SIZE)
+
+    def record(self, seconds, status):
+        self.requests += 1
+        if status >= 500:
+            self.errors += 1
+        self.total_seconds += seconds
+        self.latencies.append(seconds)
+
+    def summary(self):
+        latencies = list(self.latencies)
+
+        def ms(pct):
+            return percentile(latencies, pct) * 1000 if latencies else None
+
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'mean_ms': (self.total_seconds / self.requests * 1000
+                        if self.requests else None),
+            'p50_ms': ms(50),
+            'p95_ms': ms(95),
+            'p99_ms': ms(99),
+        }
+
+
+# ----------------------------------------------------------------------
+# Service
+# ----------------------------------------------------------------------
+class BooksService:
+    """
+    The request handlers, and the state they share.
+    """
+
+    def __init__(self, db, max_requests=MAX_REQUESTS, sessions=None):
+        self.db = db
+        self.max_requests = max_requests
+        self.sessions = sessions or SessionCache()
+        self.in_flight = 0
+        self.rejected = 0
+        self.started = time.time()
+        self.metrics = collections.defaultdict(EndpointMetrics)
+
+    async def run_database(self, description, function, *args):
+        """
+        Runs a blocking app.py function on the connection pool, answering
+        503 if the pool stays busy and 500 (or 409 for a duplicate or
+        unknown key) if the database fails. description names the request
+        in the error log.
+        """
+        try:
+            return await self.db.run(function, *args)
+        except PoolTimeoutError:
+            raise HTTPError(503, 'database busy, try again',
+                            {'Retry-After': '1'})
+        except mysql.connector.Error as err:
+            if err.errno in (errorcode.ER_DUP_ENTRY,
+                             errorcode.ER_NO_REFERENCED_ROW_2):
+                raise HTTPError(409, err.msg)
+            sys.stderr.write('%s: %s\n' % (description, err))
+            raise HTTPError(500, 'database error')
+
+    async def login(self, username, password):
+        """
+        Returns the session for a username and password, checking them
+        against the database only if they have no session yet.
+        """
+        session = self.sessions.find(username, password)
+        if session is None:
+            role = await self.run_database('login', app.check_login,
+                                           username, password)
+            if not role:
+                raise HTTPError(401, 'invalid username or password',
+                                {'WWW-Authenticate': 'Basic realm="booksdb"'})
+            session = self.sessions.create(username, role, password)
+        return session
+
+    async def authenticate(self, headers):
+        """
+        Returns the session of the request's Bearer token or Basic
+        credentials.
+        """
+        (scheme, _, credentials) = headers.get('authorization', '').partition(
+            ' ')
+        scheme = scheme.lower()
+        if scheme == 'bearer':
+            session = self.sessions.get(credentials.strip())
+            if session is None:
+                raise HTTPError(401, 'invalid or expired session')
+            return session
+        if scheme != 'basic':
+            raise HTTPError(401, 'authentication required',
+                            {'WWW-Authenticate': 'Basic realm="booksdb"'})
+        try:
+            (username, _, password) = base64.b64decode(
+                credentials).decode('utf-8').partition(':')
+        except ValueError:
+            raise HTTPError(400, 'malformed credentials')
+        return await self.login(username, password)
+
+    def parse_params(self, spec, values):
+        """
+        Converts the request's parameters (a dictionary) according to an
+        ENDPOINTS parameter list, returning them as a Namespace for the
+        command function.
+        """
+        params = {}
+        for (name, kind, default) in spec:
+            if name not in values or values[name] in ('', None):
+                if default is REQUIRED:
+                    raise HTTPError(400, 'missing parameter %s' % name)
+                params[name] = default
+                continue
+            try:
+                params[name] = kind(values[name])
+            except (TypeError, ValueError):
+                raise HTTPError(400, 'invalid %s' % name)
+        return argparse.Namespace(**params)
+
+    async def handle(self, method, target, headers, body):
+        """
+        Handles one request, returning (status, result, extra headers).
+        """
+        url = urlsplit(target)
+        if url.path == '/metrics' and method == 'GET':
+            if dict(parse_qsl(url.query)).get('format') == 'prometheus':
+                return (200, app.instruments.prometheus_text(), {})
+            return (200, self.snapshot_metrics(), {})
+        if url.path == '/login' and method == 'POST':
+            values = parse_json_body(body)
+            session = await self.login(str(values.get('username', '')),
+                                       str(values.get('password', '')))
+            return (200, {'token': session.token, 'role': session.role,
+                          'expires_in': self.sessions.ttl}, {})
+        if url.path == '/logout' and method == 'POST':
+            session = await self.authenticate(headers)
+            self.sessions.revoke(session.token)
+            return (200, {'logged_out': True}, {})
+        endpoint = ENDPOINTS.get((method, url.path))
+        if endpoint is None:
+            if any(path == url.path for (_, path) in ENDPOINTS):
+                raise HTTPError(405, 'method not allowed')
+            raise HTTPError(404, 'no such endpoint')
+        (command, spec) = endpoint
+
+        if method == 'GET':
+            values = dict(parse_qsl(url.query))
+        else:
+            values = parse_json_body(body)
+        args = self.parse_params(spec, values)
+
+        session = await self.authenticate(headers)
+        required_role = commands.COMMANDS[command][1]
+        if required_role is not None and session.role != required_role:
+            raise HTTPError(403, '%s requires a %s account'
+                            % (command, required_role))
+        if command == 'rate' and not 1 <= args.rating <= 5:
+            raise HTTPError(400, 'rating must be from 1 to 5')
+        try:
+            return (200, await self.run_database(
+                '%s %s' % (method, url.path), commands.call_command, command,
+                args), {})
+        except commands.CommandError as err:
+            raise HTTPError(400, str(err))
+
+    def snapshot_metrics(self):
+        return {
+            'uptime_seconds': time.time() - self.started,
+            'in_flight': self.in_flight,
+            'rejected': self.rejected,
+            'endpoints': {path: metrics.summary()
+                          for (path, metrics) in sorted(self.metrics.items())},
+            'db_threads': self.db.stats(),
+            'pool': app.pool.stats(),
+            'result_cache': app.result_cache.stats(),
+            'sessions': self.sessions.stats(),
+            'database': app.instruments.snapshot(),
+        }
+
+    async def purge_sessions(self):
+        """
+        Drops expired sessions every SESSION_PURGE_INTERVAL seconds.
+        """
+        while True:
+            await asyncio.sleep(SESSION_PURGE_INTERVAL)
+            self.sessions.purge()
+
+    async def serve_connection(self, reader, writer):
+        """
+        Serves the requests on one client connection (keep-alive).
+        """
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(reader),
+                                                     HEADER_TIMEOUT)
+                except HTTPError as err:
+                    await write_response(writer, err.status,
+                                         {'error': str(err)}, {}, False)
+                    break
+                if request is None:
+                    break
+                (method, target, version, headers, body) = request
+                keep_alive = (version == 'HTTP/1.1' and
+                              headers.get('connection', '').lower() != 'close')
+
+                start = time.perf_counter()
+                if self.in_flight >= self.max_requests:
+                    self.rejected += 1
+                    (status, result, extra) = (503, {'error': 'overloaded'},
+                                               {'Retry-After': '1'})
+                else:
+                    self.in_flight += 1
+                    try:
+                        (status, result, extra) = await self.handle(
+                            method, target, headers, body)
+                    except HTTPError as err:
+                        (status, result, extra) = (err.status,
+                            {'error': str(err)}, err.headers)
+                    except Exception as err:
+                        # A bug rather than a bad request; answer rather
+                        # than dropping the connection
+                        sys.stderr.write('%s %s: %s: %s\n' % (
+                            method, target, type(err).__name__, err))
+                        (status, result, extra) = (500,
+                            {'error': 'internal error'}, {})
+                    finally:
+                        self.in_flight -= 1
+                self.metrics[urlsplit(target).path if status != 404
+                             else 'other'].record(
+                    time.perf_counter() - start, status)
+
+                await write_response(writer, status, result, extra,
+                                     keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def parse_json_body(body):
+    """
+    Returns a request's JSON object body as a dictionary.
+    """
+    try:
+        values = json.loads(body or b'{}')
+    except ValueError:
+        raise HTTPError(400, 'body is not valid JSON')
+    if not isinstance(values, dict):
+        raise HTTPError(400, 'body must be a JSON object')
+    return values
+
+
+async def read_request(reader):
+    """
+    Reads one HTTP request, returning (method, target, version, headers,
+    body), or None if the client closed the connection.
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        (method, target, version) = line.decode('latin-1').split()
+    except ValueError:
+        raise HTTPError(400, 'malformed request line')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        (name, _, value) = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise HTTPError(400, 'malformed Content-Length')
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, 'request body too large')
+    body = await reader.readexactly(length) if length else b''
+    return (method.upper(), target, version.upper(), headers, body)
+
+
+async def write_response(writer, status, result, extra_headers, keep_alive):
+    """
+    Writes a response: result as JSON, or as plain text if it is a string.
+    """
+    if isinstance(result, str):
+        body = result.encode('utf-8')
+        content_type = 'text/plain; version=0.0.4'
+    else:
+        body = json.dumps(result, default=commands.json_default).encode(
+            'utf-8')
+        content_type = 'application/json'
+    headers = {
+        'Content-Type': content_type,
+        'Content-Length': str(len(body)),
+        'Connection': 'keep-alive' if keep_alive else 'close',
+    }
+    headers.update(extra_headers)
+    head = 'HTTP/1.1 %d %s\r\n%s\r\n' % (
+        status, STATUS_REASONS.get(status, ''),
+        ''.join('%s: %s\r\n' % item for item in headers.items()))
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+
+
+async def serve(host, port, max_requests):
+    db = DatabaseThreadPool(app.POOL_SIZE)
+    service = BooksService(db, max_requests)
+    server = await asyncio.start_server(service.serve_connection, host, port)
+    purge_task = asyncio.ensure_future(service.purge_sessions())
+    print('Serving on http://%s:%d' % (host, port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        purge_task.cancel()
+        db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--pool-size', type=int, default=app.POOL_SIZE * 4,
+        help='database worker threads, each with its own MySQL connection '
+             '(i.e. requests using the database at once) '
+             '(default: %d)' % (app.POOL_SIZE * 4))
+    parser.add_argument('--max-requests', type=int, default=MAX_REQUESTS,
+        help='requests handled at once before answering 503 (default: %d)'
+             % MAX_REQUESTS)
+    commands.add_instrumentation_arguments(parser)
+    args = parser.parse_args(argv)
+
+    app.POOL_SIZE = args.pool_size
+    app.RAISE_ERRORS = True
+    commands.configure_instrumentation(args)
+    # Books are only given by isbn_10, so only the description index is used
+    try:
+        app.init_app(load_indexes=False)
+    except mysql.connector.Error as err:
+        sys.stderr.write('Could not connect to the database: %s\n' % err)
+        return 1
+    app.description_index = app.load_description_index()
+    try:
+        asyncio.run(serve(args.host, args.port, args.max_requests))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        app.pool.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
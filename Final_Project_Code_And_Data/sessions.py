@@ -0,0 +1,176 @@
+"""
+In-process cache of signed-in users, so that repeated operations by the
+same user don't re-authenticate against the database.
+
+A successful login creates a Session, identified by a random token which
+clients (e.g. of service.py) send instead of their password. The cache
+also remembers which (username, password) pairs it has seen succeed, so
+clients which send their password with every request (HTTP Basic auth, or a
+batch switching between users) only reach the database the first time.
+Sessions expire SESSION_TTL seconds after they were last used.
+
+Passwords are never stored: credentials are remembered as a keyed hash with
+a random key chosen per process. A changed password doesn't end sessions
+created with the old one until they expire.
+
+Usage:
+    sessions = SessionCache()
+    session = sessions.login(username, password, app.check_login)
+    ...
+    session = sessions.get(session.token)
+"""
+
+import collections
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+
+# Seconds a session lasts after it was last used
+SESSION_TTL = 30 * 60
+# Sessions kept at once; the least recently used are dropped beyond this
+MAX_SESSIONS = 10000
+
+
+class Session:
+    """
+    A signed-in user.
+    """
+
+    def __init__(self, token, username, role, expires):
+        self.token = token
+        self.username = username
+        self.role = role
+        # time.monotonic() time at which the session expires
+        self.expires = expires
+
+
+class SessionCache:
+    """
+    Thread-safe cache of Sessions by token and by credentials.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        # Token -> Session, least recently used first
+        self._sessions = collections.OrderedDict()
+        # Credential digest -> token
+        self._credentials = {}
+        # Token -> credential digest, to forget credentials with the session
+        self._digests = {}
+        self._key = secrets.token_bytes(32)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _digest(self, username, password):
+        return hmac.new(self._key, ('%s\0%s' % (username, password)).encode(
+            'utf-8'), hashlib.sha256).digest()
+
+    def _remove(self, token):
+        self._sessions.pop(token, None)
+        digest = self._digests.pop(token, None)
+        if digest is not None:
+            self._credentials.pop(digest, None)
+
+    def _lookup(self, token):
+        """
+        Returns the live session for token (renewing it), or None. Must be
+        called with the lock held.
+        """
+        session = self._sessions.get(token)
+        if session is None:
+            return None
+        now = time.monotonic()
+        if session.expires <= now:
+            self._remove(token)
+            return None
+        session.expires = now + self.ttl
+        self._sessions.move_to_end(token)
+        return session
+
+    def create(self, username, role, password=None):
+        """
+        Creates a session for a user who has just been authenticated. If
+        password is given, later find(username, password) calls return this
+        session.
+        """
+        token = secrets.token_urlsafe(32)
+        session = Session(token, username, role, time.monotonic() + self.ttl)
+        with self._lock:
+            self._sessions[token] = session
+            if password is not None:
+                digest = self._digest(username, password)
+                old_token = self._credentials.get(digest)
+                if old_token is not None:
+                    self._remove(old_token)
+                self._credentials[digest] = token
+                self._digests[token] = digest
+            while len(self._sessions) > self.max_sessions:
+                self._remove(next(iter(self._sessions)))
+        return session
+
+    def get(self, token):
+        """
+        Returns the session with this token, or None if there is none or it
+        has expired.
+        """
+        with self._lock:
+            return self._lookup(token)
+
+    def find(self, username, password):
+        """
+        Returns the live session created for these credentials, or None.
+        """
+        digest = self._digest(username, password)
+        with self._lock:
+            token = self._credentials.get(digest)
+            session = self._lookup(token) if token is not None else None
+            if session is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return session
+
+    def login(self, username, password, check_login):
+        """
+        Returns a session for the username and password, authenticating them
+        with check_login(username, password) (which returns a role or None)
+        unless they already have one. Returns None if they are invalid.
+        """
+        session = self.find(username, password)
+        if session is not None:
+            return session
+        role = check_login(username, password)
+        if not role:
+            return None
+        return self.create(username, role, password)
+
+    def revoke(self, token):
+        """
+        Ends a session (logging out).
+        """
+        with self._lock:
+            self._remove(token)
+
+    def purge(self):
+        """
+        Drops every expired session. Returns the number dropped.
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = [token for (token, session) in self._sessions.items()
+                       if session.expires <= now]
+            for token in expired:
+                self._remove(token)
+        return len(expired)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -89,30 +89,41 @@ DELIMITER ;
 
 DELIMITER !
 CREATE FUNCTION authenticate(username VARCHAR(20), password VARCHAR(20))
-RETURNS TINYINT DETERMINISTIC
+RETURNS TINYINT READS SQL DATA
 BEGIN
-    -- The salt added to the password before hashing, from the user_info table
-    DECLARE pw_salt CHAR(8);
-    -- The password hash from the user_info table
-    DECLARE pw_hash BINARY(64);
+    -- Whether a user with this username and password exists. The password is
+    -- salted and hashed within the same primary key lookup, so unknown users
+    -- and wrong passwords both cost a single probe of user_info.
+    DECLARE valid TINYINT;
+
+    SELECT COUNT(*) INTO valid
+        FROM user_info
+        WHERE user_info.username = username
+            AND user_info.password_hash 
+                = SHA2(CONCAT(user_info.salt, password), 256);
+
+    RETURN valid;
+END !
+DELIMITER ;
 
-    -- If the username is not in the table, the user does not appear in the 
-    -- table
-    IF username NOT IN (SELECT username FROM user_info)
-        THEN RETURN 0;
-    END IF;
+-- Like authenticate, but returns the user's role (or NULL if the username
+-- and password are not valid), so a login needs only one round trip.
 
-    -- Retrieve this user's salt and password hash from the database
-    SELECT user_info.salt, user_info.password_hash INTO pw_salt, pw_hash
+-- DROP FUNCTION IF EXISTS authenticate_role;
+
+DELIMITER !
+CREATE FUNCTION authenticate_role(username VARCHAR(20), password VARCHAR(20))
+RETURNS VARCHAR(20) READS SQL DATA
+BEGIN
+    DECLARE role VARCHAR(20) DEFAULT NULL;
+
+    SELECT user_info.user_role INTO role
         FROM user_info
-        WHERE user_info.username = username;
-
-    -- If the hashed password matches the hashed password in user_info, 
-    -- the user and password are valid
-    IF SHA2(CONCAT(pw_salt, password), 256) = pw_hash
-        THEN RETURN 1;
-        ELSE RETURN 0;
-    END IF;
+        WHERE user_info.username = username
+            AND user_info.password_hash 
+                = SHA2(CONCAT(user_info.salt, password), 256);
+
+    RETURN role;
 END !
 DELIMITER ;
 
@@ -2,19 +2,21 @@
 -- Part I: Procedural SQL
 
 -- A UDF that will get the average rating for any book the database.
--- The UDF can take any book isbn_10 identifier as the input and find the 
--- average of all ratings of that book via the ratings table. This can be used
--- to identify which books have high or low ratings.
+-- The UDF can take any book isbn_10 identifier as the input and returns the 
+-- average of all ratings of that book, or NULL if it has no ratings. This can
+-- be used to identify which books have high or low ratings. The average is 
+-- read from the materialized stats (mv_book_stats, defined below) with one 
+-- primary key lookup, rather than by averaging the book's ratings.
 DROP FUNCTION IF EXISTS get_average_rating;
 
 DELIMITER !
 CREATE FUNCTION get_average_rating(input_isbn_10 CHAR(10)) 
-RETURNS NUMERIC(5, 2) DETERMINISTIC
+RETURNS NUMERIC(5, 2) READS SQL DATA
 BEGIN
     DECLARE avg_rating NUMERIC(5, 2);
 
-    SELECT AVG(rating) 
-        FROM ratings
+    SELECT total_stars / num_ratings
+        FROM mv_book_stats
         WHERE isbn_10 = input_isbn_10
     INTO avg_rating;
 
@@ -87,6 +89,102 @@ CREATE VIEW book_stats AS
         total_stars / num_ratings AS avg_rating
     FROM mv_book_stats;
 
+-- The set-based counterpart of get_average_rating: takes a JSON array of 
+-- isbn_10s (e.g. '["0439023483", "0439554934"]') and returns one row 
+-- (isbn_10, num_ratings, avg_rating) per isbn_10 in the array, in one 
+-- statement. Books without ratings have a NULL average and 0 ratings.
+DROP PROCEDURE IF EXISTS sp_get_average_ratings;
+
+DELIMITER !
+CREATE PROCEDURE sp_get_average_ratings(isbn_list JSON)
+BEGIN
+    SELECT isbns.isbn_10, 
+        IFNULL(num_ratings, 0) AS num_ratings,
+        avg_rating
+    FROM JSON_TABLE(isbn_list, '$[*]' 
+            COLUMNS (isbn_10 CHAR(10) PATH '$')) AS isbns
+        LEFT JOIN book_stats ON book_stats.isbn_10 = isbns.isbn_10;
+END !
+DELIMITER ;
+
+-- The same per-book rating stats, keyed on (and clustered by) the book's 
+-- original publication year, so that "top rated books published between 
+-- years A and B" only reads the books published in that range instead of 
+-- joining every rating to books. Books without a publication year are left 
+-- out, since they can't fall in a range. Maintained by the same procedures 
+-- and triggers as mv_book_stats (see below).
+CREATE TABLE mv_year_book_stats
+(
+    orig_publication_yr SMALLINT NOT NULL,
+    isbn_10             CHAR(10) NOT NULL,
+    num_ratings         INT NOT NULL,
+    total_stars         INT NOT NULL,
+    PRIMARY KEY (orig_publication_yr, isbn_10),
+    -- Used by the triggers, which know a book's isbn_10 but not its year
+    INDEX idx_year_stats_isbn (isbn_10)
+);
+
+-- Populate mv_year_book_stats from mv_book_stats.
+INSERT INTO mv_year_book_stats(
+    SELECT orig_publication_yr, isbn_10, num_ratings, total_stars
+    FROM mv_book_stats NATURAL JOIN books
+    WHERE orig_publication_yr IS NOT NULL
+);
+
+-- The top (up to) max_books rated books originally published between 
+-- start_year and end_year (inclusive), among books with at least min_ratings
+-- ratings.
+DROP PROCEDURE IF EXISTS sp_top_rated_in_timeframe;
+
+DELIMITER !
+CREATE PROCEDURE sp_top_rated_in_timeframe(
+    start_year SMALLINT,
+    end_year SMALLINT,
+    min_ratings INT,
+    max_books INT
+)
+BEGIN
+    SELECT isbn_10, orig_title, total_stars / num_ratings AS avg_rating, 
+        num_ratings
+    FROM mv_year_book_stats NATURAL JOIN books
+    WHERE orig_publication_yr BETWEEN start_year AND end_year
+        AND num_ratings >= min_ratings
+    ORDER BY avg_rating DESC, isbn_10
+    LIMIT max_books;
+END !
+DELIMITER ;
+
+-- Precomputed item-item collaborative filtering neighbors, built offline by 
+-- build_book_neighbors.py from the ratings table. For every book, holds its 
+-- most similar books (by adjusted cosine similarity of their ratings), so that
+-- "readers who liked this also liked" is a single primary key range lookup.
+CREATE TABLE book_neighbors
+(
+    isbn_10             CHAR(10) NOT NULL,
+    -- 1 for the most similar book, 2 for the next, etc.
+    neighbor_rank       SMALLINT NOT NULL,
+    neighbor_isbn_10    CHAR(10) NOT NULL,
+    similarity          FLOAT NOT NULL,
+    PRIMARY KEY (isbn_10, neighbor_rank),
+    -- Used to find the books whose neighbor lists include a changed book
+    INDEX idx_neighbors_neighbor (neighbor_isbn_10)
+);
+
+-- Books whose ratings have changed since book_neighbors was last built, 
+-- filled in by the ratings triggers below. build_book_neighbors.py 
+-- --incremental only recomputes the neighbors of these books (and of the 
+-- books which list them as neighbors), then empties this table.
+CREATE TABLE book_neighbors_stale
+(
+    isbn_10     CHAR(10) PRIMARY KEY
+);
+
+-- The ratings triggers below keep mv_book_stats, mv_year_book_stats and 
+-- book_neighbors_stale up to date one row at a time. Bulk loaders (see 
+-- ingest_ratings.py) set the session variable @skip_book_stats_triggers to 1
+-- to turn this off for their own session, and instead apply the combined 
+-- changes of many rows at once, in the same transaction as the rows.
+
 -- A procedure to execute when inserting a new isbn_10 and rating
 -- to the book stats materialized view (mv_book_stats).
 -- If an isbn_10 is already in view, the associated information is updated.
@@ -104,13 +202,28 @@ BEGIN
         -- isbn_10 already in view; update existing row
         num_ratings = num_ratings + 1,
         total_stars = total_stars + new_rating;
+
+    -- Same for the publication-year keyed stats (books without a year are
+    -- not included there)
+    INSERT INTO mv_year_book_stats
+        SELECT orig_publication_yr, isbn_10, 1, new_rating
+        FROM books 
+        WHERE isbn_10 = new_isbn_10 AND orig_publication_yr IS NOT NULL
+    ON DUPLICATE KEY UPDATE 
+        num_ratings = mv_year_book_stats.num_ratings + 1,
+        total_stars = mv_year_book_stats.total_stars + new_rating;
+
+    -- This book's collaborative filtering neighbors are now out of date
+    INSERT IGNORE INTO book_neighbors_stale VALUES (new_isbn_10);
 END !
 
 -- Handles new rows added to ratings table, updates stats accordingly
 CREATE TRIGGER trg_ratings_insert AFTER INSERT
     ON ratings FOR EACH ROW
 BEGIN
-    CALL sp_book_stats_new_rating(NEW.isbn_10, NEW.rating);
+    IF NOT IFNULL(@skip_book_stats_triggers, 0) THEN
+        CALL sp_book_stats_new_rating(NEW.isbn_10, NEW.rating);
+    END IF;
 END !
 DELIMITER ;
 
@@ -137,13 +250,26 @@ BEGIN
             WHERE  isbn_10 = old_isbn_10;
     END IF;
 
+    -- Same for the publication-year keyed stats. If the row is deleted, the
+    -- update finds nothing to change.
+    DELETE FROM mv_year_book_stats
+        WHERE isbn_10 = old_isbn_10 AND num_ratings = 1;
+    UPDATE mv_year_book_stats
+        SET num_ratings = num_ratings - 1,
+            total_stars = total_stars - old_rating
+        WHERE isbn_10 = old_isbn_10;
+
+    -- This book's collaborative filtering neighbors are now out of date
+    INSERT IGNORE INTO book_neighbors_stale VALUES (old_isbn_10);
 END !
 
 -- Handles when rows are deleted from ratings table, updates stats accordingly
 CREATE TRIGGER trg_ratings_delete AFTER DELETE
        ON ratings FOR EACH ROW
 BEGIN
-    CALL sp_book_stats_del_rating(OLD.isbn_10, OLD.rating);
+    IF NOT IFNULL(@skip_book_stats_triggers, 0) THEN
+        CALL sp_book_stats_del_rating(OLD.isbn_10, OLD.rating);
+    END IF;
 END !
 DELIMITER ;
 
@@ -155,13 +281,239 @@ DELIMITER !
 CREATE TRIGGER trg_ratings_update AFTER UPDATE
        ON ratings FOR EACH ROW
 BEGIN
-    IF OLD.isbn_10 = NEW.isbn_10
-        THEN UPDATE mv_book_stats 
-            SET total_stars = total_stars + NEW.rating - OLD.rating
-            WHERE isbn_10 = NEW.isbn_10;
-    ELSE
-        CALL sp_book_stats_new_rating(NEW.isbn_10, NEW.rating);
-        CALL sp_book_stats_del_rating(OLD.isbn_10, OLD.rating);
+    IF NOT IFNULL(@skip_book_stats_triggers, 0) THEN
+        IF OLD.isbn_10 = NEW.isbn_10
+            THEN UPDATE mv_book_stats 
+                SET total_stars = total_stars + NEW.rating - OLD.rating
+                WHERE isbn_10 = NEW.isbn_10;
+            UPDATE mv_year_book_stats 
+                SET total_stars = total_stars + NEW.rating - OLD.rating
+                WHERE isbn_10 = NEW.isbn_10;
+            INSERT IGNORE INTO book_neighbors_stale VALUES (NEW.isbn_10);
+        ELSE
+            CALL sp_book_stats_new_rating(NEW.isbn_10, NEW.rating);
+            CALL sp_book_stats_del_rating(OLD.isbn_10, OLD.rating);
+        END IF;
     END IF;
 END !
-DELIMITER ;
\ No newline at end of file
+DELIMITER ;
+
+
+-- Trigger to move a book's publication-year keyed stats when its publication
+-- year changes.
+DELIMITER !
+
+CREATE TRIGGER trg_books_update AFTER UPDATE
+       ON books FOR EACH ROW
+BEGIN
+    IF NOT (OLD.orig_publication_yr <=> NEW.orig_publication_yr) THEN
+        DELETE FROM mv_year_book_stats WHERE isbn_10 = OLD.isbn_10;
+        INSERT INTO mv_year_book_stats
+            SELECT NEW.orig_publication_yr, isbn_10, num_ratings, total_stars
+            FROM mv_book_stats
+            WHERE isbn_10 = NEW.isbn_10 
+                AND NEW.orig_publication_yr IS NOT NULL;
+    END IF;
+END !
+DELIMITER ;
+
+
+-- Set-based maintenance of the book stats. The triggers above update 
+-- mv_book_stats with several statements per changed rating, which makes 
+-- bulk deletes and updates of ratings slow. The procedures below turn the 
+-- triggers off (@skip_book_stats_triggers), collect the changes to each 
+-- book's stats in the temporary table tmp_book_stats_deltas, and apply them 
+-- all with a few statements. They don't commit, so they can be part of a 
+-- larger transaction.
+
+-- Creates (or empties) this session's tmp_book_stats_deltas table, which 
+-- holds the change to each book's num_ratings and total_stars (negative for
+-- removed ratings).
+DROP PROCEDURE IF EXISTS sp_create_book_stats_deltas;
+
+DELIMITER !
+CREATE PROCEDURE sp_create_book_stats_deltas()
+BEGIN
+    CREATE TEMPORARY TABLE IF NOT EXISTS tmp_book_stats_deltas (
+        isbn_10     CHAR(10) PRIMARY KEY,
+        num_ratings INT NOT NULL,
+        total_stars INT NOT NULL
+    );
+    DELETE FROM tmp_book_stats_deltas;
+END !
+DELIMITER ;
+
+-- Applies the changes in tmp_book_stats_deltas to mv_book_stats and 
+-- mv_year_book_stats, removes books left without ratings, marks the changed
+-- books' neighbors as stale, and empties tmp_book_stats_deltas.
+DROP PROCEDURE IF EXISTS sp_apply_book_stats_deltas;
+
+DELIMITER !
+CREATE PROCEDURE sp_apply_book_stats_deltas()
+BEGIN
+    INSERT INTO mv_book_stats(isbn_10, num_ratings, total_stars)
+        SELECT d.isbn_10, d.num_ratings, d.total_stars
+        FROM tmp_book_stats_deltas AS d
+    ON DUPLICATE KEY UPDATE
+        num_ratings = mv_book_stats.num_ratings + d.num_ratings,
+        total_stars = mv_book_stats.total_stars + d.total_stars;
+    DELETE s FROM mv_book_stats AS s 
+        JOIN tmp_book_stats_deltas AS d ON d.isbn_10 = s.isbn_10
+        WHERE s.num_ratings <= 0;
+
+    INSERT INTO mv_year_book_stats(orig_publication_yr, isbn_10, 
+            num_ratings, total_stars)
+        SELECT b.orig_publication_yr, d.isbn_10, d.num_ratings, d.total_stars
+        FROM tmp_book_stats_deltas AS d 
+            JOIN books AS b ON b.isbn_10 = d.isbn_10
+        WHERE b.orig_publication_yr IS NOT NULL
+    ON DUPLICATE KEY UPDATE
+        num_ratings = mv_year_book_stats.num_ratings + d.num_ratings,
+        total_stars = mv_year_book_stats.total_stars + d.total_stars;
+    DELETE s FROM mv_year_book_stats AS s 
+        JOIN tmp_book_stats_deltas AS d ON d.isbn_10 = s.isbn_10
+        WHERE s.num_ratings <= 0;
+
+    INSERT IGNORE INTO book_neighbors_stale(isbn_10)
+        SELECT isbn_10 FROM tmp_book_stats_deltas;
+    DELETE FROM tmp_book_stats_deltas;
+END !
+DELIMITER ;
+
+-- Deletes all ratings by a user (e.g. a spam account), updating the stats 
+-- of the books they rated once per book rather than once per rating.
+DROP PROCEDURE IF EXISTS sp_delete_user_ratings;
+
+DELIMITER !
+CREATE PROCEDURE sp_delete_user_ratings(input_user_id INT)
+BEGIN
+    DECLARE saved_skip INT DEFAULT @skip_book_stats_triggers;
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        SET @skip_book_stats_triggers = saved_skip;
+        RESIGNAL;
+    END;
+    SET @skip_book_stats_triggers = 1;
+
+    CALL sp_create_book_stats_deltas();
+    INSERT INTO tmp_book_stats_deltas
+        SELECT isbn_10, -COUNT(*), -SUM(rating)
+        FROM ratings
+        WHERE user_id = input_user_id
+        GROUP BY isbn_10;
+    DELETE FROM ratings WHERE user_id = input_user_id;
+    CALL sp_apply_book_stats_deltas();
+
+    SET @skip_book_stats_triggers = saved_skip;
+END !
+DELIMITER ;
+
+-- Moves every rating of old_isbn_10 to new_isbn_10 (e.g. to merge two 
+-- editions of a book). If a user rated both books, their rating of 
+-- new_isbn_10 is kept. The stats of both books are updated with a single
+-- delta each.
+DROP PROCEDURE IF EXISTS sp_remap_isbn;
+
+DELIMITER !
+CREATE PROCEDURE sp_remap_isbn(old_isbn_10 CHAR(10), new_isbn_10 CHAR(10))
+BEGIN
+    DECLARE saved_skip INT DEFAULT @skip_book_stats_triggers;
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        SET @skip_book_stats_triggers = saved_skip;
+        RESIGNAL;
+    END;
+    SET @skip_book_stats_triggers = 1;
+
+    IF old_isbn_10 <> new_isbn_10 THEN
+        CALL sp_create_book_stats_deltas();
+        -- Every rating is removed from the old book...
+        INSERT INTO tmp_book_stats_deltas
+            SELECT old_isbn_10, -COUNT(*), -IFNULL(SUM(rating), 0)
+            FROM ratings
+            WHERE isbn_10 = old_isbn_10;
+
+        DELETE old_r FROM ratings AS old_r 
+            JOIN ratings AS new_r ON new_r.user_id = old_r.user_id 
+                AND new_r.isbn_10 = new_isbn_10
+            WHERE old_r.isbn_10 = old_isbn_10;
+
+        -- ...and the ones which aren't duplicates are added to the new one
+        INSERT INTO tmp_book_stats_deltas
+            SELECT new_isbn_10, COUNT(*), IFNULL(SUM(rating), 0)
+            FROM ratings
+            WHERE isbn_10 = old_isbn_10;
+        UPDATE ratings SET isbn_10 = new_isbn_10 
+            WHERE isbn_10 = old_isbn_10;
+
+        CALL sp_apply_book_stats_deltas();
+    END IF;
+
+    SET @skip_book_stats_triggers = saved_skip;
+END !
+DELIMITER ;
+
+-- Recomputes mv_book_stats and mv_year_book_stats from scratch from the 
+-- ratings table, e.g. after loading ratings with the triggers turned off.
+DROP PROCEDURE IF EXISTS sp_rebuild_book_stats;
+
+DELIMITER !
+CREATE PROCEDURE sp_rebuild_book_stats()
+BEGIN
+    DELETE FROM mv_book_stats;
+    INSERT INTO mv_book_stats
+        SELECT isbn_10, COUNT(*), SUM(rating)
+        FROM ratings GROUP BY isbn_10;
+
+    DELETE FROM mv_year_book_stats;
+    INSERT INTO mv_year_book_stats
+        SELECT orig_publication_yr, isbn_10, num_ratings, total_stars
+        FROM mv_book_stats NATURAL JOIN books
+        WHERE orig_publication_yr IS NOT NULL;
+END !
+DELIMITER ;
+
+-- Checks mv_book_stats and mv_year_book_stats against the ratings table. 
+-- Returns one row (table_name, isbn_10, num_ratings, total_stars, 
+-- actual_num_ratings, actual_total_stars) for every book whose stored stats
+-- are wrong or missing; no rows means the stats are correct.
+DROP PROCEDURE IF EXISTS sp_verify_book_stats;
+
+DELIMITER !
+CREATE PROCEDURE sp_verify_book_stats()
+BEGIN
+    WITH actual AS (
+        SELECT isbn_10, COUNT(*) AS num_ratings, SUM(rating) AS total_stars
+        FROM ratings GROUP BY isbn_10
+    ), actual_year AS (
+        SELECT orig_publication_yr, actual.*
+        FROM actual NATURAL JOIN books
+        WHERE orig_publication_yr IS NOT NULL
+    )
+    SELECT 'mv_book_stats' AS table_name, s.isbn_10, s.num_ratings, 
+        s.total_stars, a.num_ratings, a.total_stars
+    FROM mv_book_stats AS s LEFT JOIN actual AS a ON a.isbn_10 = s.isbn_10
+    WHERE NOT (s.num_ratings <=> a.num_ratings) 
+        OR NOT (s.total_stars <=> a.total_stars)
+    UNION ALL
+    SELECT 'mv_book_stats', a.isbn_10, NULL, NULL, a.num_ratings, 
+        a.total_stars
+    FROM actual AS a LEFT JOIN mv_book_stats AS s ON s.isbn_10 = a.isbn_10
+    WHERE s.isbn_10 IS NULL
+    UNION ALL
+    SELECT 'mv_year_book_stats', s.isbn_10, s.num_ratings, s.total_stars, 
+        a.num_ratings, a.total_stars
+    FROM mv_year_book_stats AS s 
+        LEFT JOIN actual_year AS a ON a.isbn_10 = s.isbn_10 
+            AND a.orig_publication_yr = s.orig_publication_yr
+    WHERE NOT (s.num_ratings <=> a.num_ratings) 
+        OR NOT (s.total_stars <=> a.total_stars)
+    UNION ALL
+    SELECT 'mv_year_book_stats', a.isbn_10, NULL, NULL, a.num_ratings, 
+        a.total_stars
+    FROM actual_year AS a 
+        LEFT JOIN mv_year_book_stats AS s ON s.isbn_10 = a.isbn_10 
+            AND s.orig_publication_yr = a.orig_publication_yr
+    WHERE s.isbn_10 IS NULL;
+END !
+DELIMITER ;
@@ -101,6 +101,50 @@ CREATE TABLE to_read (
         ON UPDATE CASCADE ON DELETE CASCADE
 );
 
+-- Secondary indexes for the application's access paths. Note that InnoDB
+-- secondary indexes implicitly end with the table's primary key columns, so
+-- e.g. an index on genres(genre) also holds isbn_10 and covers lookups of the
+-- books in a genre.
+
 -- An index on orig_publication_yr, since we expect searches and queries
--- related to the publication year.
--- CREATE INDEX idx_year ON books(orig_publication_yr);
\ No newline at end of file
+-- related to the publication year (e.g. top rated books in a timeframe,
+-- recommendations from the same year).
+CREATE INDEX idx_year ON books(orig_publication_yr);
+
+-- Book searches filter on a language and a minimum publication year, and
+-- are paged newest first (ORDER BY orig_publication_yr DESC, isbn_10), so the
+-- index is kept in that order and each page seeks straight to its first book.
+CREATE INDEX idx_books_lang_year 
+    ON books(language_code, orig_publication_yr DESC, isbn_10);
+
+-- Books in a genre (searches, recommendations, per-genre queries). The 
+-- primary key leads with isbn_10, so it can't be used to look up a genre.
+CREATE INDEX idx_genres_genre ON genres(genre);
+
+-- Books by an author (popular series, recommendations, per-author queries).
+CREATE INDEX idx_authors_author ON authors(author);
+
+-- Ratings of a book. The primary key leads with user_id, so per-book
+-- aggregates (average rating, number of ratings) would otherwise scan the 
+-- whole table. Including rating makes this a covering index for AVG(rating).
+-- This index also serves the foreign key on isbn_10.
+CREATE INDEX idx_ratings_isbn_rating ON ratings(isbn_10, rating);
+
+-- A user's ratings ordered by rating, covering the user's top rated books 
+-- query (WHERE user_id = ? ORDER BY rating DESC, isbn_10 LIMIT 11) without a
+-- filesort, and letting each later page seek past the last (rating, isbn_10)
+-- shown instead of reading the earlier pages again.
+CREATE INDEX idx_ratings_user_rating 
+    ON ratings(user_id, rating DESC, isbn_10);
+
+-- Lookups of to_read by isbn_10 (e.g. how many users want to read a book)
+-- use the index InnoDB creates for the foreign key on to_read.isbn_10.
+
+-- Full-text indexes for keyword search over titles, authors and descriptions
+-- (the (f) option in app.py). Unlike LIKE '%...%', which has to scan every 
+-- row, MATCH ... AGAINST looks the words up in these inverted indexes and 
+-- ranks the matches by relevance.
+CREATE FULLTEXT INDEX ftx_books_title ON books(orig_title);
+CREATE FULLTEXT INDEX ftx_authors_author ON authors(author);
+CREATE FULLTEXT INDEX ftx_book_details_description 
+    ON book_details(book_description);
@@ -0,0 +1,217 @@
+"""
+Columnar binary snapshot of the ratings and to_read tables, for analysis
+tools which would otherwise round-trip through MySQL or re-parse CSV text.
+
+The export writes one .npy array per column into a directory:
+    isbns.npy               S10    the book dictionary; book code i is isbns[i]
+    ratings_user_ids.npy    int32
+    ratings_book_codes.npy  int32  indexes into isbns
+    ratings_ratings.npy     int8
+    to_read_user_ids.npy    int32
+    to_read_book_codes.npy  int32  indexes into isbns
+Rows are in primary key order (user_id, then isbn_10). Snapshot.load
+memory-maps the arrays, so loading takes milliseconds, costs no memory up
+front, and the operating system shares the pages between processes.
+
+Usage:
+    python3 snapshot.py export [--out snapshot]
+    python3 snapshot.py info [--snapshot snapshot]
+
+Requires NumPy (pip install numpy).
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import time
+from array import array
+
+import mysql.connector
+import numpy as np
+
+from db_pool import DB_CONFIG
+
+# Default location of the snapshot, relative to this directory
+DEFAULT_SNAPSHOT_DIR = 'snapshot'
+# Rows fetched from the server at a time while exporting
+FETCH_SIZE = 10000
+
+
+# ----------------------------------------------------------------------
+# Exporting
+# ----------------------------------------------------------------------
+def export_table(conn, sql, codes, isbns, with_rating):
+    """
+    Streams (user_id, isbn_10[, rating]) rows of a query into arrays,
+    dictionary-encoding isbn_10s through codes/isbns (which are extended
+    with new books). Returns (user_ids, book_codes, ratings), where ratings
+    is None unless with_rating is set.
+    """
+    user_ids = array('i')
+    book_codes = array('i')
+    ratings = array('b')
+
+    cursor = conn.cursor()
+    cursor.execute(sql)
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            code = codes.get(row[1])
+            if code is None:
+                code = codes[row[1]] = len(isbns)
+                isbns.append(row[1])
+            user_ids.append(row[0])
+            book_codes.append(code)
+            if with_rating:
+                ratings.append(row[2])
+    cursor.close()
+
+    return (np.frombuffer(user_ids, dtype=np.int32),
+            np.frombuffer(book_codes, dtype=np.int32),
+            np.frombuffer(ratings, dtype=np.int8) if with_rating else None)
+
+
+def export_snapshot(conn, out_dir=DEFAULT_SNAPSHOT_DIR):
+    """
+    Writes a snapshot of ratings and to_read to out_dir, replacing any
+    previous snapshot there only once the new one is complete. Both tables
+    are read in one consistent-snapshot transaction. Returns the number of
+    (ratings, to_read) rows exported.
+    """
+    codes = {}
+    isbns = []
+    conn.start_transaction(consistent_snapshot=True, readonly=True)
+    try:
+        (user_ids, book_codes, ratings) = export_table(
+            conn, 'SELECT user_id, isbn_10, rating FROM ratings '
+                  'ORDER BY user_id, isbn_10', codes, isbns, True)
+        (to_read_user_ids, to_read_book_codes, _) = export_table(
+            conn, 'SELECT user_id, isbn_10 FROM to_read '
+                  'ORDER BY user_id, isbn_10', codes, isbns, False)
+    finally:
+        conn.rollback()
+
+    tmp_dir = out_dir.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    arrays = {
+        'isbns': np.array(isbns, dtype='S10'),
+        'ratings_user_ids': user_ids,
+        'ratings_book_codes': book_codes,
+        'ratings_ratings': ratings,
+        'to_read_user_ids': to_read_user_ids,
+        'to_read_book_codes': to_read_book_codes,
+    }
+    for (name, values) in arrays.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), values)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.rename(tmp_dir, out_dir)
+    return (len(ratings), len(to_read_user_ids))
+
+
+# ----------------------------------------------------------------------
+# Loading
+# ----------------------------------------------------------------------
+class Snapshot:
+    """
+    A memory-mapped snapshot written by export_snapshot. Use Snapshot.load
+    to open one. All arrays are read-only views of the files.
+    """
+
+    def __init__(self, isbns, ratings, to_read):
+        # S10 array of isbn_10s, indexed by book code
+        self.isbns = isbns
+        # (user_ids, book_codes, ratings) arrays
+        self.ratings = ratings
+        # (user_ids, book_codes) arrays
+        self.to_read = to_read
+        self._codes = None
+
+    @classmethod
+    def load(cls, snapshot_dir=DEFAULT_SNAPSHOT_DIR):
+        """
+        Memory-maps the snapshot files in snapshot_dir.
+        """
+        def mapped(name):
+            return np.load(os.path.join(snapshot_dir, name + '.npy'),
+                           mmap_mode='r')
+
+        return cls(mapped('isbns'),
+                   (mapped('ratings_user_ids'), mapped('ratings_book_codes'),
+                    mapped('ratings_ratings')),
+                   (mapped('to_read_user_ids'), mapped('to_read_book_codes')))
+
+    @property
+    def num_books(self):
+        return len(self.isbns)
+
+    def isbn(self, code):
+        """
+        Returns the isbn_10 of a book code.
+        """
+        return self.isbns[code].decode('ascii')
+
+    def code(self, isbn_10):
+        """
+        Returns the book code of an isbn_10, or None if it isn't in the
+        snapshot. The reverse dictionary is built on first use.
+        """
+        if self._codes is None:
+            self._codes = {isbn.decode('ascii'): code
+                           for (code, isbn) in enumerate(self.isbns)}
+        return self._codes.get(isbn_10)
+
+    def isbn_list(self):
+        """
+        Returns the book dictionary as a list of isbn_10 strings.
+        """
+        return [isbn.decode('ascii') for isbn in self.isbns]
+
+
+# ----------------------------------------------------------------------
+# Command-Line Functionality
+# ----------------------------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export',
+        help='export ratings and to_read from the database')
+    export_parser.add_argument('--out', default=DEFAULT_SNAPSHOT_DIR,
+        help='snapshot directory (default: %s)' % DEFAULT_SNAPSHOT_DIR)
+
+    info_parser = subparsers.add_parser('info',
+        help='load a snapshot and print its sizes')
+    info_parser.add_argument('--snapshot', default=DEFAULT_SNAPSHOT_DIR)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        try:
+            conn = mysql.connector.connect(**DB_CONFIG)
+        except mysql.connector.Error as err:
+            sys.stderr.write('Could not connect to the database: %s\n' % err)
+            return 1
+        try:
+            start = time.perf_counter()
+            (num_ratings, num_to_read) = export_snapshot(conn, args.out)
+        finally:
+            conn.close()
+        print('Exported %d ratings and %d to_read rows in %.1fs'
+              % (num_ratings, num_to_read, time.perf_counter() - start))
+    elif args.command == 'info':
+        start = time.perf_counter()
+        snapshot = Snapshot.load(args.snapshot)
+        loaded = time.perf_counter()
+        print('%d books, %d ratings, %d to_read rows (loaded in %.1f ms)'
+              % (snapshot.num_books, len(snapshot.ratings[0]),
+                 len(snapshot.to_read[0]), (loaded - start) * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
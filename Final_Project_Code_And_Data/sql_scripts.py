@@ -0,0 +1,129 @@
+"""
+Helpers for reading the project's .sql scripts from Python, so that tools
+such as benchmark.py can run the same statements we source in mysql.
+
+Statements are split the same way the mysql client splits them, including
+support for the DELIMITER command used around our procedural SQL. Comments
+of the form "-- [Query 1]" label the statements which follow them.
+"""
+
+import re
+
+# Matches the "-- [Query 1]" style labels used in queries.sql
+LABEL_RE = re.compile(r'^--\s*\[(.+?)\]')
+# Matches the secondary index definitions in setup.sql
+INDEX_RE = re.compile(
+    r'^CREATE\s+(?:(FULLTEXT|UNIQUE)\s+)?INDEX\s+(\w+)\s+ON\s+(\w+)\s*\(',
+    re.IGNORECASE)
+# Matches the LOAD DATA statements in load-data.sql
+LOAD_RE = re.compile(
+    r"^LOAD\s+DATA\s+(?:LOCAL\s+)?INFILE\s+'([^']+)'\s+INTO\s+TABLE\s+(\w+)",
+    re.IGNORECASE)
+
+
+def strip_comment(line):
+    """
+    Removes a trailing "-- comment" from a line of SQL, ignoring "--" inside
+    quoted strings.
+    """
+    quote = None
+    for i, ch in enumerate(line):
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in ('\'', '"', '`'):
+            quote = ch
+        elif line.startswith('--', i) and (i + 2 == len(line)
+                                            or line[i + 2].isspace()):
+            return line[:i]
+    return line
+
+
+def read_sql_statements(filename):
+    """
+    Returns a list of (label, statement) tuples for every statement in the
+    given .sql file, in order. label is the text of the most recent
+    "-- [label]" comment before the statement, or None. Statements do not
+    include their terminating delimiter.
+    """
+    statements = []
+    delimiter = ';'
+    label = None
+    buffer = []
+
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            stripped = line.strip()
+            if not buffer:
+                match = LABEL_RE.match(stripped)
+                if match:
+                    label = match.group(1)
+                    continue
+                if stripped.upper().startswith('DELIMITER'):
+                    delimiter = stripped.split()[1]
+                    continue
+
+            code = strip_comment(line).rstrip()
+            if not code.strip():
+                continue
+            buffer.append(code)
+
+            if code.endswith(delimiter):
+                statement = '\n'.join(buffer)[:-len(delimiter)].strip()
+                if statement:
+                    statements.append((label, statement))
+                buffer = []
+
+    # A final statement may be missing its delimiter
+    if buffer:
+        statements.append((label, '\n'.join(buffer).strip()))
+    return statements
+
+
+def read_workload(filename='queries.sql'):
+    """
+    Returns the labelled (label, statement) queries from a workload file such
+    as queries.sql, skipping anything without a label.
+    """
+    return [(label, sql) for (label, sql) in read_sql_statements(filename)
+            if label]
+
+
+def index_definitions(filename='setup.sql'):
+    """
+    Returns a list of (index_name, table_name, kind, statement) tuples for
+    the CREATE INDEX statements in the given DDL file, where kind is
+    'FULLTEXT', 'UNIQUE' or None.
+    """
+    indexes = []
+    for (_, statement) in read_sql_statements(filename):
+        match = INDEX_RE.match(statement)
+        if match:
+            kind, name, table = match.groups()
+            indexes.append((name, table, kind.upper() if kind else None,
+                            statement))
+    return indexes
+
+
+def secondary_indexes(filename='setup.sql'):
+    """
+    Returns a list of (index_name, table_name, kind) tuples for the CREATE
+    INDEX statements in the given DDL file, where kind is 'FULLTEXT',
+    'UNIQUE' or None.
+    """
+    return [(name, table, kind)
+            for (name, table, kind, _) in index_definitions(filename)]
+
+
+def load_data_statements(filename='load-data.sql'):
+    """
+    Returns a list of (table_name, data_filename, statement) tuples for the
+    LOAD DATA statements in the given file, in order.
+    """
+    loads = []
+    for (_, statement) in read_sql_statements(filename):
+        match = LOAD_RE.match(statement)
+        if match:
+            data_filename, table = match.groups()
+            loads.append((table, data_filename, statement))
+    return loads
@@ -0,0 +1,214 @@
+"""
+Tests for the connection pool and prepared statement cache (db_pool.py).
+
+mysql.connector.connect is replaced with fake connections, so these don't
+need MySQL.
+
+Usage:
+    python3 -m unittest test_db_pool
+"""
+
+import threading
+import unittest
+from unittest import mock
+
+import mysql.connector
+import mysql.connector.errorcode as errorcode
+
+from db_pool import ConnectionPool, PoolTimeoutError, StatementCache
+
+
+class FakeCursor:
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection:
+    """
+    Just enough of a mysql.connector connection for the pool.
+    """
+
+    def __init__(self, **connect_args):
+        self.autocommit = False
+        self.in_transaction = False
+        self.closed = False
+        # Set to make ping() and reconnect() fail, as if the server went away
+        self.dead = False
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self, prepared=False):
+        return FakeCursor()
+
+    def start_transaction(self):
+        self.in_transaction = True
+
+    def commit(self):
+        self.commits += 1
+        self.in_transaction = False
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.in_transaction = False
+
+    def ping(self, reconnect=False):
+        if self.dead:
+            raise mysql.connector.Error(errno=errorcode.CR_SERVER_GONE_ERROR)
+
+    def reconnect(self, attempts=1, delay=0):
+        if self.dead:
+            raise mysql.connector.Error(errno=errorcode.CR_CONN_HOST_ERROR)
+
+    def close(self):
+        self.closed = True
+
+
+class StatementCacheTest(unittest.TestCase):
+
+    def test_least_recently_used_statement_is_closed(self):
+        statements = StatementCache(FakeConnection(), capacity=2)
+        first = statements.cursor('SELECT 1')
+        second = statements.cursor('SELECT 2')
+        self.assertIs(statements.cursor('SELECT 1'), first)
+        statements.cursor('SELECT 3')
+        self.assertTrue(second.closed)
+        self.assertFalse(first.closed)
+        self.assertEqual((statements.hits, statements.misses,
+                          statements.evictions), (1, 3, 1))
+        self.assertEqual(len(statements), 2)
+
+    def test_discard_and_clear(self):
+        statements = StatementCache(FakeConnection())
+        first = statements.cursor('SELECT 1')
+        second = statements.cursor('SELECT 2')
+        statements.discard('SELECT 1')
+        statements.discard('SELECT 1')
+        self.assertTrue(first.closed)
+        self.assertIsNot(statements.cursor('SELECT 1'), first)
+        statements.clear()
+        self.assertTrue(second.closed)
+        self.assertEqual(len(statements), 0)
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(mysql.connector, 'connect',
+                                    FakeConnection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_connections_are_reused(self):
+        pool = ConnectionPool(size=2)
+        with pool.checkout(read_only=True) as first:
+            self.assertTrue(first.conn.autocommit)
+        with pool.checkout(read_only=True) as second:
+            self.assertIs(second, first)
+        stats = pool.stats()
+        self.assertEqual((stats['connections_created'], stats['checkouts'],
+                          stats['in_use']), (1, 2, 0))
+
+    def test_writes_commit_or_roll_back(self):
+        pool = ConnectionPool(size=1)
+        with pool.checkout() as pooled:
+            self.assertTrue(pooled.conn.in_transaction)
+        self.assertEqual(pooled.conn.commits, 1)
+        with self.assertRaises(ValueError):
+            with pool.checkout() as pooled:
+                raise ValueError('invalid rating')
+        self.assertEqual((pooled.conn.commits, pooled.conn.rollbacks), (1, 1))
+        self.assertFalse(pooled.broken)
+
+    def test_full_pool_times_out(self):
+        pool = ConnectionPool(size=1, timeout=0.01)
+        with pool.checkout(read_only=True):
+            with self.assertRaises(PoolTimeoutError):
+                with pool.checkout(read_only=True):
+                    pass
+        self.assertEqual(pool.stats()['timeouts'], 1)
+
+    def test_waiting_caller_gets_returned_connection(self):
+        pool = ConnectionPool(size=1, timeout=5.0)
+        got = []
+
+        def wait_for_connection():
+            with pool.checkout(read_only=True) as pooled:
+                got.append(pooled)
+
+        with pool.checkout(read_only=True) as held:
+            thread = threading.Thread(target=wait_for_connection)
+            thread.start()
+        thread.join()
+        self.assertEqual(got, [held])
+
+    def test_lost_connection_is_replaced(self):
+        pool = ConnectionPool(size=1)
+        with self.assertRaises(mysql.connector.Error):
+            with pool.checkout(read_only=True) as lost:
+                raise mysql.connector.Error(errno=errorcode.CR_SERVER_LOST)
+        self.assertTrue(lost.conn.closed)
+        with pool.checkout(read_only=True) as pooled:
+            self.assertIsNot(pooled, lost)
+        stats = pool.stats()
+        self.assertEqual((stats['connections_discarded'], stats['open']),
+                         (1, 1))
+
+    def test_dead_idle_connection_is_replaced(self):
+        pool = ConnectionPool(size=1, health_check_interval=0.0)
+        with pool.checkout(read_only=True) as dead:
+            pass
+        dead.conn.dead = True
+        with pool.checkout(read_only=True) as pooled:
+            self.assertIsNot(pooled, dead)
+        self.assertTrue(dead.conn.closed)
+        self.assertEqual(pool.stats()['open'], 1)
+
+    def test_session_pins_one_connection(self):
+        pool = ConnectionPool(size=2)
+        with pool.session():
+            with pool.checkout(read_only=True) as first:
+                pass
+            with pool.checkout() as second:
+                pass
+            with pool.session():
+                with pool.checkout(read_only=True) as nested:
+                    pass
+            self.assertIs(second, first)
+            self.assertIs(nested, first)
+            self.assertEqual(pool.stats()['in_use'], 1)
+            # A transaction left open is rolled back when the session ends
+            first.conn.start_transaction()
+        self.assertEqual(first.conn.rollbacks, 1)
+        self.assertEqual(pool.stats()['in_use'], 0)
+
+    def test_session_replaces_lost_connection(self):
+        pool = ConnectionPool(size=1)
+        with pool.session():
+            with self.assertRaises(mysql.connector.Error):
+                with pool.checkout(read_only=True) as lost:
+                    raise mysql.connector.Error(
+                        errno=errorcode.CR_SERVER_LOST)
+            with pool.checkout(read_only=True) as pooled:
+                self.assertIsNot(pooled, lost)
+        stats = pool.stats()
+        self.assertEqual((stats['in_use'], stats['open'], stats['idle']),
+                         (0, 1, 1))
+
+    def test_close_closes_returned_connections(self):
+        pool = ConnectionPool(size=2)
+        with pool.checkout(read_only=True) as busy:
+            with pool.checkout(read_only=True) as idle:
+                pass
+            pool.close()
+            self.assertTrue(idle.conn.closed)
+            self.assertFalse(busy.conn.closed)
+        self.assertTrue(busy.conn.closed)
+        self.assertEqual(pool.stats()['open'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+"""
+Tests for the statement and operation metrics (metrics.py).
+
+Usage:
+    python3 -m unittest test_metrics
+"""
+
+import io
+import json
+import threading
+import unittest
+
+from metrics import Histogram, Metrics, estimate_bytes, percentile
+
+SEARCH_SQL = 'SELECT isbn_10 FROM books WHERE orig_title LIKE %s'
+RATE_SQL = 'INSERT INTO ratings VALUES (%s, %s, %s)'
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_buckets_include_their_upper_bound(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 1.0, 3.0):
+            histogram.observe(value)
+        # Observations above every bucket go in the last count
+        self.assertEqual(histogram.counts, [2, 2, 1])
+        self.assertEqual(histogram.count, 5)
+        self.assertAlmostEqual(histogram.sum, 4.65)
+
+    def test_quantile_is_a_bucket_bound(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        self.assertIsNone(histogram.quantile(0.5))
+        for value in (0.05, 0.05, 0.05, 0.5):
+            histogram.observe(value)
+        self.assertEqual(histogram.quantile(0.5), 0.1)
+        self.assertEqual(histogram.quantile(0.75), 0.1)
+        self.assertEqual(histogram.quantile(0.99), 1.0)
+        histogram.observe(3.0)
+        self.assertIsNone(histogram.quantile(0.99))
+
+    def test_percentile(self):
+        latencies = [5, 1, 4, 2, 3]
+        self.assertEqual(percentile(latencies, 50), 3)
+        self.assertEqual(percentile(latencies, 99), 5)
+        self.assertEqual(percentile(latencies, 0), 1)
+        self.assertEqual(percentile([7], 95), 7)
+
+    def test_estimate_bytes(self):
+        self.assertEqual(estimate_bytes([('abc', 1, None), (b'xy', 2.5)]), 21)
+
+
+class OperationTest(unittest.TestCase):
+
+    def test_statements_count_towards_their_operation(self):
+        metrics = Metrics()
+        with metrics.operation('search'):
+            metrics.record_statement(SEARCH_SQL, ('%Potter%',), 0.02, 3, 30)
+            metrics.record_statement(SEARCH_SQL, ('%Hobbit%',), 0.03, 1, 10)
+        metrics.record_statement(SEARCH_SQL, ('%Dune%',), 0.01, 1, 4)
+
+        snapshot = metrics.snapshot()
+        (statement,) = snapshot['statements'].values()
+        self.assertEqual(statement['latency']['count'], 3)
+        self.assertEqual(statement['rows'], 5)
+        search = snapshot['operations']['search']
+        self.assertEqual(search['calls'], 1)
+        self.assertEqual((search['rows'], search['bytes']), (4, 40))
+        # One latency observation per call, of its statements' total time
+        self.assertEqual(search['latency']['count'], 1)
+        self.assertAlmostEqual(search['latency']['sum_seconds'], 0.05)
+
+    def test_nested_operations(self):
+        metrics = Metrics()
+        for _ in range(2):
+            with metrics.operation('batch'):
+                metrics.record_statement(SEARCH_SQL, ('%a%',), 0.5, 2, 20)
+                with metrics.operation('rate'):
+                    metrics.record_statement(RATE_SQL, (1, 'x', 5), 0.25, 0,
+                                             0, error=True)
+                    metrics.record_statement(RATE_SQL, (1, 'y', 4), 0.25, 0,
+                                             0)
+
+        batch = metrics.operations['batch']
+        rate = metrics.operations['rate']
+        self.assertEqual((batch.calls, rate.calls), (2, 2))
+        # Rows, bytes and errors go to the innermost operation only
+        self.assertEqual((batch.rows, batch.bytes, batch.errors), (4, 40, 0))
+        self.assertEqual((rate.rows, rate.bytes, rate.errors), (0, 0, 2))
+        # The outer operation's time includes the nested one's
+        self.assertEqual(batch.latency.count, 2)
+        self.assertAlmostEqual(batch.latency.sum, 2.0)
+        self.assertEqual(rate.latency.count, 2)
+        self.assertAlmostEqual(rate.latency.sum, 1.0)
+
+    def test_operation_is_timed_when_it_fails(self):
+        metrics = Metrics()
+        with self.assertRaises(ValueError):
+            with metrics.operation('rate'):
+                metrics.record_statement(RATE_SQL, (1, 'x', 9), 0.1, 0, 0,
+                                         error=True)
+                raise ValueError('rating out of range')
+        rate = metrics.operations['rate']
+        self.assertEqual((rate.latency.count, rate.errors), (1, 1))
+        # Later statements are outside the operation
+        metrics.record_statement(RATE_SQL, (1, 'x', 5), 0.1, 0, 0)
+        self.assertEqual(rate.latency.count, 1)
+
+    def test_operations_are_per_thread(self):
+        metrics = Metrics()
+
+        def other_thread():
+            metrics.record_statement(SEARCH_SQL, ('%b%',), 1.0, 7, 70)
+
+        with metrics.operation('search'):
+            thread = threading.Thread(target=other_thread)
+            thread.start()
+            thread.join()
+        search = metrics.operations['search']
+        self.assertEqual((search.rows, search.latency.sum), (0, 0.0))
+
+
+class SlowQueryLogTest(unittest.TestCase):
+
+    def test_slow_statements_are_logged_without_passwords(self):
+        log = io.StringIO()
+        metrics = Metrics(slow_query_seconds=0.1, slow_query_log=log)
+        with metrics.operation('search'):
+            metrics.record_statement(SEARCH_SQL, ('%Potter%',), 0.05, 1, 1)
+            metrics.record_statement(SEARCH_SQL, ('%Potter%',), 0.2, 1, 1)
+        metrics.record_statement('SELECT authenticate(%s, %s)',
+                                 ('avidreader', 'WRAYp7e'), 0.3, 1, 1)
+
+        entries = [json.loads(line) for line in log.getvalue().splitlines()]
+        self.assertEqual(metrics.slow_queries, 2)
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0]['operation'], 'search')
+        self.assertEqual(entries[0]['params'], ['%Potter%'])
+        self.assertIsNone(entries[1]['operation'])
+        self.assertIsNone(entries[1]['params'])
+        self.assertNotIn('WRAYp7e', log.getvalue())
+
+
+class PrometheusTextTest(unittest.TestCase):
+
+    def test_exposition(self):
+        metrics = Metrics()
+        with metrics.operation('search'):
+            metrics.record_statement(SEARCH_SQL, ('%a%',), 0.0002, 2, 20)
+            metrics.record_statement(SEARCH_SQL, ('%b%',), 0.3, 1, 10,
+                                     error=True)
+        metrics.record_statement(SEARCH_SQL, ('%c%',), 20.0, 0, 0)
+        lines = metrics.prometheus_text().splitlines()
+        (key,) = metrics.statements
+
+        def value(line_start):
+            matches = [line for line in lines if line.startswith(line_start)]
+            self.assertEqual(len(matches), 1, line_start)
+            return matches[0].rsplit(' ', 1)[1]
+
+        statement = 'booksdb_statement_seconds_bucket{statement="%s",' % key
+        # Buckets are cumulative, ending with +Inf
+        self.assertEqual(value(statement + 'le="0.0005"}'), '1')
+        self.assertEqual(value(statement + 'le="0.25"}'), '1')
+        self.assertEqual(value(statement + 'le="0.5"}'), '2')
+        self.assertEqual(value(statement + 'le="10.0"}'), '2')
+        self.assertEqual(value(statement + 'le="+Inf"}'), '3')
+        self.assertEqual(value(
+            'booksdb_statement_seconds_count{statement="%s"}' % key), '3')
+        self.assertAlmostEqual(float(value(
+            'booksdb_statement_seconds_sum{statement="%s"}' % key)), 20.3002)
+        self.assertEqual(value(
+            'booksdb_statement_rows_total{statement="%s"}' % key), '3')
+
+        operation = 'booksdb_operation_seconds_bucket{operation="search",'
+        self.assertEqual(value(operation + 'le="0.25"}'), '0')
+        self.assertEqual(value(operation + 'le="0.5"}'), '1')
+        self.assertEqual(value(
+            'booksdb_operation_seconds_count{operation="search"}'), '1')
+        self.assertEqual(value(
+            'booksdb_operation_rows_total{operation="search"}'), '3')
+        self.assertEqual(value(
+            'booksdb_operation_errors_total{operation="search"}'), '1')
+        self.assertEqual(value(
+            'booksdb_operation_calls_total{operation="search"}'), '1')
+        self.assertEqual(value('booksdb_slow_queries_total'), '0')
+
+        # Each metric is declared once, before its samples
+        types = [line for line in lines if line.startswith('# TYPE')]
+        self.assertEqual(len(types), len(set(types)))
+        self.assertIn('# TYPE booksdb_operation_seconds histogram', types)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+"""
+Tests for keyset pagination (pagination.py and the paged queries in app.py).
+
+The paged queries run against an in-memory SQLite copy of the tables they
+read, so the ordering and seek conditions tested are app.py's own SQL.
+
+Usage:
+    python3 -m unittest test_pagination
+"""
+
+import sqlite3
+import unittest
+from unittest import mock
+
+import app
+from pagination import CursorError, decode_cursor, encode_cursor, split_page
+
+# (isbn_10, total_stars, num_ratings) in mv_year_book_stats. 40/12, 50/15
+# and 100/30 are all 3.3333... (3.3333 once rounded), and 33333/10000 is
+# exactly 3.3333, so they tie and must be ordered by isbn_10.
+BOOK_STATS = [
+    ('0000000001', 45, 10),
+    ('0000000002', 50, 15),
+    ('0000000003', 33333, 10000),
+    ('0000000004', 40, 12),
+    ('0000000005', 41, 10),
+    ('0000000006', 100, 30),
+    ('0000000007', 20, 10),
+    ('0000000008', 5, 1),
+]
+# (user_id, isbn_10, rating), with ties on rating
+RATINGS = [
+    (1, '0000000001', 5), (1, '0000000002', 4), (1, '0000000003', 5),
+    (1, '0000000004', 4), (1, '0000000005', 4), (1, '0000000006', 2),
+    (2, '0000000001', 1),
+]
+
+
+def make_database():
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE books (isbn_10 TEXT PRIMARY KEY, '
+               'orig_title TEXT, orig_publication_yr INTEGER)')
+    # REAL, so the rollup's average isn't an integer division as in SQLite
+    db.execute('CREATE TABLE mv_year_book_stats (orig_publication_yr '
+               'INTEGER, isbn_10 TEXT, num_ratings INTEGER, '
+               'total_stars REAL)')
+    db.execute('CREATE TABLE ratings (user_id INTEGER, isbn_10 TEXT, '
+               'rating INTEGER)')
+    for (isbn_10, total_stars, num_ratings) in BOOK_STATS:
+        db.execute('INSERT INTO books VALUES (?, ?, 2005)',
+                   (isbn_10, 'Title ' + isbn_10))
+        db.execute('INSERT INTO mv_year_book_stats VALUES (2005, ?, ?, ?)',
+                   (isbn_10, num_ratings, total_stars))
+    db.executemany('INSERT INTO ratings VALUES (?, ?, ?)', RATINGS)
+    return db
+
+
+class PaginationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = make_database()
+
+        def execute_sql_query(sql, error_message, params=(), cache=False):
+            return self.db.execute(sql.replace('%s', '?'), params).fetchall()
+
+        patcher = mock.patch.object(app, 'execute_sql_query',
+                                    execute_sql_query)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.db.close)
+
+    def all_pages(self, fetch_page, limit):
+        """
+        Returns the isbn_10s of every page of a list, following the cursors.
+        """
+        isbns = []
+        cursor = None
+        while True:
+            (rows, cursor) = fetch_page(cursor, limit)
+            self.assertLessEqual(len(rows), limit)
+            isbns.extend(row[0] for row in rows)
+            if cursor is None:
+                return isbns
+
+    def test_top_rated_pages_keep_tied_averages(self):
+        def fetch_page(cursor, limit):
+            return app.fetch_top_rated_in_timeframe_page(2000, 2010, cursor,
+                                                         10, limit)
+
+        (everything, _) = fetch_page(None, 100)
+        expected = [row[0] for row in everything]
+        self.assertEqual(expected, [
+            '0000000001', '0000000005', '0000000002', '0000000003',
+            '0000000004', '0000000006', '0000000007'])
+        # Every page size splits the tied averages somewhere
+        for limit in range(1, len(expected) + 1):
+            self.assertEqual(self.all_pages(fetch_page, limit), expected,
+                             'page size %d' % limit)
+
+    def test_users_top_rated_pages_keep_tied_ratings(self):
+        def fetch_page(cursor, limit):
+            return app.fetch_users_top_rated_page(1, cursor, limit)
+
+        expected = ['0000000001', '0000000003', '0000000002', '0000000004',
+                    '0000000005', '0000000006']
+        for limit in range(1, len(expected) + 1):
+            self.assertEqual(self.all_pages(fetch_page, limit), expected,
+                             'page size %d' % limit)
+
+    def test_cursor_for_another_list_is_rejected(self):
+        (_, cursor) = app.fetch_users_top_rated_page(1, None, 2)
+        with self.assertRaises(CursorError):
+            app.fetch_users_top_rated_page(2, cursor, 2)
+        with self.assertRaises(CursorError):
+            app.fetch_top_rated_in_timeframe_page(2000, 2010, cursor)
+
+
+class CursorTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        cursor = encode_cursor('search', ('fantasy', 'eng', 2000),
+                               (2001, '043955493X'))
+        self.assertEqual(decode_cursor(cursor, 'search',
+                                       ('fantasy', 'eng', 2000), (int, str)),
+                         (2001, '043955493X'))
+
+    def test_malformed_cursors(self):
+        for cursor in ('', 'junk', 'e30', encode_cursor('search', (), (1,))):
+            with self.assertRaises(CursorError):
+                decode_cursor(cursor, 'search', (), (int, str))
+
+    def test_split_page(self):
+        rows = [(1,), (2,), (3,)]
+        self.assertEqual(split_page(rows, 3, 'k', (), lambda row: row),
+                         (rows, None))
+        (page, cursor) = split_page(rows, 2, 'k', (), lambda row: row)
+        self.assertEqual(page, rows[:2])
+        self.assertEqual(decode_cursor(cursor, 'k', (), (int,)), (2,))
+
+
+if __name__ == '__main__':
+    unittest.main()
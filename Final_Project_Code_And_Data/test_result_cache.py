@@ -0,0 +1,134 @@
+"""
+Tests for the query result cache (result_cache.py).
+
+Usage:
+    python3 -m unittest test_result_cache
+"""
+
+import types
+import unittest
+from unittest import mock
+
+import app
+import result_cache
+from result_cache import ResultCache, tables_read, tables_written
+
+SEARCH_SQL = 'SELECT isbn_10 FROM books NATURAL JOIN genres WHERE genre = %s'
+STATS_SQL = 'SELECT isbn_10, avg_rating FROM book_stats WHERE isbn_10 = %s'
+RATINGS_SQL = 'SELECT rating FROM ratings WHERE user_id = %s'
+
+
+class TablesTest(unittest.TestCase):
+
+    def test_tables_read(self):
+        self.assertEqual(tables_read(SEARCH_SQL), {'books', 'genres'})
+        self.assertEqual(tables_read(
+            'SELECT * FROM `books` b JOIN authors a ON a.isbn_10 = b.isbn_10'),
+            {'books', 'authors'})
+
+    def test_views_read_their_tables(self):
+        self.assertEqual(tables_read(STATS_SQL),
+                         {'book_stats', 'mv_book_stats'})
+
+    def test_ctes_and_json_table_are_not_tables(self):
+        sql = ('WITH rated AS (SELECT isbn_10 FROM ratings), '
+               'liked AS (SELECT isbn_10 FROM rated) '
+               'SELECT * FROM liked JOIN to_read USING (isbn_10)')
+        self.assertEqual(tables_read(sql), {'ratings', 'to_read'})
+        self.assertEqual(tables_read(app.TITLES_SQL), {'books'})
+
+    def test_tables_written(self):
+        self.assertEqual(tables_written(
+            'INSERT INTO to_read (user_id, isbn_10) VALUES (%s, %s)'),
+            {'to_read'})
+        self.assertEqual(tables_written('DELETE FROM authors WHERE 1'),
+                         {'authors'})
+        # The ratings triggers also write the stats tables
+        self.assertEqual(tables_written(
+            'INSERT IGNORE INTO ratings VALUES (%s, %s, %s)'),
+            {'ratings', 'mv_book_stats', 'mv_year_book_stats',
+             'book_neighbors_stale'})
+        self.assertIsNone(tables_written('CALL sp_add_user(%s, %s, %s)'))
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # The cache's clock, moved by the tests
+        self.now = 1000.0
+        clock = types.SimpleNamespace(monotonic=lambda: self.now)
+        patcher = mock.patch.object(result_cache, 'time', clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_hit_shares_key_across_whitespace(self):
+        cache = ResultCache()
+        cache.put(SEARCH_SQL, ('fantasy',), [('0439554934',)])
+        self.assertEqual(cache.get('  SELECT isbn_10\n FROM books NATURAL '
+                                   'JOIN genres WHERE genre = %s',
+                                   ('fantasy',)),
+                         [('0439554934',)])
+        self.assertIsNone(cache.get(SEARCH_SQL, ('horror',)))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_write_drops_results_reading_the_table(self):
+        cache = ResultCache()
+        cache.put(SEARCH_SQL, ('fantasy',), [('0439554934',)])
+        cache.put(STATS_SQL, ('0439554934',), [('0439554934', 4.5)])
+        cache.put(RATINGS_SQL, (1,), [(5,)])
+
+        cache.invalidate_for('INSERT INTO genres VALUES (%s, %s)')
+        self.assertIsNone(cache.get(SEARCH_SQL, ('fantasy',)))
+        self.assertIsNotNone(cache.get(STATS_SQL, ('0439554934',)))
+        self.assertIsNotNone(cache.get(RATINGS_SQL, (1,)))
+
+        # A rating also changes the stats read through the book_stats view
+        cache.invalidate_for('INSERT INTO ratings VALUES (%s, %s, %s)')
+        self.assertIsNone(cache.get(STATS_SQL, ('0439554934',)))
+        self.assertIsNone(cache.get(RATINGS_SQL, (1,)))
+        self.assertEqual(cache.stats()['invalidations'], 3)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_unknown_write_clears_everything(self):
+        cache = ResultCache()
+        cache.put(SEARCH_SQL, ('fantasy',), [('0439554934',)])
+        cache.put(RATINGS_SQL, (1,), [(5,)])
+        cache.invalidate_for('CALL sp_rebuild_book_stats()')
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ResultCache(max_entries=2)
+        cache.put(RATINGS_SQL, (1,), [(5,)])
+        cache.put(RATINGS_SQL, (2,), [(4,)])
+        cache.get(RATINGS_SQL, (1,))
+        cache.put(RATINGS_SQL, (3,), [(3,)])
+        self.assertEqual(cache.get(RATINGS_SQL, (1,)), [(5,)])
+        self.assertIsNone(cache.get(RATINGS_SQL, (2,)))
+        self.assertEqual(cache.get(RATINGS_SQL, (3,)), [(3,)])
+        self.assertEqual(cache.stats()['evictions'], 1)
+        # The evicted entry no longer counts towards its tables
+        cache.invalidate_tables(['ratings'])
+        self.assertEqual(cache.stats()['invalidations'], 2)
+
+    def test_results_expire(self):
+        cache = ResultCache(ttl=60.0)
+        cache.put(RATINGS_SQL, (1,), [(5,)])
+        self.now += 59.0
+        self.assertEqual(cache.get(RATINGS_SQL, (1,)), [(5,)])
+        self.now += 1.0
+        self.assertIsNone(cache.get(RATINGS_SQL, (1,)))
+        stats = cache.stats()
+        self.assertEqual((stats['expirations'], stats['entries']), (1, 0))
+
+    def test_large_results_are_not_cached(self):
+        cache = ResultCache(max_rows=2)
+        cache.put(RATINGS_SQL, (1,), [(5,), (4,), (3,)])
+        self.assertIsNone(cache.get(RATINGS_SQL, (1,)))
+        cache.put(RATINGS_SQL, (2,), [(5,), (4,)])
+        self.assertEqual(cache.get(RATINGS_SQL, (2,)), [(5,), (4,)])
+
+
+if __name__ == '__main__':
+    unittest.main()
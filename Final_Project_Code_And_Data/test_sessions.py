@@ -0,0 +1,103 @@
+"""
+Tests for the signed-in user cache (sessions.py).
+
+Usage:
+    python3 -m unittest test_sessions
+"""
+
+import types
+import unittest
+from unittest import mock
+
+import sessions
+from sessions import SessionCache
+
+
+class SessionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # The cache's clock, moved by the tests
+        self.now = 1000.0
+        clock = types.SimpleNamespace(monotonic=lambda: self.now)
+        patcher = mock.patch.object(sessions, 'time', clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # (username, password) pairs check_login was called with
+        self.checked = []
+
+    def check_login(self, username, password):
+        self.checked.append((username, password))
+        return 'client' if password == 'WRAYp7e' else None
+
+    def test_login_checks_the_database_once(self):
+        cache = SessionCache()
+        session = cache.login('avidreader', 'WRAYp7e', self.check_login)
+        self.assertEqual((session.username, session.role),
+                         ('avidreader', 'client'))
+        self.assertIs(cache.login('avidreader', 'WRAYp7e', self.check_login),
+                      session)
+        self.assertIs(cache.get(session.token), session)
+        self.assertEqual(self.checked, [('avidreader', 'WRAYp7e')])
+        self.assertEqual(cache.stats(),
+                         {'sessions': 1, 'hits': 1, 'misses': 1})
+
+    def test_wrong_password_is_not_remembered(self):
+        cache = SessionCache()
+        cache.login('avidreader', 'WRAYp7e', self.check_login)
+        for _ in range(2):
+            self.assertIsNone(cache.login('avidreader', 'guess',
+                                          self.check_login))
+        self.assertEqual(len(self.checked), 3)
+
+    def test_sessions_expire_unless_used(self):
+        cache = SessionCache(ttl=60)
+        session = cache.login('avidreader', 'WRAYp7e', self.check_login)
+        self.now += 50
+        self.assertIs(cache.get(session.token), session)
+        # Using the session renewed it
+        self.now += 50
+        self.assertIs(cache.get(session.token), session)
+        self.now += 60
+        self.assertIsNone(cache.get(session.token))
+        self.assertIsNone(cache.find('avidreader', 'WRAYp7e'))
+
+    def test_purge(self):
+        cache = SessionCache(ttl=60)
+        old = cache.create('avidreader', 'client')
+        self.now += 30
+        new = cache.create('bookworm', 'client')
+        self.now += 30
+        self.assertEqual(cache.purge(), 1)
+        self.assertIsNone(cache.get(old.token))
+        self.assertIs(cache.get(new.token), new)
+
+    def test_least_recently_used_session_is_dropped(self):
+        cache = SessionCache(max_sessions=2)
+        first = cache.create('a', 'client', 'pa')
+        second = cache.create('b', 'client', 'pb')
+        cache.get(first.token)
+        cache.create('c', 'client', 'pc')
+        self.assertIs(cache.get(first.token), first)
+        self.assertIsNone(cache.get(second.token))
+        self.assertIsNone(cache.find('b', 'pb'))
+
+    def test_revoke(self):
+        cache = SessionCache()
+        session = cache.login('avidreader', 'WRAYp7e', self.check_login)
+        cache.revoke(session.token)
+        self.assertIsNone(cache.get(session.token))
+        self.assertIsNot(cache.login('avidreader', 'WRAYp7e',
+                                     self.check_login), session)
+        self.assertEqual(len(self.checked), 2)
+
+    def test_new_login_replaces_session_for_same_credentials(self):
+        cache = SessionCache()
+        old = cache.create('avidreader', 'client', 'WRAYp7e')
+        new = cache.create('avidreader', 'client', 'WRAYp7e')
+        self.assertIsNone(cache.get(old.token))
+        self.assertIs(cache.find('avidreader', 'WRAYp7e'), new)
+        self.assertEqual(cache.stats()['sessions'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
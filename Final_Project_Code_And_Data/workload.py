@@ -0,0 +1,250 @@
+"""
+The application's operations, driven without any prompts, for benchmark.py
+and other tools which exercise the database the way app.py does.
+
+Each operation takes a WorkloadData (the genres, books, users etc. which
+parameters are drawn from) and a random.Random, performs the same queries
+as the corresponding menu option in app.py, and returns the number of rows
+it read or wrote. Drawing parameters from a seeded random.Random makes runs
+reproducible.
+
+Also generates synthetic ratings and to_read rows, so the operations can be
+measured at larger data scales than the goodbooks data. Synthetic users
+have user_ids from SYNTHETIC_USER_BASE up, so they can be told apart from
+(and removed without touching) real users.
+"""
+
+import bisect
+import itertools
+import random
+
+import app
+
+# Synthetic user_ids start here (the goodbooks user_ids are far below it)
+SYNTHETIC_USER_BASE = 100000000
+# Search terms for the full-text search operation
+SEARCH_TERMS = ['Harry Potter', 'Tolkien', 'dragon', 'civil war', 'love',
+                'murder mystery', 'vampire', 'Jane Austen', 'space', 'war']
+# Authors of the popular series in app.view_popular_series_info
+POPULAR_SERIES_AUTHORS = ['J.K. Rowling', 'Stephenie Meyer', 'Suzanne Collins',
+                          'C.S. Lewis', 'George R.R. Martin']
+# A reader account created by setup-passwords.sql, used for logins
+DEFAULT_LOGIN = ('avidreader', 'WRAYp7e')
+# Number of books and users parameters are drawn from
+SAMPLE_BOOKS = 2000
+SAMPLE_USERS = 5000
+
+
+class WorkloadData:
+    """
+    The values operation parameters are drawn from, read once from the
+    database with WorkloadData.load.
+    """
+
+    def __init__(self, genres, languages, isbns, user_ids, years, login):
+        self.genres = genres
+        self.languages = languages
+        # Most rated books first
+        self.isbns = isbns
+        self.user_ids = user_ids
+        # (earliest, latest) publication year
+        self.years = years
+        # (username, password) of a valid account
+        self.login = login
+
+    @classmethod
+    def load(cls, login=DEFAULT_LOGIN):
+        """
+        Reads the parameter values through app's query functions, so
+        app.init_app must have been called.
+        """
+        genres = [row[0] for row in app.execute_sql_query(
+            'SELECT DISTINCT genre FROM genres', 'Could not read genres.')]
+        languages = [row[0] for row in app.execute_sql_query(
+            'SELECT DISTINCT language_code FROM books',
+            'Could not read language codes.')]
+        isbns = [row[0] for row in app.execute_sql_query(
+            'SELECT isbn_10 FROM mv_book_stats ORDER BY num_ratings DESC '
+            'LIMIT %s', 'Could not read books.', (SAMPLE_BOOKS,))]
+        user_ids = [row[0] for row in app.execute_sql_query(
+            'SELECT DISTINCT user_id FROM ratings LIMIT %s',
+            'Could not read users.', (SAMPLE_USERS,))]
+        years = app.execute_sql_query(
+            'SELECT MIN(orig_publication_yr), MAX(orig_publication_yr) '
+            'FROM books', 'Could not read publication years.')[0]
+        return cls(genres, languages, isbns, user_ids, years, login)
+
+    def book(self, rng):
+        """
+        Draws a book, favoring the most rated ones as real users do.
+        """
+        return self.isbns[min(int(rng.expovariate(10.0 / len(self.isbns))),
+                              len(self.isbns) - 1)]
+
+    def year(self, rng):
+        (earliest, latest) = self.years
+        return rng.randint(max(earliest or 1900, 1900), latest or 2017)
+
+
+# ----------------------------------------------------------------------
+# Operations
+# ----------------------------------------------------------------------
+def op_search(data, rng):
+    """
+    The (s) menu option: search by genre, language and year.
+    """
+    language = 'eng' if 'eng' in data.languages else rng.choice(
+        data.languages)
+    (rows, _) = app.fetch_search_page(rng.choice(data.genres), language,
+                                      data.year(rng))
+    return len(rows)
+
+
+def op_full_text_search(data, rng):
+    """
+    The (f) menu option: keyword search over titles, authors, descriptions.
+    """
+    return len(app.fetch_full_text_matches(rng.choice(SEARCH_TERMS)))
+
+
+def op_recommend(data, rng):
+    """
+    The (b) menu option: recommendations for a book.
+    """
+    isbn_10 = data.book(rng)
+    return (len(app.fetch_recommendations(isbn_10))
+            + len(app.fetch_similar_descriptions(isbn_10))
+            + len(app.fetch_also_liked(isbn_10)))
+
+
+def op_popular_series(data, rng):
+    """
+    The (p) menu option: books by a popular series author, with averages.
+    """
+    rows = app.fetch_books_by_author(rng.choice(POPULAR_SERIES_AUTHORS))
+    app.fetch_average_ratings([row[0] for row in rows])
+    return len(rows)
+
+
+def op_login(data, rng):
+    """
+    Logging in.
+    """
+    return 1 if app.check_login(*data.login) else 0
+
+
+def op_users_top_rated(data, rng):
+    """
+    The (utr) admin option: a user's top rated books, with averages.
+    """
+    (rows, _) = app.fetch_users_top_rated_page(rng.choice(data.user_ids))
+    app.fetch_average_ratings([row[0] for row in rows])
+    return len(rows)
+
+
+def op_top_rated_in_timeframe(data, rng):
+    """
+    The (trt) admin option: top rated books published in a range of years.
+    """
+    start_year = data.year(rng)
+    end_year = start_year + rng.randint(0, 20)
+    (rows, _) = app.fetch_top_rated_in_timeframe_page(start_year, end_year)
+    return len(rows)
+
+
+def op_rate(data, rng):
+    """
+    The (r) menu option: a (synthetic) user rates a book. Duplicate ratings
+    raise an IntegrityError, which callers may count as an error.
+    """
+    app.insert_rating(SYNTHETIC_USER_BASE + rng.randrange(10 ** 7),
+                      data.book(rng), rng.randint(1, 5))
+    return 1
+
+
+def op_add_to_read(data, rng):
+    """
+    The (t) menu option: a (synthetic) user adds a book to their shelf.
+    """
+    app.insert_to_read(SYNTHETIC_USER_BASE + rng.randrange(10 ** 7),
+                       data.book(rng))
+    return 1
+
+
+# Name -> operation, for the read-only operations which can be repeated
+# without changing the database
+READ_OPERATIONS = {
+    'search': op_search,
+    'full_text_search': op_full_text_search,
+    'recommend': op_recommend,
+    'popular_series': op_popular_series,
+    'login': op_login,
+    'users_top_rated': op_users_top_rated,
+    'top_rated_in_timeframe': op_top_rated_in_timeframe,
+}
+# Name -> operation, for the operations which write
+WRITE_OPERATIONS = {
+    'rate': op_rate,
+    'add_to_read': op_add_to_read,
+}
+
+
+# ----------------------------------------------------------------------
+# Synthetic Data
+# ----------------------------------------------------------------------
+def popularity_weights(num_books, skew=1.0):
+    """
+    Returns cumulative Zipf-like weights for books ranked by popularity, for
+    bisect-based sampling.
+    """
+    return list(itertools.accumulate(1.0 / (rank + 1) ** skew
+                                     for rank in range(num_books)))
+
+
+def synthetic_user_books(isbns, num_users, per_user, seed):
+    """
+    Generator yielding (user_id, isbn_10s) for num_users synthetic users,
+    each with about per_user distinct books drawn with Zipf-like popularity
+    (isbns are ordered most popular first).
+    """
+    rng = random.Random(seed)
+    cumulative = popularity_weights(len(isbns))
+    total = cumulative[-1]
+    for user in range(num_users):
+        count = min(len(isbns), max(1, int(rng.expovariate(1.0 / per_user))))
+        books = set()
+        # Popular books are drawn repeatedly, so stop trying eventually
+        for _ in range(count * 4):
+            rank = bisect.bisect(cumulative, rng.random() * total)
+            books.add(isbns[min(rank, len(isbns) - 1)])
+            if len(books) == count:
+                break
+        yield (SYNTHETIC_USER_BASE + user, sorted(books))
+
+
+def synthetic_ratings(isbns, num_ratings, per_user=100, seed=0):
+    """
+    Generator yielding about num_ratings (user_id, isbn_10, rating) rows for
+    synthetic users, in primary key order.
+    """
+    rng = random.Random(seed + 1)
+    num_users = max(1, num_ratings // per_user)
+    for (user_id, books) in synthetic_user_books(isbns, num_users, per_user,
+                                                 seed):
+        # Each user is a harsher or more generous rater than average
+        bias = rng.gauss(0, 0.7)
+        for isbn_10 in books:
+            yield (user_id, isbn_10,
+                   min(5, max(1, int(round(3.9 + bias + rng.gauss(0, 0.9))))))
+
+
+def synthetic_to_read(isbns, num_rows, per_user=20, seed=0):
+    """
+    Generator yielding about num_rows (user_id, isbn_10) rows for synthetic
+    users, in primary key order.
+    """
+    num_users = max(1, num_rows // per_user)
+    for (user_id, books) in synthetic_user_books(isbns, num_users, per_user,
+                                                 seed + 2):
+        for isbn_10 in books:
+            yield (user_id, isbn_10)